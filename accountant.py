@@ -0,0 +1,257 @@
+"""
+Durable journal of outbound changes, for sync-acks and crash-safe replay.
+
+Every change the observer is about to notify peers of is appended to an
+on-disk journal first, and given an increasing sequence number ('seq').
+Peers acknowledge notifications by sequence number once they've applied
+them, in the response to that notification or a later one; whatever a peer hasn't acknowledged yet is replayed to it when this
+machine restarts (after a crash, or after a network partition outlasting
+the process), instead of having to reconcile the whole tree.
+
+The journal is a series of append-only segment files under conf.STATE_DIR,
+each named after the first seq in it. Records are framed as
+
+    length (4 bytes), crc32 (4 bytes), seq (8 bytes), JSON change
+
+so a record torn by a crash is detected, and cut off, on the next start.
+Appends are group committed: a single writer thread writes and fsyncs
+whatever has been appended since its last commit, and every append waits
+until its records are on disk, so concurrent appends share one fsync.
+Segments are deleted once every peer has acknowledged all of their records.
+"""
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+import conf
+from utils import logger
+
+RECORD_HEADER = struct.Struct('>IIQ')  # length of the JSON, its crc32, seq
+SEGMENT_SUFFIX = '.journal'
+ACKS_SAVE_INTERVAL = 1
+
+_fsync = getattr(os, 'fdatasync', os.fsync)
+
+
+def _encode(seq, change):
+    data = json.dumps(change).encode('utf-8')
+    return RECORD_HEADER.pack(len(data), zlib.crc32(data) & 0xffffffff, seq) + data
+
+
+def read_segment(path):
+    """
+    Generate the (seq, change) records of a segment file, and finally the
+    offset its valid records end at (short of a torn or corrupt record).
+    """
+    offset = 0
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            length, crc, seq = RECORD_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length or zlib.crc32(data) & 0xffffffff != crc:
+                break
+            yield seq, json.loads(data.decode('utf-8'))
+            offset += RECORD_HEADER.size + length
+    yield offset
+
+
+class TheAccountant(object):
+
+    def __init__(self, sync_dir, peers, state_dir=None, segment_size=None):
+        """
+        sync_dir: Dir whose changes are journaled; there is a journal per sync dir.
+        peers: Endpoints of the peers which acknowledge changes.
+
+        Nothing is opened until the journal is first used, so that it's
+        opened (and its writer thread started) by the process using it.
+        """
+        root = os.path.abspath(sync_dir)
+        root_id = hashlib.sha1(root.encode('utf-8')).hexdigest()[:16]
+        self.journal_dir = os.path.join(state_dir or conf.STATE_DIR, 'journal-{}'.format(root_id))
+        self.acks_path = os.path.join(self.journal_dir, 'acks.json')
+        self.peers = list(peers)
+        self.segment_size = segment_size or conf.JOURNAL_SEGMENT_SIZE
+        self._pid = None
+        self._open_lock = threading.Lock()
+
+    def __getstate__(self):
+        """Only the configuration is handed to a spawned process, which opens the journal itself."""
+        return dict(journal_dir=self.journal_dir, acks_path=self.acks_path, peers=self.peers,
+                    segment_size=self.segment_size)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._pid = None
+        self._open_lock = threading.Lock()
+
+    def _segment_path(self, first_seq):
+        return os.path.join(self.journal_dir, '{:020d}{}'.format(first_seq, SEGMENT_SUFFIX))
+
+    def _open(self):
+        """Recover the journal on disk, and start the writer thread."""
+        if self._pid == os.getpid():
+            return
+        with self._open_lock:
+            if self._pid != os.getpid():
+                self._recover_and_start()
+
+    def _recover_and_start(self):
+        if not os.path.isdir(self.journal_dir):
+            os.makedirs(self.journal_dir)
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._buffer = []  # Encoded records not written yet
+        self._segments = sorted(  # First seqs of the segment files, oldest first
+            int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.journal_dir)
+            if name.endswith(SEGMENT_SUFFIX))
+        self._seq = self._recover()
+        self._committed = self._seq
+        try:
+            with open(self.acks_path) as f:
+                self._acks = json.load(f)
+        except (IOError, ValueError):
+            self._acks = {}
+        for peer in self.peers:
+            # A peer new to this journal has nothing to catch up on
+            self._acks.setdefault(peer, self._seq)
+        self._acks_dirty = True
+
+        if not self._segments:
+            self._segments.append(self._seq + 1)
+        self._file = open(self._segment_path(self._segments[-1]), 'ab')
+        self._pid = os.getpid()
+        writer = threading.Thread(target=self._write_forever, name='journal-writer')
+        writer.daemon = True
+        writer.start()
+
+    def _recover(self):
+        """Last seq on disk, cutting off a torn record at the end of the last segment."""
+        if not self._segments:
+            return 0
+        last_path = self._segment_path(self._segments[-1])
+        last_seq = self._segments[-1] - 1
+        for record in read_segment(last_path):
+            if isinstance(record, tuple):
+                last_seq = record[0]
+            elif record < os.path.getsize(last_path):
+                logger.warning("JOURNAL: cutting off a torn record at %s of %s", record, last_path)
+                with open(last_path, 'r+b') as f:
+                    f.truncate(record)
+        return last_seq
+
+    def add_push_event(self, changes):
+        """
+        Journal changes about to be notified, setting the 'seq' of each of
+        them. Returns the last seq once they're all safely on disk.
+        """
+        self._open()
+        with self._cond:
+            for change in changes:
+                self._seq += 1
+                change['seq'] = self._seq
+                self._buffer.append(_encode(self._seq, change))
+            last_seq = self._seq
+            self._cond.notify_all()
+            while self._committed < last_seq:
+                self._cond.wait()
+        return last_seq
+
+    def ack(self, peer, seq):
+        """Record that a peer has accepted every change up to seq."""
+        self._open()
+        with self._lock:
+            if seq > self._acks.get(peer, 0):
+                self._acks[peer] = seq
+                self._acks_dirty = True
+
+    def unacked(self, peer):
+        """Generate the journaled changes the peer hasn't acknowledged yet, in order."""
+        self._open()
+        with self._lock:
+            acked = self._acks.get(peer, self._seq)
+            segments = list(self._segments)
+            last_seq = self._committed
+        for position, first_seq in enumerate(segments):
+            if position + 1 < len(segments) and segments[position + 1] <= acked + 1:
+                continue  # All acknowledged
+            try:
+                for record in read_segment(self._segment_path(first_seq)):
+                    if not isinstance(record, tuple):
+                        break
+                    seq, change = record
+                    if seq > last_seq:
+                        return
+                    if seq > acked:
+                        yield change
+            except IOError:
+                continue  # Compacted meanwhile
+
+    def stats(self):
+        self._open()
+        with self._lock:
+            return {'seq': self._seq, 'segments': len(self._segments), 'acks': dict(self._acks)}
+
+    def _write_forever(self):
+        while True:
+            with self._cond:
+                if not self._buffer:
+                    self._cond.wait(ACKS_SAVE_INTERVAL)
+                data = b''.join(self._buffer)
+                self._buffer = []
+                last_seq = self._seq
+            if data:
+                try:
+                    self._file.write(data)
+                    self._file.flush()
+                    _fsync(self._file.fileno())
+                except EnvironmentError as e:
+                    logger.error("JOURNAL: couldn't write %s: %s", self._file.name, e)
+                    time.sleep(1)
+                    with self._cond:
+                        self._buffer.insert(0, data)
+                    continue
+                with self._cond:
+                    self._committed = last_seq
+                    self._cond.notify_all()
+                if self._file.tell() >= self.segment_size:
+                    self._rotate(last_seq + 1)
+            try:
+                self._save_acks()
+                self._compact()
+            except EnvironmentError as e:
+                logger.error("JOURNAL: couldn't save acks or compact %s: %s", self.journal_dir, e)
+
+    def _rotate(self, first_seq):
+        self._file.close()
+        self._file = open(self._segment_path(first_seq), 'ab')
+        with self._lock:
+            self._segments.append(first_seq)
+
+    def _save_acks(self):
+        with self._lock:
+            if not self._acks_dirty:
+                return
+            data = json.dumps(self._acks)
+            self._acks_dirty = False
+        tmp_path = self.acks_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.rename(tmp_path, self.acks_path)
+
+    def _compact(self):
+        """Delete the segments every peer has acknowledged all records of."""
+        with self._lock:
+            acked = min(self._acks.get(peer, 0) for peer in self.peers) if self.peers else self._seq
+            done = [first_seq for first_seq, next_first_seq in zip(self._segments, self._segments[1:])
+                    if next_first_seq <= acked + 1]
+            self._segments = self._segments[len(done):]
+        for first_seq in done:
+            os.remove(self._segment_path(first_seq))
+            logger.info("JOURNAL: compacted segment %s", first_seq)
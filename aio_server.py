@@ -0,0 +1,680 @@
+"""
+asyncio based alternative to web_server.ThreadedHTTPServer (Python 3.7+).
+
+Instead of a thread per connection, every connection is a task on one
+event loop, and so are the fetch workers applying received changes:
+
+    * File GETs are sent with loop.sendfile, i.e. zero-copy os.sendfile
+      where the platform supports it, unless they're compressed on the fly.
+    * REQSYNC only validates and queues the changes; an AsyncFetchQueue
+      applies them, downloading files over keep-alive connections opened
+      on the same loop (see PeerClient). REQPUSH does the same once the
+      files pushed along are written out, on a thread (see push.py).
+    * REQLIST and REQDELTA, and the few other blocking bits (hashing,
+      delta syncs, writing out downloaded files), run on threads.
+
+At most conf.MAX_REQUESTS requests are handled at a time, and at most
+conf.MAX_REQUESTS_PER_PEER of them per peer address; the rest wait their
+turn. Outbound fetches are capped by conf.FETCH_WORKERS overall and by
+conf.POOL_SIZE connections per peer fetched from.
+
+It speaks the same protocol as web_server.py, so peers can run either.
+"""
+import asyncio
+import contextlib
+import email.utils
+import io
+import json
+import mimetypes
+import os
+import posixpath
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.client import responses
+from urllib.parse import quote, unquote, urlsplit
+
+import bundle
+import conf
+import content_encoding
+import delta
+import metrics
+import push
+import reconcile
+import startup
+import throttle
+from fetcher import FetchQueue, QueueFull
+from utils import logger, temp_path_for
+from web_server import CHUNK_WRITE_SIZE, origin_endpoint, parse_range, sync_response_headers
+
+MAX_HEADER_LINES = 100
+
+
+class DownloadError(Exception):
+    pass
+
+
+def _date(timestamp=None):
+    return email.utils.formatdate(timestamp, usegmt=True)
+
+
+async def _read_head(reader):
+    """
+    Read the start line and headers of a request or response. Returns
+    (start_line, {lowercased name: value}), or None if the connection
+    was closed before a new message started.
+    """
+    start_line = await reader.readline()
+    if not start_line:
+        return None
+    headers = {}
+    for _ in range(MAX_HEADER_LINES):
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return start_line.decode('latin-1').rstrip('\r\n'), headers
+
+
+async def _iter_body(reader, headers, timeout=None):
+    """
+    Generate the body of a message, chunked or with a Content-Length.
+    timeout: Seconds to wait for each read.
+    """
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        while True:
+            size_line = await asyncio.wait_for(reader.readline(), timeout)
+            size = int(size_line.split(b';')[0].strip(), 16)
+            if not size:
+                while (await asyncio.wait_for(reader.readline(), timeout)) not in (b'\r\n', b'\n', b''):
+                    pass  # Trailers
+                return
+            yield await asyncio.wait_for(reader.readexactly(size), timeout)
+            await asyncio.wait_for(reader.readexactly(2), timeout)
+    remaining = int(headers.get('content-length', 0))
+    while remaining > 0:
+        data = await asyncio.wait_for(reader.read(min(CHUNK_WRITE_SIZE, remaining)), timeout)
+        if not data:
+            raise asyncio.IncompleteReadError(b'', remaining)
+        yield data
+        remaining -= len(data)
+
+
+def _gather(chunks, size=CHUNK_WRITE_SIZE):
+    """Join the next chunks of a blocking generator up to about `size` bytes; b'' once it's done."""
+    gathered = []
+    gathered_size = 0
+    for chunk in chunks:
+        gathered.append(chunk)
+        gathered_size += len(chunk)
+        if gathered_size >= size:
+            break
+    return b''.join(gathered)
+
+
+async def _throttled(delay):
+    """Wait out a delay a throttle.Limiter asks for."""
+    if delay > 0:
+        metrics.THROTTLED_SECONDS.inc(delay)
+        await asyncio.sleep(delay)
+
+
+class Request(object):
+
+    def __init__(self, method, path, version, headers, body=b'', peer=None):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+        self.peer = peer  # Address of the client
+        connection = headers.get('connection', '').lower()
+        self.keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+
+
+class AsyncFetchQueue(FetchQueue):
+    """
+    FetchQueue whose workers are tasks on an event loop, applying changes
+    with a coroutine. put() is for the loop itself, put_many() for other
+    threads (e.g. the reconciler).
+    """
+
+    def __init__(self, apply, loop, workers=4, max_size=1000, apply_bundle=None, bundle_key=None,
+                 priority=None, applied=None, failed=None):
+        self._loop = loop
+        FetchQueue.__init__(self, apply, workers=workers, max_size=max_size,
+                            apply_bundle=apply_bundle, bundle_key=bundle_key, priority=priority,
+                            applied=applied, failed=failed)
+
+    def _start_workers(self, workers):
+        self._cond = asyncio.Condition()
+        for _ in range(workers):
+            self._loop.create_task(self._work())
+
+    async def put(self, changes):
+        async with self._cond:
+            if self._pending and len(self._pending) + len(changes) > self.max_size:
+                raise QueueFull()
+            self._extend(changes)
+            self._cond.notify_all()
+
+    def put_many(self, changes):
+        asyncio.run_coroutine_threadsafe(self.put(changes), self._loop).result()
+
+    async def _take(self):
+        async with self._cond:
+            while True:
+                batch = self._next_ready()
+                if batch is not None:
+                    self._start(batch)
+                    return batch
+                await self._cond.wait()
+
+    async def _done(self, batch, failed):
+        async with self._cond:
+            self._finish(batch, failed)
+            self._cond.notify_all()
+
+    async def _work(self):
+        while True:
+            batch = await self._take()
+            failed = batch
+            try:
+                if len(batch) > 1:
+                    failed = await self.apply_bundle(batch)
+                else:
+                    failed = [] if await self.apply(batch[0]) else batch
+            except Exception as e:
+                logger.exception("FETCHER: applying %s failed: %s", batch, e)
+            finally:
+                await self._done(batch, failed)
+
+
+def _open_temp(local_path):
+    """Open the temp file to download local_path into, making its dir if need be."""
+    dir_path = os.path.dirname(local_path)
+    if dir_path and not os.path.isdir(dir_path):
+        os.makedirs(dir_path)
+    return open(temp_path_for(local_path), 'wb')
+
+
+def _install_temp(f, local_path, rel_path, written, expected_size):
+    """fsync and close a downloaded temp file, and move it into place if it's complete."""
+    try:
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    if expected_size is not None and written != expected_size:
+        os.remove(f.name)
+        raise DownloadError("GET {}: got {} of {} bytes".format(rel_path, written, expected_size))
+    import shutil_dl
+    shutil_dl._install(f.name, local_path)
+
+
+class PeerClient(object):
+    """Keep-alive HTTP/1.1 client fetching files from one peer, on the event loop."""
+
+    def __init__(self, host, port, headers=None, max_connections=None):
+        self.host = host
+        self.port = int(port)
+        self.headers = headers or {}
+        self._idle = []  # (reader, writer) of idle keep-alive connections
+        self._slots = asyncio.Semaphore(max_connections or conf.POOL_SIZE)
+
+    async def _connect(self):
+        return await asyncio.wait_for(asyncio.open_connection(self.host, self.port), conf.CONNECT_TIMEOUT)
+
+    async def download(self, rel_path, local_path, limiter=throttle.UNLIMITED):
+        """
+        Fetch a file into local_path through a temp file, installing it once
+        complete. Returns the number of bytes received.
+        limiter: throttle.Limiter pacing the download.
+        Raises DownloadError, asyncio errors or EnvironmentError on failures.
+        """
+        async with self._slots:
+            while True:
+                reused = bool(self._idle)
+                reader, writer = self._idle.pop() if reused else await self._connect()
+                try:
+                    received, keep_alive = await self._download(reader, writer, rel_path, local_path, limiter)
+                except (ConnectionError, asyncio.IncompleteReadError) as e:
+                    writer.close()
+                    if reused and not getattr(e, 'partial', None):
+                        continue  # The peer closed the idle connection; retry on a new one
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                if keep_alive:
+                    self._idle.append((reader, writer))
+                else:
+                    writer.close()
+                return received
+
+    async def _download(self, reader, writer, rel_path, local_path, limiter):
+        request = ['GET {} HTTP/1.1'.format(quote(rel_path)),
+                   'Host: {}:{}'.format(self.host, self.port),
+                   'Accept-Encoding: {}'.format(content_encoding.accept_encoding())]
+        request.extend('{}: {}'.format(name, value) for name, value in self.headers.items())
+        writer.write('\r\n'.join(request).encode('latin-1') + b'\r\n\r\n')
+        await writer.drain()
+
+        head = await asyncio.wait_for(_read_head(reader), conf.READ_TIMEOUT)
+        if head is None:
+            raise asyncio.IncompleteReadError(b'', None)
+        status_line, headers = head
+        version, status = status_line.split(' ', 2)[:2]
+        keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+        if status != '200':
+            async for _ in _iter_body(reader, headers, conf.READ_TIMEOUT):
+                pass
+            raise DownloadError("GET {}: {}".format(rel_path, status_line))
+
+        encoding = headers.get('content-encoding')
+        decompressor = content_encoding.decompressor(encoding) if encoding and encoding != 'identity' else None
+        if 'x-simplesync-size' in headers:
+            expected_size = int(headers['x-simplesync-size'])
+        elif 'content-length' in headers and not decompressor:
+            expected_size = int(headers['content-length'])
+        else:
+            expected_size = None
+
+        # Everything touching the disk is done on a thread, the loop only receiving
+        loop = asyncio.get_event_loop()
+        f = await loop.run_in_executor(None, _open_temp, local_path)
+        received = 0
+        written = 0
+        try:
+            async for data in _iter_body(reader, headers, conf.READ_TIMEOUT):
+                received += len(data)
+                await _throttled(limiter.network_delay(len(data)))
+                if decompressor:
+                    data = decompressor.decompress(data)
+                await _throttled(limiter.disk_delay(len(data)))
+                await loop.run_in_executor(None, f.write, data)
+                written += len(data)
+        except BaseException:
+            await loop.run_in_executor(None, f.close)
+            raise
+        await loop.run_in_executor(None, _install_temp, f, local_path, rel_path, written, expected_size)
+        return received, keep_alive
+
+
+class AsyncSyncServer(object):
+
+    def __init__(self, serve_on, serve_dir, send_ack=True, syncer=None, accountant=None,
+                 max_requests=None, max_requests_per_peer=None):
+        self.serve_on = serve_on
+        self.serve_dir = os.path.abspath(serve_dir)
+        self.send_ack = send_ack
+        self.syncer = syncer
+        self.accountant = accountant
+        self.max_requests = max_requests or conf.MAX_REQUESTS
+        self.max_requests_per_peer = max_requests_per_peer or conf.MAX_REQUESTS_PER_PEER
+        self.executor = ThreadPoolExecutor(max_workers=conf.FETCH_WORKERS)
+        self.loop = None
+        self.fetch_queue = None
+        self._clients = {}  # endpoint -> PeerClient
+        self._requests = None
+        self._peer_requests = {}  # peer address -> [Semaphore, number of its requests holding or awaiting it]
+
+    async def serve_forever(self, reconcile_on_start=False):
+        self.loop = asyncio.get_event_loop()
+        self.loop.set_default_executor(self.executor)
+        self._requests = asyncio.Semaphore(self.max_requests)
+        self.fetch_queue = AsyncFetchQueue(self.apply_change, self.loop,
+                                           workers=conf.FETCH_WORKERS, max_size=conf.FETCH_QUEUE_SIZE,
+                                           apply_bundle=self.apply_bundle, bundle_key=self.syncer.bundle_key,
+                                           priority=throttle.priority, applied=self.syncer.acks.applied,
+                                           failed=self.syncer.acks.failed)
+        server = await asyncio.start_server(self._serve_connection, *self.serve_on)
+        startup.mark('listening')
+        # Import what fetching changes needs while waiting for the first ones
+        warm_up_thread = threading.Thread(target=self.syncer.warm_up, name='warm-up')
+        warm_up_thread.daemon = True
+        warm_up_thread.start()
+        if reconcile_on_start:
+            for endpoint in self.syncer.peers:
+                reconciler = reconcile.Reconciler(self.syncer, queue=self.fetch_queue, endpoint=endpoint)
+                reconcile_thread = threading.Thread(target=reconciler.run_until_done,
+                                                    name='reconcile-{}'.format(endpoint))
+                reconcile_thread.daemon = True
+                reconcile_thread.start()
+        async with server:
+            await server.serve_forever()
+
+    # Receiving side
+
+    def client_for(self, endpoint):
+        if endpoint not in self._clients:
+            url = urlsplit(endpoint)
+            self._clients[endpoint] = PeerClient(url.hostname, url.port, self.syncer.auth_headers)
+        return self._clients[endpoint]
+
+    async def apply_change(self, change):
+        """
+        Syncer.apply_change, with the files fetched on the event loop. Deletes
+        and moves, which can take a while on large dirs, are applied on a thread.
+        """
+        syncer = self.syncer
+        syncer._mark_just_synced(change)
+        if syncer._needs_fetch(change['change_type'], change['is_dir']):
+            applied = await self.remote_action(change)
+        else:
+            await self.loop.run_in_executor(None, syncer.local_action, change)
+            applied = True
+        # Again, as fetching may have taken longer than the suppression lasts
+        syncer._mark_just_synced(change)
+        return applied
+
+    async def apply_bundle(self, changes):
+        """Syncer.apply_bundle, on a thread."""
+        return await self.loop.run_in_executor(None, self.syncer.apply_bundle, changes)
+
+    async def remote_action(self, data):
+        """
+        Syncer.remote_action, except that whole files are downloaded on the
+        loop. Delta syncs, segmented downloads of large files, and retries of
+        failed downloads (which resume where they were cut off), are left to
+        Syncer.remote_action on a thread.
+        """
+        syncer = self.syncer
+        local_path = syncer._get_local_save_path(data['src_path'][1:])
+        if await self.loop.run_in_executor(None, syncer._install_pushed, data):
+            return True
+        if data.get('file_hash'):
+            local_hash = await self.loop.run_in_executor(None, syncer.manifest.file_hash, data['src_path'])
+            if local_hash == data['file_hash']:
+                logger.debug("Already up to date, not fetching: %s", data)
+                return True
+            if await self.loop.run_in_executor(None, syncer._copy_local, data):
+                return True
+        if await self.loop.run_in_executor(None, lambda: syncer._use_delta(local_path) or syncer._use_segments(data)):
+            return await self.loop.run_in_executor(None, syncer.remote_action, data)
+
+        start = time.time()
+        metrics.TRANSFERS_IN_FLIGHT.inc()
+        try:
+            endpoint = syncer.endpoint_for(data)
+            received = await self.client_for(endpoint).download(
+                data['src_path'], local_path, throttle.limiter_for(endpoint, throttle.priority(data)))
+        except (EnvironmentError, asyncio.TimeoutError, asyncio.IncompleteReadError, DownloadError) as e:
+            metrics.DOWNLOAD_FAILURES.inc()
+            logger.warning("Sync failed: %s; Error: %s; retrying", data, e)
+            return await self.loop.run_in_executor(None, syncer.remote_action, data)
+        finally:
+            metrics.TRANSFERS_IN_FLIGHT.dec()
+        metrics.record_download(time.time() - start, received)
+        syncer.recently_saved[data['src_path']] = data
+        await self.loop.run_in_executor(None, syncer.manifest.refresh, data['src_path'])
+        logger.info("Synced file: %s; %s bytes in %.2fs", data, received, time.time() - start)
+        return True
+
+    # Serving side
+
+    def _translate_path(self, url_path):
+        path = posixpath.normpath(unquote(urlsplit(url_path).path))
+        parts = [part for part in path.split('/') if part and part not in (os.curdir, os.pardir)]
+        return os.path.join(self.serve_dir, *parts)
+
+    async def _serve_connection(self, reader, writer):
+        startup.mark_once('first request')
+        peer = (writer.get_extra_info('peername') or ('',))[0]
+        try:
+            while True:
+                head = await asyncio.wait_for(_read_head(reader), conf.READ_TIMEOUT)
+                if head is None:
+                    break
+                start_line, headers = head
+                try:
+                    method, path, version = start_line.split(' ', 2)
+                except ValueError:
+                    await self._send(writer, 400, b'Bad request line')
+                    break
+                length = int(headers.get('content-length', 0))
+                if length > conf.MAX_BODY_SIZE:
+                    await self._send(writer, 413, b'Request body too large')
+                    break
+                # The body is only read once it's this request's turn, so that
+                # no more than max_requests of them are held in memory
+                async with self._turn(peer):
+                    body = await asyncio.wait_for(reader.readexactly(length), conf.READ_TIMEOUT) if length else b''
+                    request = Request(method, path, version, headers, body, peer)
+                    await self._dispatch(request, writer)
+                if not request.keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        except Exception as e:
+            logger.exception("WEBSERVER: error serving %s: %s", peer, e)
+        finally:
+            writer.close()
+
+    @contextlib.asynccontextmanager
+    async def _turn(self, peer):
+        """Wait for a request of peer's turn to be handled, within both the overall and per peer caps."""
+        turns = self._peer_requests.get(peer)
+        if turns is None:
+            turns = self._peer_requests[peer] = [asyncio.Semaphore(self.max_requests_per_peer), 0]
+        turns[1] += 1
+        try:
+            async with turns[0], self._requests:
+                yield
+        finally:
+            turns[1] -= 1
+            if not turns[1]:
+                del self._peer_requests[peer]
+
+    async def _dispatch(self, request, writer):
+        handler = getattr(self, 'do_' + request.method, None)
+        if handler is None:
+            await self._send(writer, 501, "Unsupported method ({})".format(request.method).encode('utf-8'))
+            return
+        await handler(request, writer)
+
+    def _head(self, code, headers):
+        lines = ['HTTP/1.1 {} {}'.format(code, responses.get(code, '')),
+                 'Server: SimpleSync',
+                 'Date: {}'.format(_date())]
+        lines.extend('{}: {}'.format(name, value) for name, value in headers)
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    async def _send(self, writer, code, body=b'', content_type='text/plain', headers=()):
+        headers = [('Content-type', content_type), ('Content-Length', len(body))] + list(headers)
+        writer.write(self._head(code, headers) + body)
+        await writer.drain()
+
+    async def _send_json(self, writer, code, resp_data, headers=()):
+        await self._send(writer, code, json.dumps(resp_data).encode('utf-8'), 'application/json', headers)
+
+    async def _send_chunked(self, writer, content_type, chunks, headers=()):
+        """
+        Send a chunked response whose body is generated by a blocking
+        generator, which is pulled on the thread pool.
+        """
+        headers = [('Content-type', content_type), ('Transfer-Encoding', 'chunked')] + list(headers)
+        writer.write(self._head(200, headers))
+        while True:
+            data = await self.loop.run_in_executor(None, _gather, chunks)
+            if not data:
+                break
+            writer.write('{:x}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n')
+            await writer.drain()
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+    async def do_GET(self, request, writer):
+        """
+        Send a file, or a single byte range of it (see web_server.RequestHandler.send_head),
+        with sendfile; whole files are compressed on the fly instead if negotiated.
+        """
+        response = metrics.response_for(request.path)
+        if response:
+            content_type, body = response
+            await self._send(writer, 200, body, content_type)
+            return
+        path = self._translate_path(request.path)
+        try:
+            f = open(path, 'rb')
+        except EnvironmentError:
+            await self._send(writer, 404, b'File not found')
+            return
+        with f:
+            fs = os.fstat(f.fileno())
+            if not os.path.isfile(path):
+                await self._send(writer, 404, b'File not found')
+                return
+            size = fs.st_size
+            last_modified = _date(fs.st_mtime)
+            content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+            headers = [('Content-type', content_type), ('Last-Modified', last_modified),
+                       ('Accept-Ranges', 'bytes')]
+
+            byte_range = None
+            if request.headers.get('range'):
+                byte_range = parse_range(request.headers['range'], size)
+                if_range = request.headers.get('if-range')
+                if if_range and if_range != last_modified:
+                    byte_range = None
+            if byte_range is not None:
+                start, end = byte_range
+                if start >= size or start > end:
+                    await self._send(writer, 416, headers=[('Content-Range', 'bytes */{}'.format(size))])
+                    return
+                code = 206
+                headers.append(('Content-Range', 'bytes {}-{}/{}'.format(start, end, size)))
+            else:
+                start, end = 0, size - 1
+                code = 200
+                encoding = content_encoding.negotiate(request.headers.get('accept-encoding'))
+                if encoding and size >= conf.COMPRESSION_MIN_SIZE and content_encoding.is_compressible(path):
+                    headers.extend([('Content-Encoding', encoding), ('Vary', 'Accept-Encoding'),
+                                    ('X-Simplesync-Size', size)])
+                    await self._send_chunked(writer, content_type, self._compressed(f, encoding), headers[1:])
+                    return
+
+            count = end - start + 1
+            writer.write(self._head(code, headers + [('Content-Length', count)]))
+            if count > 0:
+                await self.loop.sendfile(writer.transport, f, start, count)
+            await writer.drain()
+
+    def _compressed(self, f, encoding):
+        compressor = content_encoding.compressor(encoding)
+        while True:
+            data = f.read(CHUNK_WRITE_SIZE)
+            if not data:
+                break
+            yield compressor.compress(data)
+        yield compressor.flush()
+
+    async def do_REQSYNC(self, request, writer):
+        start = time.time()
+        try:
+            await self._handle_reqsync(request, writer)
+        finally:
+            metrics.REQSYNC_SECONDS.observe(time.time() - start)
+
+    async def do_REQPUSH(self, request, writer):
+        """See web_server.RequestHandler.do_REQPUSH."""
+        start = time.time()
+        try:
+            await self._handle_reqsync(request, writer, with_files=True)
+        finally:
+            metrics.REQSYNC_SECONDS.observe(time.time() - start)
+
+    async def _handle_reqsync(self, request, writer, with_files=False):
+        if with_files:
+            data, pushed = push.decode(io.BytesIO(request.body).read)
+        else:
+            data_string = request.body
+            if request.headers.get('content-encoding'):
+                try:
+                    data_string = await self.loop.run_in_executor(
+                        None, content_encoding.decompress, request.headers['content-encoding'], data_string,
+                        conf.MAX_BODY_SIZE)
+                except content_encoding.TooLarge as e:
+                    await self._send_json(writer, 413, {'errors': [str(e)]})
+                    return
+            data = json.loads(data_string.decode('utf-8'))
+            pushed = ()
+        logger.debug("WEBSERVER: RECEIVED REQSYNC: %s", data)
+        origin = origin_endpoint(request.peer, data)
+        seq = data.get('seq') if isinstance(data, dict) else None
+        if isinstance(data, dict) and 'changes' in data:
+            # Batched notification; changes are applied in order
+            data = data['changes']
+        # Validating stats the files (and loads the manifest, the first time)
+        valid_changes, errors = await self.loop.run_in_executor(None, self.syncer.validate_changes, data, origin)
+        if with_files:
+            await self.loop.run_in_executor(None, self.syncer.stage_pushed, valid_changes, pushed)
+        self.syncer.acks.expect(valid_changes)
+        try:
+            await self.fetch_queue.put(valid_changes)
+        except QueueFull:
+            self.syncer.unqueued(valid_changes)
+            metrics.REQSYNC_REFUSED.inc()
+            logger.warning("WEBSERVER: fetch queue full, REQSYNC refused")
+            await self._send_json(writer, 503, {'errors': ['Fetch queue full']},
+                                  headers=[('Retry-After', conf.BUSY_RETRY_AFTER)])
+            return
+        if seq:
+            self.syncer.acks.received(origin, seq)
+        resp_data = {'errors': errors}
+        logger.info("WEBSERVER: PROCESSED %s of %s changes from %s; errors: %s",
+                    request.method, len(data) if isinstance(data, list) else 1, origin, errors)
+        if self.send_ack:
+            resp_data['ack'] = time.time()
+            ack_seq = self.syncer.acks.ack_seq(origin)
+            if ack_seq is not None:
+                resp_data['ack_seq'] = ack_seq
+        else:
+            resp_data['data'] = data
+        await self._send_json(writer, 200, resp_data, headers=list(sync_response_headers().items()))
+
+    async def do_REQDELTA(self, request, writer):
+        """See web_server.RequestHandler.do_REQDELTA."""
+        data = json.loads(request.body.decode('utf-8'))
+        try:
+            source = open(self._translate_path(quote(data['path'])), 'rb')
+        except EnvironmentError:
+            await self._send(writer, 404, b'File not found')
+            return
+
+        def encoded_ops():
+            with source:
+                for op, value in delta.delta_ops(source, data['signatures'], data['block_size']):
+                    yield delta.encode_op(op, value)
+
+        await self._send_chunked(writer, 'application/octet-stream', encoded_ops())
+
+    async def do_REQBUNDLE(self, request, writer):
+        """See web_server.RequestHandler.do_REQBUNDLE."""
+        data = json.loads(request.body.decode('utf-8'))
+        frames = bundle.frames(data['paths'], lambda path: self._translate_path(quote(path)),
+                               conf.BUNDLE_MAX_FILE_SIZE)
+        await self._send_chunked(writer, 'application/octet-stream', frames)
+
+    async def do_REQLIST(self, request, writer):
+        """See web_server.RequestHandler.do_REQLIST."""
+        manifest, rules = await self.loop.run_in_executor(None, lambda: (self.syncer.manifest, self.syncer.ignore))
+
+        def lines():
+            for rel_path, is_dir, size, mtime in reconcile.walk_sorted(self.serve_dir, ignore=rules):
+                file_hash = None if is_dir else manifest.peek(rel_path, size, mtime)
+                yield json.dumps([rel_path, is_dir, size, mtime, file_hash]).encode('utf-8') + b'\n'
+
+        await self._send_chunked(writer, 'application/x-ndjson', lines())
+
+
+def run_server(serve_on=('0.0.0.0', 8000), serve_dir='.', send_ack=True,
+               syncer=None, accountant=None, reconcile_on_start=False):
+    """Same as web_server.run_server, serving with an AsyncSyncServer."""
+    os.chdir(serve_dir)
+    server = AsyncSyncServer(serve_on, os.getcwd(), send_ack=send_ack, syncer=syncer, accountant=accountant)
+    logger.info(">> Started asyncio web server on %s, use <Ctrl-C> to stop", serve_on)
+    try:
+        asyncio.run(server.serve_forever(reconcile_on_start=reconcile_on_start))
+    except KeyboardInterrupt:
+        logger.info("\n\nShutting down... Good bye!\n")
@@ -0,0 +1,226 @@
+"""
+Coalescing outbound queue for filesystem change notifications.
+
+The observer pushes every change it wants to sync into an EventBatcher.
+Changes on the same path are collapsed (created + modified + modified is
+sent as a single `created`), and the pending changes are handed over to
+the flush callable as one list once no new event has arrived for
+`quiet_window` seconds.
+
+A never ending stream of events is still flushed every `max_delay`
+seconds, or as soon as `max_size` changes are pending.
+
+Moving a directory moves the files pending to be fetched from under it
+after the move, at their new path.
+
+Deleting a directory makes whatever is pending under it redundant: the
+delete events of its contents, which the watcher reports before the
+directory's own, are dropped from the batch, so the whole subtree is sent
+as a single directory delete. Pending deletes don't count towards
+`max_size` for that reason, so that the deletes of a large subtree are
+still pending by the time its directory's delete arrives.
+"""
+import threading
+import time
+
+from watchdog import events
+
+from utils import logger
+
+FETCH_TYPE_EVENTS = (events.EVENT_TYPE_CREATED, events.EVENT_TYPE_MODIFIED)
+
+
+def split_moved_fetches(changes, src_dir, dest_dir):
+    """
+    Split changes queued before a move of src_dir to dest_dir into the
+    ones to keep as they are, and the fetches of files under src_dir. Those
+    files can only be found at their new path once the dir has moved, so the
+    fetches are returned rewritten to it, to be queued after the move.
+    """
+    prefix = src_dir + '/'
+    kept = []
+    moved = []
+    for change in changes:
+        if (change['change_type'] in FETCH_TYPE_EVENTS and not change['is_dir'] and
+                change['src_path'].startswith(prefix)):
+            moved.append(dict(change, src_path=dest_dir + change['src_path'][len(src_dir):]))
+        else:
+            kept.append(change)
+    return kept, moved
+
+
+class EventBatcher(object):
+
+    def __init__(self, flush, quiet_window=0.5, max_delay=5, max_size=500):
+        """
+        flush: Callable receiving a list of change dicts.
+        """
+        self.flush = flush
+        self.quiet_window = quiet_window
+        self.max_delay = max_delay
+        self.max_size = max_size
+
+        self._cond = threading.Condition()
+        self._pending = []  # Changes in arrival order
+        self._index = {}  # src_path -> position in _pending of its coalescable change
+        self._deleted_dirs = {}  # dir path -> position in _pending of its latest delete
+        self._deletes = 0  # Deletes in _pending
+        self._first_event_at = None
+        self._last_event_at = None
+        self._stopped = False
+
+        self._thread = threading.Thread(target=self._run, name='event-batcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _coalesce(self, pending, change):
+        """
+        Merge `change` into the `pending` change on the same path.
+        Returns the change that should take its place.
+        """
+        if change['change_type'] in FETCH_TYPE_EVENTS and pending['change_type'] in FETCH_TYPE_EVENTS:
+            # created + modified stays created, modified + modified is one modified
+            merged = dict(change)
+            merged['change_type'] = pending['change_type']
+            return merged
+        # Anything followed by a delete is a delete, and a
+        # delete followed by a (re)create is just a create.
+        return change
+
+    def _is_covered(self, position, path):
+        """Whether a directory containing `path` was deleted after `position` in the batch."""
+        while True:
+            path = path.rsplit('/', 1)[0]
+            if not path:
+                return False
+            if self._deleted_dirs.get(path, -1) > position:
+                return True
+
+    def _change_paths(self, change):
+        if change['change_type'] == events.EVENT_TYPE_MOVED:
+            return change['src_path'], change['dest_path']
+        return change['src_path'],
+
+    def _reindex(self):
+        """Rebuild the indexes of _pending after it's been reordered."""
+        self._index = {}
+        self._deleted_dirs = {}
+        for position, change in enumerate(self._pending):
+            if change['change_type'] == events.EVENT_TYPE_MOVED:
+                self._index.pop(change['src_path'], None)
+                self._index.pop(change['dest_path'], None)
+                continue
+            self._index[change['src_path']] = position
+            if change['is_dir'] and change['change_type'] == events.EVENT_TYPE_DELETED:
+                self._deleted_dirs[change['src_path']] = position
+
+    def push(self, change):
+        with self._cond:
+            now = time.time()
+            src_path = change['src_path']
+            position = self._index.get(src_path)
+            if position is not None and self._is_covered(position, src_path):
+                position = None  # That change is dropped, as its dir was deleted since
+
+            if change['change_type'] == events.EVENT_TYPE_MOVED:
+                # Moves are ordering barriers: nothing after them may be
+                # merged into a change on either path queued before them.
+                self._index.pop(src_path, None)
+                self._index.pop(change.get('dest_path'), None)
+                moved = []
+                if change['is_dir']:
+                    kept, moved = split_moved_fetches(
+                        [c for c in self._pending if c is not None], src_path, change['dest_path'])
+                if moved:
+                    self._pending = kept + [change] + moved
+                    self._reindex()
+                else:
+                    self._pending.append(change)
+            elif change['is_dir']:
+                # A dir delete has to come after whatever was queued under the dir,
+                # and a dir recreated after a delete is not the same dir.
+                if position is not None and change['change_type'] == events.EVENT_TYPE_DELETED:
+                    self._pending[position] = None
+                self._index[src_path] = len(self._pending)
+                self._pending.append(change)
+                if change['change_type'] == events.EVENT_TYPE_DELETED:
+                    self._deleted_dirs[src_path] = self._index[src_path]
+                    self._deletes += 1
+            elif position is not None:
+                self._pending[position] = self._coalesce(self._pending[position], change)
+            else:
+                self._index[src_path] = len(self._pending)
+                self._pending.append(change)
+                if change['change_type'] == events.EVENT_TYPE_DELETED:
+                    self._deletes += 1
+
+            if self._first_event_at is None:
+                self._first_event_at = now
+            self._last_event_at = now
+            self._cond.notify()
+
+    def _is_due(self, now):
+        if not self._pending:
+            return False
+        return (len(self._pending) - self._deletes >= self.max_size or
+                now - self._last_event_at >= self.quiet_window or
+                now - self._first_event_at >= self.max_delay)
+
+    def _take(self):
+        """
+        Block until a batch is due and return it. Returns None once stopped.
+        """
+        with self._cond:
+            while True:
+                now = time.time()
+                if self._is_due(now) or (self._stopped and self._pending):
+                    break
+                if self._stopped:
+                    return None
+                if self._pending:
+                    wait_for = min(self.quiet_window - (now - self._last_event_at),
+                                   self.max_delay - (now - self._first_event_at))
+                    self._cond.wait(max(wait_for, 0.01))
+                else:
+                    self._cond.wait()
+
+            batch = self._subtree_pruned()
+            self._pending = []
+            self._index = {}
+            self._deleted_dirs = {}
+            self._deletes = 0
+            self._first_event_at = self._last_event_at = None
+            return batch
+
+    def _subtree_pruned(self):
+        """The pending changes, without those made redundant by the delete of a dir containing them."""
+        if not self._deleted_dirs:
+            return [change for change in self._pending if change is not None]
+        batch = []
+        for position, change in enumerate(self._pending):
+            if change is None:
+                continue
+            if all(self._is_covered(position, path) for path in self._change_paths(change)):
+                continue
+            batch.append(change)
+        dropped = len(self._pending) - len(batch)
+        if dropped:
+            logger.info("BATCHER: dropped %s changes under %s deleted dirs", dropped, len(self._deleted_dirs))
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            if batch is None:
+                return
+            try:
+                self.flush(batch)
+            except Exception as e:
+                logger.exception("BATCHER: flushing %s changes failed: %s", len(batch), e)
+
+    def stop(self):
+        """Flush whatever is pending and stop the batching thread."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
@@ -0,0 +1,483 @@
+"""
+End-to-end sync throughput and latency benchmark.
+
+Starts two SimpleSync nodes syncing with each other on loopback, each with
+a temp sync dir and its own conf.ini and state dir, then runs scripted
+workloads against the first node while polling the second one until every
+change has been replicated:
+
+    small_files   Many small files in one dir
+    huge_files    A few huge files
+    deep_tree     Files spread over deeply nested dirs
+    rename_storm  Renames of many files which are synced already
+    append_log    Lines appended to a few log files, like a logger would
+
+The nodes are started afresh for every workload. For each workload the
+events/sec, bytes/sec, p50/p99 latency from an event on the first node to
+its replica being complete on the second one, and the peak RSS of the
+observer and webserver processes of both nodes are reported, and written
+as JSON for comparing releases:
+
+    python benchmark.py --output results.json
+    python benchmark.py -w small_files -w rename_storm --scale 0.1
+
+Peak RSS is read from /proc, so it's only reported on Linux.
+"""
+from __future__ import division
+
+import json
+import math
+import os
+import platform
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import click
+
+try:
+    from ConfigParser import RawConfigParser
+except ImportError:
+    # Python 3
+    from configparser import RawConfigParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+POLL_INTERVAL = 0.005
+STARTUP_TIMEOUT = 30
+STOP_TIMEOUT = 10
+PROBE_PATH = '.benchmark-probe'
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile, None for no values."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(percent / 100 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def child_pids(pid):
+    """Pids of the child processes of a process, oldest first (Linux only)."""
+    children = []
+    for name in os.listdir('/proc') if os.path.isdir('/proc') else []:
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name)) as f:
+                # Fields after the parenthesized command, from the state (field 3) on
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (IOError, OSError):
+            continue
+        if int(fields[1]) == pid:
+            children.append((int(fields[19]), int(name)))
+    return [child for _, child in sorted(children)]
+
+
+def peak_rss(pid):
+    """Peak resident set size of a process in bytes, None if unknown (Linux only)."""
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return None
+
+
+class Node(object):
+    """A SimpleSync node run as a child process, syncing with one peer."""
+
+    def __init__(self, name, work_dir, port, peer_port, python, server_mode=None):
+        self.name = name
+        self.port = port
+        self.sync_dir = os.path.join(work_dir, name)
+        self.node_dir = os.path.join(work_dir, name + '.node')
+        self.args = [python, os.path.join(HERE, 'simplesync.py'), '-d', self.sync_dir, '-r',
+                     '-p', str(port), '--peer', '127.0.0.1:{}'.format(peer_port)]
+        if server_mode:
+            self.args += ['--server_mode', server_mode]
+        self.process = None
+        os.makedirs(self.sync_dir)
+        os.makedirs(self.node_dir)
+        self._write_conf()
+
+    def _write_conf(self):
+        """conf.ini of the sample settings, with a state dir of the node's own."""
+        parser = RawConfigParser()
+        parser.read(os.path.join(HERE, 'conf.ini.sample'))
+        parser.set('dirconfig', 'state_dir', os.path.join(self.node_dir, 'state'))
+        with open(os.path.join(self.node_dir, 'conf.ini'), 'w') as f:
+            parser.write(f)
+
+    def start(self):
+        with open(os.path.join(self.node_dir, 'output.log'), 'ab') as output:
+            # In a session of its own, to stop its observer and webserver along with it
+            self.process = subprocess.Popen(self.args, cwd=self.node_dir, stdout=output,
+                                            stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+
+    def wait_listening(self, timeout=STARTUP_TIMEOUT):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("Node {} exited with {}; see {}".format(
+                    self.name, self.process.returncode, os.path.join(self.node_dir, 'output.log')))
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                return
+            except socket.error:
+                time.sleep(0.1)
+        raise RuntimeError("Node {} isn't listening on {} after {}s".format(self.name, self.port, timeout))
+
+    def peak_rss(self):
+        """Peak RSS of the observer and webserver processes, which are started in that order."""
+        pids = child_pids(self.process.pid)
+        return {role: peak_rss(pid) for role, pid in zip(('observer', 'webserver'), pids)}
+
+    def stop(self):
+        if self.process is None or self.process.poll() is not None:
+            return
+        try:
+            os.killpg(self.process.pid, signal.SIGTERM)
+            deadline = time.time() + STOP_TIMEOUT
+            while self.process.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if self.process.poll() is None:
+                os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass  # Gone already
+        self.process.wait()
+
+
+class Replicas(object):
+    """
+    Polls the replica dir for the expected outcome of each event, timing
+    how long after the event it was complete.
+    """
+
+    def __init__(self, replica_dir):
+        self.replica_dir = replica_dir
+        self.latencies = []
+        self._lock = threading.Lock()
+        self._added = []  # (since, check) added since the last poll
+        self._pending = []
+        self._generation = 0  # Bumped by reset, to drop whatever is being polled meanwhile
+        self._last_done = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._poll_forever, name='replica-poller')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def path(self, rel_path):
+        return os.path.join(self.replica_dir, rel_path)
+
+    def expect(self, since, check):
+        """check: Callable returning whether the replica is complete."""
+        with self._lock:
+            self._added.append((since, check))
+
+    def expect_size(self, since, rel_path, min_size):
+        path = self.path(rel_path)
+
+        def check():
+            try:
+                return os.path.getsize(path) >= min_size
+            except OSError:
+                return False
+        self.expect(since, check)
+
+    def expect_move(self, since, rel_path, new_rel_path, size):
+        path, new_path = self.path(rel_path), self.path(new_rel_path)
+
+        def check():
+            try:
+                return os.path.getsize(new_path) >= size and not os.path.lexists(path)
+            except OSError:
+                return False
+        self.expect(since, check)
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending) + len(self._added)
+
+    def wait(self, timeout):
+        """Wait for every expected replica; returns the time the last one was complete."""
+        deadline = time.time() + timeout
+        while self.pending() and time.time() < deadline:
+            time.sleep(POLL_INTERVAL)
+        with self._lock:
+            return self._last_done
+
+    def reset(self):
+        with self._lock:
+            self.latencies = []
+            self._added = []
+            self._pending = []
+            self._generation += 1
+            self._last_done = None
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _poll_forever(self):
+        while not self._stopped.is_set():
+            with self._lock:
+                self._pending.extend(self._added)
+                self._added = []
+                pending = self._pending
+                generation = self._generation
+            left, latencies, last_done = [], [], None
+            for since, check in pending:
+                if check():
+                    last_done = time.time()
+                    latencies.append(last_done - since)
+                else:
+                    left.append((since, check))
+            with self._lock:
+                if generation == self._generation:
+                    self._pending = left
+                    self.latencies.extend(latencies)
+                    self._last_done = last_done or self._last_done
+            time.sleep(POLL_INTERVAL)
+
+
+class Workload(object):
+    """File operations on the source dir, each expecting its replica on the other node."""
+
+    def __init__(self, source_dir, replicas):
+        self.source_dir = source_dir
+        self.replicas = replicas
+        self.reset()
+
+    def reset(self):
+        """Start measuring afresh, e.g. once the files a workload needs are in place."""
+        self.replicas.reset()
+        self.events = 0
+        self.bytes = 0
+        self.started = None
+
+    def _event(self, size):
+        now = time.time()
+        if self.started is None:
+            self.started = now
+        self.events += 1
+        self.bytes += size
+        return now
+
+    def path(self, rel_path):
+        return os.path.join(self.source_dir, rel_path)
+
+    def write(self, rel_path, data):
+        path = self.path(rel_path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+        self.replicas.expect_size(self._event(len(data)), rel_path, len(data))
+
+    def write_chunks(self, rel_path, chunk, count):
+        """Write a file of count chunks, as a single event."""
+        with open(self.path(rel_path), 'wb') as f:
+            for _ in range(count):
+                f.write(chunk)
+        size = len(chunk) * count
+        self.replicas.expect_size(self._event(size), rel_path, size)
+
+    def append(self, rel_path, data):
+        with open(self.path(rel_path), 'ab') as f:
+            f.write(data)
+            size = f.tell()
+        self.replicas.expect_size(self._event(len(data)), rel_path, size)
+
+    def rename(self, rel_path, new_rel_path):
+        size = os.path.getsize(self.path(rel_path))
+        os.rename(self.path(rel_path), self.path(new_rel_path))
+        self.replicas.expect_move(self._event(0), rel_path, new_rel_path, size)
+
+
+def _count(count, scale):
+    return max(1, int(count * scale))
+
+
+def small_files(workload, scale):
+    for i in range(_count(2000, scale)):
+        workload.write(os.path.join('small', 'file{:06d}.bin'.format(i)), os.urandom(4096))
+
+
+def huge_files(workload, scale):
+    os.makedirs(workload.path('huge'))
+    chunk_size = 1024 * 1024
+    for i in range(_count(4, scale)):
+        # Random, so it can't be compressed; the chunk repeats further apart than any compression window
+        workload.write_chunks(os.path.join('huge', 'file{}.bin'.format(i)), os.urandom(chunk_size), 64)
+
+
+def deep_tree(workload, scale):
+    for branch in range(_count(8, scale)):
+        rel_dir = 'tree{}'.format(branch)
+        for depth in range(16):
+            rel_dir = os.path.join(rel_dir, 'level{}'.format(depth))
+            for i in range(2):
+                workload.write(os.path.join(rel_dir, 'file{}.txt'.format(i)), os.urandom(1024))
+
+
+def rename_storm(workload, scale, timeout):
+    count = _count(1000, scale)
+    for i in range(count):
+        workload.write(os.path.join('renames', 'file{:06d}.txt'.format(i)), os.urandom(1024))
+    workload.replicas.wait(timeout)
+    # Let the echo suppression of the files synced above lapse
+    time.sleep(1)
+    workload.reset()
+    for i in range(count):
+        workload.rename(os.path.join('renames', 'file{:06d}.txt'.format(i)),
+                        os.path.join('renames', 'renamed{:06d}.txt'.format(i)))
+
+
+def append_log(workload, scale):
+    os.makedirs(workload.path('logs'))
+    logs = [os.path.join('logs', 'app{}.log'.format(i)) for i in range(4)]
+    for i in range(_count(250, scale)):
+        for log in logs:
+            workload.append(log, '{:.6f} INFO line {} of a log being appended to\n'.format(
+                time.time(), i).encode('utf-8'))
+        time.sleep(0.002)
+
+
+WORKLOADS = [
+    ('small_files', small_files),
+    ('huge_files', huge_files),
+    ('deep_tree', deep_tree),
+    ('rename_storm', rename_storm),
+    ('append_log', append_log),
+]
+WORKLOADS_WITH_SETUP = ('rename_storm',)
+
+
+def _wait_synced(source, replicas, timeout=STARTUP_TIMEOUT):
+    """Wait until a probe file gets replicated, rewriting it until the observer picks it up."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        source.write(PROBE_PATH, str(time.time()).encode('utf-8'))
+        replicas.wait(1)
+        if not replicas.pending():
+            return
+    raise RuntimeError("Nothing got synced within {}s".format(timeout))
+
+
+def run_workload(name, scale, python, server_mode, timeout):
+    work_dir = tempfile.mkdtemp(prefix='simplesync-benchmark-')
+    port_a, port_b = free_port(), free_port()
+    node_a = Node('A', work_dir, port_a, port_b, python, server_mode)
+    node_b = Node('B', work_dir, port_b, port_a, python, server_mode)
+    replicas = Replicas(node_b.sync_dir)
+    workload = Workload(node_a.sync_dir, replicas)
+    try:
+        for node in (node_a, node_b):
+            node.start()
+        for node in (node_a, node_b):
+            node.wait_listening()
+        _wait_synced(workload, replicas)
+        workload.reset()
+
+        function = dict(WORKLOADS)[name]
+        if name in WORKLOADS_WITH_SETUP:
+            function(workload, scale, timeout)
+        else:
+            function(workload, scale)
+        last_done = replicas.wait(timeout)
+        missing = replicas.pending()
+        latencies = replicas.latencies
+        ended = time.time() if missing or last_done is None else last_done
+        duration = ended - workload.started if workload.started else 0
+        return {
+            'events': workload.events,
+            'bytes': workload.bytes,
+            'duration': duration,
+            'events_per_sec': workload.events / duration if duration else None,
+            'bytes_per_sec': workload.bytes / duration if duration else None,
+            'latency': {
+                'p50': percentile(latencies, 50),
+                'p99': percentile(latencies, 99),
+                'max': max(latencies) if latencies else None,
+            },
+            'missing': missing,  # Events not replicated within the timeout
+            'peak_rss': {node.name: node.peak_rss() for node in (node_a, node_b)},
+        }
+    finally:
+        replicas.stop()
+        for node in (node_a, node_b):
+            node.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def _commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=HERE,
+                                           stderr=devnull).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _summary(name, result):
+    latency = result['latency']
+    return ("{:<13} {:>7} events {:>9.1f} events/s {:>9.2f} MB/s  p50 {} p99 {}{}".format(
+        name, result['events'], result['events_per_sec'] or 0, (result['bytes_per_sec'] or 0) / 1e6,
+        '{:.3f}s'.format(latency['p50']) if latency['p50'] is not None else '-',
+        '{:.3f}s'.format(latency['p99']) if latency['p99'] is not None else '-',
+        '  ({} missing)'.format(result['missing']) if result['missing'] else ''))
+
+
+@click.command()
+@click.option('--workload', '-w', 'workloads', multiple=True, type=click.Choice([name for name, _ in WORKLOADS]),
+              help='Workload to run; repeat for several. All of them by default.')
+@click.option('--scale', type=click.FLOAT, default=1.0,
+              help='Multiplier for the number of files or operations of every workload.')
+@click.option('--server_mode', type=click.Choice(['threaded', 'asyncio']), help='Server mode of the nodes.')
+@click.option('--python', default=sys.executable, help='Python interpreter to run the nodes with.')
+@click.option('--timeout', type=click.FLOAT, default=300,
+              help='Seconds to wait for the replicas of a workload.')
+@click.option('--output', '-o', type=click.Path(dir_okay=False, writable=True),
+              help='File to write the JSON results to, instead of printing them.')
+def run(workloads, scale, server_mode, python, timeout, output):
+    results = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': _commit(),
+        'python': subprocess.check_output([python, '-c', 'import platform; print(platform.python_version())'])
+                            .decode('ascii').strip(),
+        'platform': platform.platform(),
+        'server_mode': server_mode or 'default',
+        'scale': scale,
+        'workloads': {},
+    }
+    for name in workloads or [name for name, _ in WORKLOADS]:
+        result = run_workload(name, scale, python, server_mode, timeout)
+        results['workloads'][name] = result
+        click.echo(_summary(name, result), err=True)
+
+    data = json.dumps(results, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as f:
+            f.write(data + '\n')
+    else:
+        click.echo(data)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,82 @@
+"""
+Many small files in a single stream, for REQBUNDLE.
+
+Fetching thousands of tiny files with a GET each costs far more in round
+trips and request handling than in bytes, so the receiving side asks for
+a batch of them at once (see FetchQueue for how they're grouped), and the
+sending side streams them back one after the other, straight from the
+files, with no archive built on disk.
+
+Wire format of the stream, one frame per requested file:
+    >H path length + >q size + path (utf-8) + data   - a file
+    >H path length + >q -1 + path                    - a file not sent
+    >H 0 + >q 0                                      - end of stream
+
+A file is read whole before its frame is sent, so its size and data always
+agree even while it's being written to. Files missing, unreadable, or over
+conf.BUNDLE_MAX_FILE_SIZE bytes aren't sent; they're left for the receiver
+to fetch on their own.
+"""
+import struct
+
+FRAME_HEADER = struct.Struct('>Hq')
+NOT_SENT = -1
+
+
+def encode_frame(path, data):
+    """Frame of a file, or of a file not sent if data is None."""
+    encoded_path = path.encode('utf-8')
+    if data is None:
+        return FRAME_HEADER.pack(len(encoded_path), NOT_SENT) + encoded_path
+    return FRAME_HEADER.pack(len(encoded_path), len(data)) + encoded_path + data
+
+
+def end_frame():
+    return FRAME_HEADER.pack(0, 0)
+
+
+def read_file(file_path, max_size):
+    """Content of a file, or None if it's unreadable or over max_size bytes."""
+    try:
+        with open(file_path, 'rb') as f:
+            data = f.read(max_size + 1)
+    except EnvironmentError:
+        return None
+    return data if len(data) <= max_size else None
+
+
+def frames(paths, local_path_for, max_size):
+    """
+    Generate the frames of a bundle of paths, ending with the end frame.
+
+    local_path_for: Callable giving the local file of a requested path.
+    """
+    for path in paths:
+        yield encode_frame(path, read_file(local_path_for(path), max_size))
+    yield end_frame()
+
+
+def read_exact(read, size):
+    """`size` bytes read through `read`; raises EOFError if the stream ends first."""
+    chunks = []
+    while size:
+        chunk = read(size)
+        if not chunk:
+            raise EOFError("Bundle stream ended unexpectedly")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def read_frames(read):
+    """
+    Generate (path, data) of the files of a bundle stream read through
+    `read`; data is None for files not sent. Raises EOFError if the
+    stream is cut short.
+    """
+    while True:
+        path_length, size = FRAME_HEADER.unpack(read_exact(read, FRAME_HEADER.size))
+        if not path_length:
+            return
+        path = read_exact(read, path_length).decode('utf-8')
+        yield path, (None if size == NOT_SENT else read_exact(read, size))
@@ -1,17 +1,192 @@
-import ConfigParser
-conf = ConfigParser.SafeConfigParser({'RESPONSE_READ_CHUNK_SIZE': 4096, 'sync_dir': '/tmp/sstest'})
+try:
+    from ConfigParser import SafeConfigParser as ConfigParser
+except ImportError:
+    # Python 3
+    from configparser import ConfigParser
+conf = ConfigParser({
+    'RESPONSE_READ_CHUNK_SIZE': 4096,
+    'sync_dir': '/tmp/sstest',
+    'batch_quiet_window': '0.5',
+    'batch_max_delay': '5',
+    'batch_max_size': '500',
+    'peers': '',
+    'peer_backlog_size': '100000',
+    'peer_max_retry_delay': '60',
+    'pool_size': '10',
+    'connect_timeout': '5',
+    'read_timeout': '60',
+    'notify_retries': '3',
+    'retry_backoff': '1',
+    'notify_busy_max_wait': '60',
+    'delta_sync': 'true',
+    'delta_min_size': '4194304',
+    'delta_block_size': '2048',
+    'local_copy': 'copy',
+    'segmented_min_size': '67108864',
+    'download_segments': '4',
+    'bundle_max_file_size': '65536',
+    'bundle_max_files': '500',
+    'bundle_max_size': '4194304',
+    'push_mode': 'false',
+    'push_max_file_size': '65536',
+    'push_max_size': '4194304',
+    'max_download_rate': '0',
+    'max_download_rate_per_peer': '0',
+    'max_disk_write_rate': '0',
+    'small_file_size': '1048576',
+    'bulk_file_size': '16777216',
+    'state_dir': '/tmp/simplesync_state',
+    'hash_workers': '2',
+    'fetch_workers': '4',
+    'fetch_queue_size': '1000',
+    'busy_retry_after': '1',
+    'server_mode': 'threaded',
+    'max_requests': '256',
+    'max_requests_per_peer': '32',
+    'max_body_size': '67108864',
+    'metrics_path': '/_simplesync/metrics',
+    'reconcile_on_start': 'false',
+    'single_process': 'false',
+    'observer_backend': 'auto',
+    'max_watches': '0',
+    'poll_interval': '5',
+    'scan_workers': '8',
+    'dedupe_window': '5',
+    'dedupe_max_entries': '10000',
+    'journal': 'true',
+    'journal_segment_size': '16777216',
+    'log_path': '/tmp/simplesync.log',
+    'log_level': 'info',
+    'log_queue_size': '10000',
+    'ignore': '',
+    'compression': 'gzip',
+    'compression_level': '6',
+    'compression_min_size': '1024',
+})
 conf.read('conf.ini')
 
 # Transport settings
 DEFAULT_SYNC_MACHINE_IP = conf.get('transport', 'sync_machine_ip')
 DEFAULT_SYNC_MACHINE_PORT = conf.get('transport', 'sync_machine_port')
+# Machines to sync with, as comma separated host:port; if not given, the
+# sync machine above is the only one. Each peer has a backlog of up to
+# PEER_BACKLOG_SIZE changes not notified yet, retried at least every
+# PEER_MAX_RETRY_DELAY seconds while it's unreachable.
+PEERS = [peer.strip() for peer in conf.get('transport', 'peers').split(',') if peer.strip()]
+PEER_BACKLOG_SIZE = int(conf.get('transport', 'peer_backlog_size'))
+PEER_MAX_RETRY_DELAY = float(conf.get('transport', 'peer_max_retry_delay'))
 # EXCHANGE_SERVER_HOST = conf.get('transport', 'exchange_server_host')
 # EXCHANGE_SERVER_POST = conf.get('transport', 'exchange_server_port')
 
+# HTTP connection pool settings, per remote endpoint
+POOL_SIZE = int(conf.get('transport', 'pool_size'))
+CONNECT_TIMEOUT = float(conf.get('transport', 'connect_timeout'))
+READ_TIMEOUT = float(conf.get('transport', 'read_timeout'))
+NOTIFY_RETRIES = int(conf.get('transport', 'notify_retries'))
+RETRY_BACKOFF = float(conf.get('transport', 'retry_backoff'))
+# Seconds a notification waits in all on a peer answering it's busy (503 with
+# Retry-After) before it fails, and is left to the backlog to retry
+NOTIFY_BUSY_MAX_WAIT = float(conf.get('transport', 'notify_busy_max_wait'))
+
+# Delta transfer settings; modified files of at least DELTA_MIN_SIZE bytes
+# are synced by transferring only the changed blocks.
+DELTA_SYNC = conf.get('transport', 'delta_sync') == 'true'
+DELTA_MIN_SIZE = int(conf.get('transport', 'delta_min_size'))
+DELTA_BLOCK_SIZE = int(conf.get('transport', 'delta_block_size'))
+# Received files whose content is found in a local file already are copied
+# from it rather than fetched: `copy` (a reflink if the filesystem supports
+# it), `hardlink` (a reflink, or else a hard link) or `off`.
+LOCAL_COPY = conf.get('transport', 'local_copy')
+
+# Files of at least SEGMENTED_MIN_SIZE bytes are downloaded as DOWNLOAD_SEGMENTS
+# byte ranges fetched concurrently; 1 segment turns this off.
+SEGMENTED_MIN_SIZE = int(conf.get('transport', 'segmented_min_size'))
+DOWNLOAD_SEGMENTS = int(conf.get('transport', 'download_segments'))
+# Files of at most BUNDLE_MAX_FILE_SIZE bytes to fetch from the same peer are
+# fetched together, up to BUNDLE_MAX_FILES files or BUNDLE_MAX_SIZE bytes in
+# one REQBUNDLE (see bundle.py); a max file size of 0 turns this off.
+BUNDLE_MAX_FILE_SIZE = int(conf.get('transport', 'bundle_max_file_size'))
+BUNDLE_MAX_FILES = int(conf.get('transport', 'bundle_max_files'))
+BUNDLE_MAX_SIZE = int(conf.get('transport', 'bundle_max_size'))
+# With PUSH_MODE, files of at most PUSH_MAX_FILE_SIZE bytes are sent along with
+# their notification, to peers which take them (see push.py). PUSH_MAX_SIZE is
+# the most bytes of files in one notification, sent or taken; 0 takes none.
+PUSH_MODE = conf.get('transport', 'push_mode') == 'true'
+PUSH_MAX_FILE_SIZE = int(conf.get('transport', 'push_max_file_size'))
+PUSH_MAX_SIZE = int(conf.get('transport', 'push_max_size'))
+# Max bytes per second fetched overall, from each peer, and written to disk by
+# the fetches; 0 for no limit (see throttle.py). Files of at most
+# SMALL_FILE_SIZE bytes are fetched first, and those of at least BULK_FILE_SIZE
+# bytes last, by all but one of the fetch workers at most.
+MAX_DOWNLOAD_RATE = int(conf.get('transport', 'max_download_rate'))
+MAX_DOWNLOAD_RATE_PER_PEER = int(conf.get('transport', 'max_download_rate_per_peer'))
+MAX_DISK_WRITE_RATE = int(conf.get('transport', 'max_disk_write_rate'))
+SMALL_FILE_SIZE = int(conf.get('transport', 'small_file_size'))
+BULK_FILE_SIZE = int(conf.get('transport', 'bulk_file_size'))
+
+# On the fly compression of file transfers and notifications:
+# off, gzip, deflate or zstd (needs the zstandard package)
+COMPRESSION = conf.get('transport', 'compression')
+COMPRESSION_LEVEL = int(conf.get('transport', 'compression_level'))
+COMPRESSION_MIN_SIZE = int(conf.get('transport', 'compression_min_size'))
+
+# Event batching settings
+BATCH_QUIET_WINDOW = float(conf.get('transport', 'batch_quiet_window'))
+BATCH_MAX_DELAY = float(conf.get('transport', 'batch_max_delay'))
+BATCH_MAX_SIZE = int(conf.get('transport', 'batch_max_size'))
+
 # Sync settings
 DEFAULT_LOCAL_SYNC_DIR = conf.get('dirconfig', 'sync_dir')
 WATCH_RECURSIVE = conf.get('dirconfig', 'watch_recursive') == 'true'
 AUTO_CREATE_SYNC_DIR = conf.get('dirconfig', 'auto_create_sync_dir') == 'true'
+# Where manifests and other local sync state are kept
+STATE_DIR = conf.get('dirconfig', 'state_dir')
+HASH_WORKERS = int(conf.get('dirconfig', 'hash_workers'))
+# Fetch whatever is missing or stale compared to the remote on startup
+RECONCILE_ON_START = conf.get('dirconfig', 'reconcile_on_start') == 'true'
+# Watch and serve from one process, instead of forking one for each
+SINGLE_PROCESS = conf.get('dirconfig', 'single_process') == 'true'
+SCAN_WORKERS = int(conf.get('dirconfig', 'scan_workers'))
+# How the sync dir is watched: auto, native or polling (see watchers.py). A
+# tree needing more than MAX_WATCHES native watches (0: half the user's inotify
+# limit) is partly polled, every POLL_INTERVAL seconds.
+OBSERVER_BACKEND = conf.get('dirconfig', 'observer_backend')
+MAX_WATCHES = int(conf.get('dirconfig', 'max_watches'))
+POLL_INTERVAL = float(conf.get('dirconfig', 'poll_interval'))
+# Repeats of the same event within DEDUPE_WINDOW seconds are skipped (for a
+# file created or modified, only while its mtime and size are the same); at
+# most DEDUPE_MAX_ENTRIES recent events are remembered.
+DEDUPE_WINDOW = int(conf.get('dirconfig', 'dedupe_window'))
+DEDUPE_MAX_ENTRIES = int(conf.get('dirconfig', 'dedupe_max_entries'))
+# Journal outbound changes under STATE_DIR until every peer has acknowledged
+# them, so they're replayed after a crash (see accountant.py)
+JOURNAL = conf.get('dirconfig', 'journal') == 'true'
+JOURNAL_SEGMENT_SIZE = int(conf.get('dirconfig', 'journal_segment_size'))
+# Log file and level (debug, info, warning or error). Records are written by
+# a background thread; at most LOG_QUEUE_SIZE of them wait to be written,
+# any more are dropped.
+LOG_PATH = conf.get('dirconfig', 'log_path')
+LOG_LEVEL = conf.get('dirconfig', 'log_level')
+LOG_QUEUE_SIZE = int(conf.get('dirconfig', 'log_queue_size'))
+# .gitignore style patterns of paths not to sync, one per line; those of a
+# .syncignore file at the root of the sync dir apply after them (see ignore.py)
+IGNORE = [line for line in conf.get('dirconfig', 'ignore').splitlines() if line.strip()]
 
 # Web server settings
 WEBSERVER_PORT = int(conf.get('web_server', 'port'))
+# Received changes are applied by FETCH_WORKERS threads; when FETCH_QUEUE_SIZE
+# changes are waiting, notifiers are told to retry after BUSY_RETRY_AFTER seconds.
+FETCH_WORKERS = int(conf.get('web_server', 'fetch_workers'))
+FETCH_QUEUE_SIZE = int(conf.get('web_server', 'fetch_queue_size'))
+BUSY_RETRY_AFTER = int(conf.get('web_server', 'busy_retry_after'))
+# threaded (a thread per connection) or asyncio (one event loop; Python 3.7+
+# only). The asyncio server handles at most MAX_REQUESTS requests at a time,
+# and at most MAX_REQUESTS_PER_PEER of them from the same peer.
+SERVER_MODE = conf.get('web_server', 'server_mode')
+MAX_REQUESTS = int(conf.get('web_server', 'max_requests'))
+MAX_REQUESTS_PER_PEER = int(conf.get('web_server', 'max_requests_per_peer'))
+# Largest request body taken, in bytes, and largest a compressed notification
+# may decompress to; larger ones are refused with a 413
+MAX_BODY_SIZE = int(conf.get('web_server', 'max_body_size'))
+# Path the metrics are served on (see metrics.py); empty to not serve them
+METRICS_PATH = conf.get('web_server', 'metrics_path')
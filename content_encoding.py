@@ -0,0 +1,154 @@
+"""
+On the fly stream compression for file transfers and notifications.
+
+gzip and deflate are always available; zstd is too if the optional
+`zstandard` package is installed. Which one is used is negotiated the
+HTTP way: the receiving side lists what it can decode in Accept-Encoding,
+and the sending side picks conf.COMPRESSION if it's in there, or else
+the first one in there it supports itself.
+
+Files which are compressed already (judging by their extension or their
+first bytes) are always sent as they are.
+"""
+import io
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import conf
+
+SAMPLE_SIZE = 64 * 1024
+DECODE_CHUNK_SIZE = 64 * 1024
+MIN_SAMPLE_RATIO = 0.9  # Sample has to compress to less than this to compress the file
+
+SUPPORTED = (['zstd'] if zstandard else []) + ['gzip', 'deflate']
+
+COMPRESSED_EXTENSIONS = frozenset([
+    '.gz', '.tgz', '.bz2', '.xz', '.lz', '.lzma', '.zst', '.zip', '.7z', '.rar', '.jar', '.whl',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic',
+    '.mp3', '.aac', '.ogg', '.flac', '.mp4', '.mkv', '.mov', '.avi', '.webm',
+    '.pdf', '.docx', '.xlsx', '.pptx', '.odt', '.apk',
+])
+COMPRESSED_MAGIC = (
+    b'\x1f\x8b',  # gzip
+    b'PK\x03\x04',  # zip and friends
+    b'BZh',  # bzip2
+    b'\xfd7zXZ\x00',  # xz
+    b'(\xb5/\xfd',  # zstd
+    b'7z\xbc\xaf\x27\x1c',  # 7z
+    b'\x89PNG',
+    b'\xff\xd8\xff',  # jpeg
+    b'GIF8',
+)
+
+
+def enabled():
+    return conf.COMPRESSION != 'off'
+
+
+def accept_encoding():
+    """Accept-Encoding to send: what this side can decode, if compression is on."""
+    return ', '.join(SUPPORTED) if enabled() else 'identity'
+
+
+def negotiate(accept_encoding_header):
+    """Encoding to send with, given the other side's Accept-Encoding. None for no compression."""
+    if not (enabled() and accept_encoding_header):
+        return None
+    accepted = [part.split(';')[0].strip().lower() for part in accept_encoding_header.split(',')]
+    if conf.COMPRESSION in accepted and conf.COMPRESSION in SUPPORTED:
+        return conf.COMPRESSION
+    for encoding in accepted:
+        if encoding in SUPPORTED:
+            return encoding
+    return None
+
+
+def is_compressible(file_path):
+    """
+    False for files with the extension or magic bytes of a compressed format,
+    or whose first SAMPLE_SIZE bytes hardly compress (e.g. random or encrypted data).
+    """
+    if os.path.splitext(file_path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return False
+    try:
+        with open(file_path, 'rb') as f:
+            sample = f.read(SAMPLE_SIZE)
+    except IOError:
+        return False
+    if any(sample.startswith(magic) for magic in COMPRESSED_MAGIC):
+        return False
+    return len(zlib.compress(sample, 1)) < len(sample) * MIN_SAMPLE_RATIO
+
+
+def compressor(encoding):
+    """Object with compress(data) and flush() methods."""
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=conf.COMPRESSION_LEVEL).compressobj()
+    wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+    return zlib.compressobj(conf.COMPRESSION_LEVEL, zlib.DEFLATED, wbits)
+
+
+def decompressor(encoding):
+    """Object with a decompress(data) method."""
+    if encoding == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj()
+    if encoding == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        return zlib.decompressobj(zlib.MAX_WBITS)
+    raise ValueError("Unsupported content encoding: {}".format(encoding))
+
+
+class TooLarge(ValueError):
+    pass
+
+
+def compress(encoding, data):
+    c = compressor(encoding)
+    return c.compress(data) + c.flush()
+
+
+def _decoded_chunks(encoding, data):
+    """Generate data decoded, at most DECODE_CHUNK_SIZE bytes at a time."""
+    if encoding == 'zstd':
+        reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data))
+        for chunk in iter(lambda: reader.read(DECODE_CHUNK_SIZE), b''):
+            yield chunk
+        return
+    d = decompressor(encoding)
+    while data:
+        chunk = d.decompress(data, DECODE_CHUNK_SIZE)
+        data = d.unconsumed_tail
+        if chunk:
+            yield chunk
+    yield d.flush()
+
+
+def decompress(encoding, data, max_size=None):
+    """
+    Decode data. With max_size, it's decoded a chunk at a time, raising
+    TooLarge as soon as more than max_size bytes come out of it.
+    """
+    if max_size is None:
+        return decompressor(encoding).decompress(data)
+    decoded = []
+    size = 0
+    for chunk in _decoded_chunks(encoding, data):
+        size += len(chunk)
+        if size > max_size:
+            raise TooLarge("Decodes to more than {} bytes".format(max_size))
+        decoded.append(chunk)
+    return b''.join(decoded)
+
+
+def decompress_stream(encoding, chunks):
+    d = decompressor(encoding)
+    for chunk in chunks:
+        data = d.decompress(chunk)
+        if data:
+            yield data
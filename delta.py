@@ -0,0 +1,195 @@
+"""
+rsync style block level delta transfer.
+
+The receiver splits its local copy of a file into fixed size blocks and
+sends a signature (weak adler32 + strong md5) for each of them. The sender
+slides a window over its copy of the file, and wherever the window matches
+a block of the receiver it only sends a reference to that block; all other
+bytes are sent as literal data. The receiver then rebuilds the file from
+its old copy and the literal data.
+
+Wire format of the delta stream, one op after the other:
+    b'B' + >Q block index         - copy block from the receiver's old copy
+    b'L' + >I length + data       - literal data
+    b'E' + 16 bytes md5 digest    - end of stream, md5 of the whole new file
+"""
+import hashlib
+import math
+import struct
+import zlib
+
+OP_BLOCK = b'B'
+OP_LITERAL = b'L'
+OP_END = b'E'
+
+ADLER_MOD = 65521
+READ_SIZE = 1024 * 1024
+MAX_LITERAL_SIZE = 1024 * 1024  # Literal data is flushed in ops of at most this size
+# After this many blocks worth of unmatched data the sender stops looking for
+# matches at every byte offset, and only checks at block boundaries until the
+# next match. Keeps appends and large rewrites from being rolled byte by byte.
+MAX_ROLLING_BLOCKS = 16
+
+
+def block_size_for(file_size, min_block_size):
+    """Roughly sqrt(file_size) sized blocks, rounded up to whole KBs."""
+    size = int(math.sqrt(file_size))
+    size = (size + 1023) // 1024 * 1024
+    return max(size, min_block_size)
+
+
+def weak_checksum(data):
+    return zlib.adler32(bytes(data)) & 0xffffffff
+
+
+def strong_checksum(data):
+    return hashlib.md5(bytes(data)).hexdigest()
+
+
+def signatures(fileobj, block_size):
+    """
+    Signatures of every full block of `fileobj`; a trailing partial block
+    is left out as it could never be matched by a full window anyway.
+    """
+    sigs = []
+    while True:
+        block = fileobj.read(block_size)
+        if len(block) < block_size:
+            break
+        sigs.append([weak_checksum(block), strong_checksum(block)])
+    return sigs
+
+
+def _signature_index(sigs):
+    """{weak: {strong: block index}}"""
+    index = {}
+    for block_index, (weak, strong) in enumerate(sigs):
+        index.setdefault(weak, {}).setdefault(strong, block_index)
+    return index
+
+
+def delta_ops(fileobj, sigs, block_size):
+    """
+    Generate (op, value) pairs describing `fileobj` in terms of the
+    blocks in `sigs`; op is OP_BLOCK (value: block index), OP_LITERAL
+    (value: bytes) or OP_END (value: md5 digest of `fileobj`).
+    """
+    index = _signature_index(sigs)
+    file_md5 = hashlib.md5()
+    buf = bytearray()
+    eof = False
+    pos = 0  # start of the current window in buf
+    literal_start = 0  # start of not yet sent literal data in buf
+    weak = None
+    unmatched_since = 0
+
+    while True:
+        # After a long unmatched run only look for matches at block
+        # boundaries, until the next match.
+        skipping = pos - unmatched_since >= MAX_ROLLING_BLOCKS * block_size
+        lookahead = 2 * block_size if skipping else block_size + 1
+        if len(buf) - pos < lookahead and not eof:
+            # Drop what has been sent already before reading more
+            del buf[:literal_start]
+            pos -= literal_start
+            unmatched_since -= literal_start
+            literal_start = 0
+            data = fileobj.read(READ_SIZE)
+            if data:
+                file_md5.update(data)
+                buf.extend(data)
+            else:
+                eof = True
+            continue
+        if len(buf) - pos < block_size:
+            break
+
+        if weak is None:
+            weak = weak_checksum(buf[pos:pos + block_size])
+        candidates = index.get(weak)
+        if candidates:
+            block_index = candidates.get(strong_checksum(buf[pos:pos + block_size]))
+            if block_index is not None:
+                if pos > literal_start:
+                    yield OP_LITERAL, bytes(buf[literal_start:pos])
+                yield OP_BLOCK, block_index
+                pos += block_size
+                literal_start = unmatched_since = pos
+                weak = None
+                continue
+
+        if pos - literal_start >= MAX_LITERAL_SIZE:
+            yield OP_LITERAL, bytes(buf[literal_start:pos])
+            literal_start = pos
+
+        if len(buf) - pos < lookahead:
+            # End of file, the window can't move any further
+            break
+        if skipping:
+            pos += block_size
+            weak = None
+            continue
+
+        # Roll the window one byte forward
+        out_byte = buf[pos]
+        in_byte = buf[pos + block_size]
+        a = weak & 0xffff
+        b = weak >> 16
+        a = (a - out_byte + in_byte) % ADLER_MOD
+        b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+        weak = (b << 16) | a
+        pos += 1
+
+    while literal_start < len(buf):
+        yield OP_LITERAL, bytes(buf[literal_start:literal_start + MAX_LITERAL_SIZE])
+        literal_start += MAX_LITERAL_SIZE
+    yield OP_END, file_md5.digest()
+
+
+def encode_op(op, value):
+    if op == OP_BLOCK:
+        return OP_BLOCK + struct.pack('>Q', value)
+    elif op == OP_LITERAL:
+        return OP_LITERAL + struct.pack('>I', len(value)) + value
+    return OP_END + value
+
+
+def _read_exact(read, size):
+    data = b''
+    while len(data) < size:
+        chunk = read(size - len(data))
+        if not chunk:
+            raise EOFError("Delta stream ended unexpectedly")
+        data += chunk
+    return data
+
+
+def apply_delta(read, basis, out, block_size):
+    """
+    Rebuild a file into `out` from the delta stream read through `read`
+    and the receiver's old copy `basis`.
+
+    Returns (literal_bytes, matched_bytes). Raises ValueError when the
+    rebuilt file doesn't match the md5 sent by the sender.
+    """
+    literal_bytes = matched_bytes = 0
+    out_md5 = hashlib.md5()
+    while True:
+        op = _read_exact(read, 1)
+        if op == OP_BLOCK:
+            block_index, = struct.unpack('>Q', _read_exact(read, 8))
+            basis.seek(block_index * block_size)
+            data = basis.read(block_size)
+            matched_bytes += len(data)
+        elif op == OP_LITERAL:
+            length, = struct.unpack('>I', _read_exact(read, 4))
+            data = _read_exact(read, length)
+            literal_bytes += length
+        elif op == OP_END:
+            if _read_exact(read, 16) != out_md5.digest():
+                raise ValueError("Rebuilt file checksum mismatch")
+            return literal_bytes, matched_bytes
+        else:
+            raise ValueError("Unknown delta op: {!r}".format(op))
+        out_md5.update(data)
+        out.write(data)
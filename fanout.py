@@ -0,0 +1,144 @@
+"""
+Fan-out of change notifications to every peer.
+
+The observer hands each batch of changes to a FanOut, which appends it to
+the backlog of every peer. Each peer has its own sender thread working
+through its backlog in order, so a slow or unreachable peer only falls
+behind itself while the others keep being notified as usual. Once it's
+reachable again it catches up on its backlog, in batches of up to
+conf.BATCH_MAX_SIZE changes.
+
+Backlogs are kept in memory and bounded by conf.PEER_BACKLOG_SIZE changes.
+A peer falling further behind than that loses its oldest changes, and has
+to be brought up to date with --reconcile.
+"""
+import itertools
+import threading
+import time
+from collections import deque
+
+import conf
+import metrics
+import transport
+from utils import logger
+
+
+class PeerNotifier(object):
+
+    def __init__(self, endpoint, notify, max_backlog=None, max_batch=None, max_retry_delay=None):
+        """
+        endpoint: 'http://host:port' of the peer.
+        notify: Callable(endpoint, changes) returning whether the peer got the changes.
+        """
+        self.endpoint = endpoint
+        self.notify = notify
+        self.max_backlog = max_backlog or conf.PEER_BACKLOG_SIZE
+        self.max_batch = max_batch or conf.BATCH_MAX_SIZE
+        self.max_retry_delay = max_retry_delay or conf.PEER_MAX_RETRY_DELAY
+
+        self._cond = threading.Condition()
+        self._backlog = deque()  # (seq, time its event was received, change), oldest first
+        self._seq = 0
+        self.sent = 0
+        self.failures = 0  # Failed attempts since the last successful one
+        self.total_failures = 0
+        self.dropped = 0
+        self.last_success = None
+
+        self._thread = threading.Thread(target=self._run, name='notify-{}'.format(endpoint))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def push(self, changes, received_at=None):
+        """
+        received_at: Times the changes' events were received at, if known;
+                     the notify latency is measured from those.
+        """
+        now = time.time()
+        with self._cond:
+            for position, change in enumerate(changes):
+                self._seq += 1
+                self._backlog.append((self._seq, received_at[position] if received_at else now, change))
+            metrics.NOTIFY_BACKLOG.inc(len(changes))
+            overflow = len(self._backlog) - self.max_backlog
+            if overflow > 0:
+                for _ in range(overflow):
+                    self._backlog.popleft()
+                self.dropped += overflow
+                metrics.NOTIFY_BACKLOG.dec(overflow)
+                logger.warning("FANOUT: backlog of %s full, dropped its %s oldest changes; "
+                               "it needs a --reconcile to catch up", self.endpoint, overflow)
+            self._cond.notify()
+
+    def lag(self):
+        """Seconds the oldest change not sent yet has been waiting."""
+        with self._cond:
+            return time.time() - self._backlog[0][1] if self._backlog else 0
+
+    def stats(self):
+        with self._cond:
+            backlog = len(self._backlog)
+        return {
+            'endpoint': self.endpoint,
+            'backlog': backlog,
+            'lag': self.lag(),
+            'sent': self.sent,
+            'failures': self.failures,
+            'total_failures': self.total_failures,
+            'dropped': self.dropped,
+            'last_success': self.last_success,
+        }
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._backlog:
+                self._cond.wait()
+            entries = list(itertools.islice(self._backlog, self.max_batch))
+        return entries[-1][0], [change for _, _, change in entries]
+
+    def _sent(self, last_seq, count):
+        now = time.time()
+        with self._cond:
+            # Changes dropped meanwhile are gone from the front already
+            while self._backlog and self._backlog[0][0] <= last_seq:
+                metrics.NOTIFY_LATENCY.observe(now - self._backlog.popleft()[1])
+                metrics.NOTIFY_BACKLOG.dec()
+            backlog = len(self._backlog)
+        self.sent += count
+        self.last_success = time.time()
+        if self.failures:
+            logger.info("FANOUT: %s is back after %s failed attempts; %s changes left to catch up on",
+                        self.endpoint, self.failures, backlog)
+        self.failures = 0
+
+    def _run(self):
+        while True:
+            last_seq, changes = self._next_batch()
+            try:
+                notified = self.notify(self.endpoint, changes)
+            except Exception as e:
+                logger.exception("FANOUT: notifying %s failed: %s", self.endpoint, e)
+                notified = False
+            if notified:
+                self._sent(last_seq, len(changes))
+                continue
+            self.failures += 1
+            self.total_failures += 1
+            delay = min(transport.backoff_delay(self.failures), self.max_retry_delay)
+            logger.warning("FANOUT: %s not notified (%s failed attempts, %.0fs behind); retrying in %ss",
+                           self.endpoint, self.failures, self.lag(), delay)
+            time.sleep(delay)
+
+
+class FanOut(object):
+    """Notifies every peer of the changes pushed, each at its own pace."""
+
+    def __init__(self, endpoints, notify, **kwargs):
+        self.peers = [PeerNotifier(endpoint, notify, **kwargs) for endpoint in endpoints]
+
+    def push(self, changes, received_at=None):
+        for peer in self.peers:
+            peer.push(changes, received_at)
+
+    def stats(self):
+        return [peer.stats() for peer in self.peers]
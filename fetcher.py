@@ -0,0 +1,323 @@
+"""
+Bounded queue of received changes, applied by a pool of fetch workers.
+
+Changes are taken off the queue in arrival order, except that a change is
+held back while an earlier change on the same path (or on a directory
+containing it, or contained by it) is still queued or being applied. So
+a delete or move can never overtake an in-flight create of the same file,
+while unrelated files are fetched concurrently.
+
+The one exception is a directory move: files still waiting to be fetched
+from under the moved directory would no longer be found at their old
+path on the notifying side, so they're put after the move, at their new
+path.
+
+Given a bundle_key, a worker taking a change takes the next ready changes
+with the same key along with it, to be applied together; e.g. fetches of
+small files from the same peer, which are then fetched in one request
+(see bundle.py). A burst of thousands of them is then a handful of requests.
+
+Given a priority, the ready change taken is the one of the lowest priority
+class rather than the first (see throttle.priority), e.g. a small file
+edited during a bulk sync goes ahead of the big files queued before it.
+Changes of the bulk classes are taken by all but one of the workers at
+most, so one is always left for the others.
+
+The journal seqs of received changes are only acknowledged to their notifier
+once applied (see AckTracker), so that none is lost if this machine stops
+with changes still queued: the notifier replays what it wasn't acked. The
+apply callables tell which changes they applied; one that failed, like a
+download which didn't go through, stays unacknowledged until a later change
+of its path is applied.
+"""
+import threading
+from collections import deque
+
+from watchdog import events
+
+import conf
+import metrics
+import throttle
+from batcher import split_moved_fetches
+from utils import logger
+
+
+class QueueFull(Exception):
+    pass
+
+
+def _ancestors(path):
+    """'/a/b/c' -> ['/a/b', '/a']"""
+    ancestors = []
+    while True:
+        path = path.rsplit('/', 1)[0]
+        if not path:
+            return ancestors
+        ancestors.append(path)
+
+
+def _change_paths(change):
+    if change['change_type'] == events.EVENT_TYPE_MOVED:
+        return [change['src_path'], change['dest_path']]
+    return [change['src_path']]
+
+
+class _PathSet(object):
+    """Multiset of paths which can tell if a path overlaps any of them."""
+
+    def __init__(self):
+        self._paths = {}  # path -> count
+        self._parents = {}  # ancestor of a path in _paths -> count
+
+    def _update(self, counts, key, delta):
+        counts[key] = counts.get(key, 0) + delta
+        if not counts[key]:
+            del counts[key]
+
+    def add(self, path, delta=1):
+        self._update(self._paths, path, delta)
+        for ancestor in _ancestors(path):
+            self._update(self._parents, ancestor, delta)
+
+    def remove(self, path):
+        self.add(path, -1)
+
+    def overlaps(self, path):
+        if path in self._paths or path in self._parents:
+            return True
+        return any(ancestor in self._paths for ancestor in _ancestors(path))
+
+
+class AckTracker(object):
+    """
+    Journal seqs of the received changes which can be acknowledged to each
+    notifier: the last one up to which all its queued changes have been applied.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}  # origin -> {seq: number of queued changes with it not applied yet}
+        self._received = {}  # origin -> last seq of its notifications taken
+        self._failed = {}  # (origin, path) -> seqs of changes of path which failed to apply
+
+    def expect(self, changes):
+        """Hold back the acknowledgement of changes about to be queued, until they're applied."""
+        with self._lock:
+            for change in changes:
+                if change.get('seq') and change.get('origin'):
+                    pending = self._pending.setdefault(change['origin'], {})
+                    pending[change['seq']] = pending.get(change['seq'], 0) + 1
+
+    def release(self, change):
+        """Stop holding back a change held back by expect, e.g. one which wasn't queued after all."""
+        if not (change.get('seq') and change.get('origin')):
+            return
+        with self._lock:
+            self._release(change['origin'], change['seq'])
+
+    def _release(self, origin, seq):
+        pending = self._pending.get(origin, {})
+        if seq in pending:
+            pending[seq] -= 1
+            if not pending[seq]:
+                del pending[seq]
+
+    def applied(self, change):
+        """
+        Release a change once applied, along with the failed changes of its
+        paths from the same notifier, which it supersedes.
+        """
+        if not (change.get('seq') and change.get('origin')):
+            return
+        with self._lock:
+            self._release(change['origin'], change['seq'])
+            for path in _change_paths(change):
+                for seq in self._failed.pop((change['origin'], path), ()):
+                    self._release(change['origin'], seq)
+
+    def failed(self, change):
+        """
+        Keep holding back a change which couldn't be applied, so that its
+        notifier replays it, until a later change of its path is applied.
+        """
+        if not (change.get('seq') and change.get('origin')):
+            return
+        with self._lock:
+            self._failed.setdefault((change['origin'], change['src_path']), []).append(change['seq'])
+
+    def received(self, origin, seq):
+        """Note the last seq of a notification whose changes were all queued."""
+        with self._lock:
+            self._received[origin] = max(seq, self._received.get(origin, 0))
+
+    def ack_seq(self, origin):
+        """Seq to acknowledge to origin, if any."""
+        with self._lock:
+            pending = self._pending.get(origin)
+            if pending:
+                return min(pending) - 1 or None
+            return self._received.get(origin)
+
+
+class FetchQueue(object):
+
+    def __init__(self, apply, workers=4, max_size=1000, apply_bundle=None, bundle_key=None, priority=None,
+                 applied=None, failed=None):
+        """
+        apply: Callable applying a single change, returning whether it did;
+               run by the worker threads.
+        apply_bundle: Callable applying a list of changes with the same bundle
+                      key, returning those it couldn't apply.
+        bundle_key: Callable giving what a change can be applied along with
+                    other changes by, or None if it's to be applied on its own.
+        priority: Callable giving the priority class of a change, see throttle.py.
+        applied: Callable called with each change once it's been applied, e.g. AckTracker.applied.
+        failed: Callable called with each change which couldn't be applied, e.g. AckTracker.failed.
+        """
+        self.apply = apply
+        self.applied = applied
+        self.failed = failed
+        self.apply_bundle = apply_bundle
+        self.bundle_key = bundle_key if apply_bundle else None
+        self.priority = priority
+        self.max_size = max_size
+        self.max_bulk = max(workers - 1, 1)  # Workers on bulk changes at a time
+        self._bulk = 0
+        self._cond = threading.Condition()
+        self._pending = deque()
+        self._in_flight = _PathSet()
+        self._start_workers(workers)
+
+    def _start_workers(self, workers):
+        for i in range(workers):
+            worker = threading.Thread(target=self._work, name='fetch-worker-{}'.format(i))
+            worker.daemon = True
+            worker.start()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put_many(self, changes):
+        """
+        Queue all of `changes`, or none of them: raises QueueFull if they
+        don't fit. A batch larger than max_size is still taken when the
+        queue is empty, so it can't be refused forever.
+        """
+        with self._cond:
+            if self._pending and len(self._pending) + len(changes) > self.max_size:
+                raise QueueFull()
+            self._extend(changes)
+            self._cond.notify_all()
+
+    def _extend(self, changes):
+        for change in changes:
+            if change['change_type'] == events.EVENT_TYPE_MOVED and change['is_dir']:
+                self._pending.append(change)
+                self._pending.extend(self._pop_fetches_under(change['src_path'], change['dest_path']))
+            else:
+                self._pending.append(change)
+        metrics.FETCH_QUEUE_DEPTH.set(len(self._pending))
+
+    def _pop_fetches_under(self, src_dir, dest_dir):
+        """Take the pending fetches of files under src_dir out of the queue, moved to dest_dir."""
+        kept, moved = split_moved_fetches(self._pending, src_dir, dest_dir)
+        if moved:
+            self._pending = deque(kept)
+        return moved
+
+    def _priority(self, change):
+        return self.priority(change) if self.priority else throttle.PRIORITY_INTERACTIVE
+
+    def _is_bulk(self, batch):
+        return min(self._priority(change) for change in batch) >= throttle.PRIORITY_BULK
+
+    def _next_ready(self):
+        """
+        Pop the first pending change of the lowest priority class among those
+        not overlapping any earlier or in-flight one, along with the next such
+        changes of the same bundle key, if it has one, up to
+        conf.BUNDLE_MAX_FILES of them and conf.BUNDLE_MAX_SIZE bytes.
+        """
+        held_back = _PathSet()
+        taken = []
+        first_priority = None
+        key = None
+        taken_size = 0
+        for position, change in enumerate(self._pending):
+            paths = _change_paths(change)
+            if not any(self._in_flight.overlaps(p) or held_back.overlaps(p) for p in paths):
+                change_priority = self._priority(change)
+                if change_priority >= throttle.PRIORITY_BULK and self._bulk >= self.max_bulk:
+                    pass  # Left for when a bulk change in flight is done
+                elif not taken or change_priority < first_priority:
+                    taken = [position]
+                    first_priority = change_priority
+                    key = self.bundle_key(change) if self.bundle_key else None
+                    taken_size = change.get('size', 0)
+                elif (key is not None and len(taken) < conf.BUNDLE_MAX_FILES and
+                      self.bundle_key(change) == key and taken_size + change.get('size', 0) <= conf.BUNDLE_MAX_SIZE):
+                    taken.append(position)
+                    taken_size += change.get('size', 0)
+                if taken and first_priority == throttle.PRIORITY_INTERACTIVE and (
+                        key is None or len(taken) >= conf.BUNDLE_MAX_FILES):
+                    break
+            for path in paths:
+                held_back.add(path)
+        if not taken:
+            return None
+        if len(taken) == 1:
+            batch = [self._pending[taken[0]]]
+            del self._pending[taken[0]]
+        else:
+            taken = set(taken)
+            batch = [change for position, change in enumerate(self._pending) if position in taken]
+            self._pending = deque(change for position, change in enumerate(self._pending)
+                                  if position not in taken)
+        metrics.FETCH_QUEUE_DEPTH.set(len(self._pending))
+        return batch
+
+    def _start(self, batch):
+        for change in batch:
+            for path in _change_paths(change):
+                self._in_flight.add(path)
+        if self._is_bulk(batch):
+            self._bulk += 1
+
+    def _finish(self, batch, failed=()):
+        failed = set(id(change) for change in failed)
+        for change in batch:
+            for path in _change_paths(change):
+                self._in_flight.remove(path)
+            callback = self.failed if id(change) in failed else self.applied
+            if callback:
+                callback(change)
+        if self._is_bulk(batch):
+            self._bulk -= 1
+
+    def _take(self):
+        with self._cond:
+            while True:
+                batch = self._next_ready()
+                if batch is not None:
+                    self._start(batch)
+                    return batch
+                self._cond.wait()
+
+    def _done(self, batch, failed):
+        with self._cond:
+            self._finish(batch, failed)
+            self._cond.notify_all()
+
+    def _work(self):
+        while True:
+            batch = self._take()
+            failed = batch
+            try:
+                if len(batch) > 1:
+                    failed = self.apply_bundle(batch)
+                else:
+                    failed = [] if self.apply(batch[0]) else batch
+            except Exception as e:
+                logger.exception("FETCHER: applying %s failed: %s", batch, e)
+            finally:
+                self._done(batch, failed)
@@ -0,0 +1,159 @@
+"""
+.gitignore style rules for paths not to sync.
+
+Rules come from the `ignore` option in conf.ini, one pattern per line,
+followed by those of the .syncignore file at the root of the sync dir, if
+there is one. The syntax is that of .gitignore:
+
+    # A comment; blank lines are skipped too
+    *.swp           Any file or dir named like this, at any depth
+    build/          Only dirs, at any depth, and everything under them
+    /dist           Only at the root of the sync dir
+    docs/**/*.tmp   Patterns with a slash are relative to the root
+    !keep.swp       Not ignored after all, if a rule before ignored it
+
+As with git, a path under an ignored dir is ignored whatever later rules
+say, since the dir is never looked into. Edits of .syncignore are picked
+up within RELOAD_INTERVAL seconds, by each process on its own.
+
+Rules are compiled once into a single regex matching the ignored paths and
+everything under them (or, if there are negated rules, a regex per run of
+rules that are negated or not), so a path is checked with one regex match
+per run, without splitting it up.
+"""
+import os
+import re
+import time
+
+import conf
+from utils import logger
+
+IGNORE_FILE = '.syncignore'
+RELOAD_INTERVAL = 1  # Seconds between checks of whether the .syncignore file changed
+
+
+def _translate(pattern):
+    """Regex matching the relative paths (dirs with a trailing /) a pattern matches, and what's under them."""
+    dir_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+    parts = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i) and (i == 0 or pattern[i - 1] == '/'):
+            parts.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i) and i + 2 == len(pattern) and (i == 0 or pattern[i - 1] == '/'):
+            parts.append('.+')  # What's under the dir, not the dir itself
+            i += 2
+        elif pattern[i] == '*':
+            parts.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            parts.append('[^/]')
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            chars = pattern[i + 1:end]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            parts.append('[{}]'.format(chars.replace('\\', '\\\\')))
+            i = end + 1
+        else:
+            if pattern[i] == '\\' and i + 1 < len(pattern):
+                i += 1
+            parts.append(re.escape(pattern[i]))
+            i += 1
+    return '{}{}{}'.format('' if anchored else '(?:.*/)?', ''.join(parts), '/' if dir_only else '(?:/|$)')
+
+
+def parse(lines):
+    """(negated, regex) of each rule in lines."""
+    rules = []
+    for line in lines:
+        line = line.rstrip('\n').rstrip('\r')
+        if not line.endswith('\\ '):
+            line = line.rstrip()
+        if not line or line.startswith('#'):
+            continue
+        negated = line.startswith('!')
+        if negated or line.startswith('\\!') or line.startswith('\\#'):
+            line = line[1:]
+        rules.append((negated, _translate(line)))
+    return rules
+
+
+class IgnoreRules(object):
+
+    def __init__(self, lines=(), sync_dir=None, mtime=None):
+        self.patterns = list(lines)
+        self.sync_dir = sync_dir  # Whose .syncignore the rules were loaded from, if any
+        self._mtime = mtime
+        self._checked_at = time.time()
+        # Runs of consecutive rules which are all negated or all not,
+        # last first, as the last matching rule decides
+        groups = []
+        for negated, regex in parse(self.patterns):
+            if groups and groups[-1][0] == negated:
+                groups[-1][1].append(regex)
+            else:
+                groups.append((negated, [regex]))
+        self._groups = [(negated, re.compile('(?:{})'.format('|'.join(regexes))).match)
+                        for negated, regexes in reversed(groups)]
+
+    @classmethod
+    def load(cls, sync_dir):
+        """The rules of conf.IGNORE, followed by those of the sync dir's .syncignore."""
+        lines = list(conf.IGNORE)
+        mtime = _mtime(sync_dir)
+        try:
+            with open(os.path.join(sync_dir, IGNORE_FILE)) as f:
+                lines.extend(f)
+        except IOError:
+            pass
+        return cls(lines, sync_dir, mtime)
+
+    def refreshed(self):
+        """
+        These rules, or the rules reloaded if the .syncignore file changed
+        since they were loaded. The file is looked at once a RELOAD_INTERVAL
+        at most, so this is cheap enough to call before every use.
+        """
+        now = time.time()
+        if self.sync_dir is None or now - self._checked_at < RELOAD_INTERVAL:
+            return self
+        self._checked_at = now
+        if _mtime(self.sync_dir) == self._mtime:
+            return self
+        logger.info("IGNORE: reloading the rules of %s", os.path.join(self.sync_dir, IGNORE_FILE))
+        return self.load(self.sync_dir)
+
+    def __bool__(self):
+        return bool(self._groups)
+
+    __nonzero__ = __bool__
+
+    def match(self, rel_path, is_dir=False):
+        """Whether rel_path (with or without a leading /) is ignored."""
+        if not self._groups:
+            return False
+        path = rel_path.lstrip('/')
+        if is_dir:
+            path += '/'
+        for negated, match in self._groups:
+            if match(path):
+                # Not even a negated rule applies under an ignored dir
+                return self._parent_ignored(path) if negated else True
+        return False
+
+    def _parent_ignored(self, path):
+        parent = path.rstrip('/').rpartition('/')[0]
+        return bool(parent) and self.match(parent, is_dir=True)
+
+
+def _mtime(sync_dir):
+    try:
+        return os.stat(os.path.join(sync_dir, IGNORE_FILE)).st_mtime
+    except OSError:
+        return None
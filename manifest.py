@@ -0,0 +1,291 @@
+"""
+Persistent content-hash manifest of a sync directory.
+
+Keeps a (size, mtime, content hash) record for every file that has been
+seen, keyed by its path relative to the sync dir (e.g. '/dir/file', the
+same form used in change notifications). Hashes are only recomputed
+when the size or mtime of a file changes, and are computed by a pool of
+background worker threads so the observer never blocks on them.
+
+The manifest is saved as JSON under conf.STATE_DIR, one file per sync
+dir and per role (the observer and the receiving side each keep one).
+An index from content hash to the paths having it is kept along, rebuilt
+from the saved entries on load, for finding local copies of some content,
+and so is one from each dir to the entries and dirs in it, so that deleting
+or moving a dir only goes through what's under it.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+try:
+    import queue as Queue
+except ImportError:
+    # Python 2
+    import Queue
+
+import conf
+from utils import logger
+
+HASH_READ_SIZE = 1024 * 1024
+HASH_ATTEMPTS = 3  # Give up hashing a file that keeps changing while being read
+
+
+def hash_file(file_path):
+    file_hash = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        while True:
+            data = f.read(HASH_READ_SIZE)
+            if not data:
+                break
+            file_hash.update(data)
+    return file_hash.hexdigest()
+
+
+def _stat(file_path):
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime
+
+
+class Manifest(object):
+
+    def __init__(self, root, role, state_dir=None, workers=None, save_interval=5):
+        """
+        root: Sync dir the relative paths are resolved against.
+        role: Name distinguishing manifests of the same dir, e.g. 'observer'.
+        """
+        self.root = os.path.abspath(root)
+        state_dir = state_dir or conf.STATE_DIR
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        root_id = hashlib.sha1(self.root.encode('utf-8')).hexdigest()[:16]
+        self.state_path = os.path.join(state_dir, 'manifest-{}-{}.json'.format(root_id, role))
+        self.save_interval = save_interval
+
+        self._lock = threading.Lock()
+        self._entries = {}  # rel_path -> [size, mtime, hash]
+        self._by_hash = {}  # hash -> set of the rel_paths of the entries with it
+        self._children = {}  # rel_path of a dir ('' for the root) -> rel_paths of the entries and dirs with entries in it
+        self._in_progress = {}  # rel_path -> threading.Event set once its hash job is done
+        self._dirty = False
+        self._jobs = Queue.Queue()
+        self.load()
+
+        for i in range(workers or conf.HASH_WORKERS):
+            worker = threading.Thread(target=self._work, name='manifest-hasher-{}'.format(i))
+            worker.daemon = True
+            worker.start()
+        saver = threading.Thread(target=self._save_periodically, name='manifest-saver')
+        saver.daemon = True
+        saver.start()
+
+    def _full_path(self, rel_path):
+        return self.root + rel_path
+
+    def load(self):
+        try:
+            with open(self.state_path) as f:
+                self._entries = json.load(f)
+        except (IOError, ValueError):
+            self._entries = {}
+        self._by_hash = {}
+        self._children = {}
+        for rel_path, entry in self._entries.items():
+            self._by_hash.setdefault(entry[2], set()).add(rel_path)
+            self._link(rel_path)
+
+    def _link(self, rel_path):
+        """Add a new entry to the index of its dir, and so on up; the lock has to be held."""
+        while rel_path:
+            parent = rel_path.rsplit('/', 1)[0]
+            children = self._children.setdefault(parent, set())
+            had_children = bool(children)
+            children.add(rel_path)
+            if had_children:
+                return  # Linked up already
+            rel_path = parent
+
+    def _unlink(self, rel_path):
+        """Drop a path gone from the index of its dir, and so on up; the lock has to be held."""
+        while rel_path and rel_path not in self._entries and rel_path not in self._children:
+            parent = rel_path.rsplit('/', 1)[0]
+            children = self._children.get(parent)
+            if children is None:
+                return
+            children.discard(rel_path)
+            if children:
+                return
+            del self._children[parent]
+            rel_path = parent
+
+    def _under(self, rel_path):
+        """Paths of the entry of rel_path and of those under it, as a dir; the lock has to be held."""
+        paths = [rel_path] if rel_path in self._entries else []
+        dirs = [rel_path]
+        while dirs:
+            for child in self._children.get(dirs.pop(), ()):
+                if child in self._entries:
+                    paths.append(child)
+                if child in self._children:
+                    dirs.append(child)
+        return paths
+
+    def _set(self, rel_path, entry):
+        """Record an entry; the lock has to be held."""
+        self._pop(rel_path)
+        self._entries[rel_path] = entry
+        self._by_hash.setdefault(entry[2], set()).add(rel_path)
+        self._link(rel_path)
+        self._dirty = True
+
+    def _pop(self, rel_path):
+        """Forget and return the entry of a path, if any; the lock has to be held."""
+        entry = self._entries.pop(rel_path, None)
+        if entry is not None:
+            paths = self._by_hash[entry[2]]
+            paths.discard(rel_path)
+            if not paths:
+                del self._by_hash[entry[2]]
+            self._unlink(rel_path)
+            self._dirty = True
+        return entry
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps(self._entries)
+            self._dirty = False
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.rename(tmp_path, self.state_path)
+
+    def _save_periodically(self):
+        while True:
+            time.sleep(self.save_interval)
+            try:
+                self.save()
+            except EnvironmentError as e:
+                logger.error("MANIFEST: Couldn't save %s: %s", self.state_path, e)
+
+    def _is_current(self, entry, stat):
+        return entry is not None and stat is not None and (entry[0], entry[1]) == stat
+
+    def _hash(self, rel_path):
+        """Hash the file and record it. Returns its entry, or None if it's gone."""
+        full_path = self._full_path(rel_path)
+        for _ in range(HASH_ATTEMPTS):
+            stat = _stat(full_path)
+            if stat is None:
+                return None
+            try:
+                file_hash = hash_file(full_path)
+            except EnvironmentError:
+                return None
+            if _stat(full_path) == stat:
+                entry = [stat[0], stat[1], file_hash]
+                with self._lock:
+                    self._set(rel_path, entry)
+                return entry
+        logger.warning("MANIFEST: %s keeps changing, not hashed", rel_path)
+        return None
+
+    def _work(self):
+        while True:
+            rel_path = self._jobs.get()
+            try:
+                self._hash(rel_path)
+            except Exception as e:
+                logger.exception("MANIFEST: hashing %s failed: %s", rel_path, e)
+            finally:
+                with self._lock:
+                    done = self._in_progress.pop(rel_path)
+                done.set()
+
+    def refresh(self, rel_path):
+        """
+        Schedule (re)hashing of a file in the background, unless its size
+        and mtime still match the recorded entry.
+        """
+        stat = _stat(self._full_path(rel_path))
+        if stat is None:
+            return
+        with self._lock:
+            if self._is_current(self._entries.get(rel_path), stat) or rel_path in self._in_progress:
+                return
+            self._in_progress[rel_path] = threading.Event()
+        self._jobs.put(rel_path)
+
+    def get(self, rel_path):
+        """
+        Return the up to date [size, mtime, hash] of a file, hashing it
+        (or waiting for its pending hash job) if needed. None if it's gone.
+        """
+        while True:
+            stat = _stat(self._full_path(rel_path))
+            if stat is None:
+                return None
+            with self._lock:
+                entry = self._entries.get(rel_path)
+                if self._is_current(entry, stat):
+                    return entry
+                pending = self._in_progress.get(rel_path)
+            if pending is None:
+                return self._hash(rel_path)
+            pending.wait()
+
+    def peek(self, rel_path, size, mtime):
+        """Recorded hash of a file if it's still current for the given size and mtime, without hashing."""
+        with self._lock:
+            entry = self._entries.get(rel_path)
+        return entry[2] if self._is_current(entry, (size, mtime)) else None
+
+    def current_hash(self, rel_path):
+        """Recorded hash of a file if it's still current, without hashing."""
+        stat = _stat(self._full_path(rel_path))
+        with self._lock:
+            entry = self._entries.get(rel_path)
+        return entry[2] if self._is_current(entry, stat) else None
+
+    def file_hash(self, rel_path):
+        entry = self.get(rel_path)
+        return entry[2] if entry else None
+
+    def find(self, file_hash):
+        """
+        Path of a file whose recorded hash is file_hash and still current,
+        if any, without hashing. Stale files are scheduled to be rehashed.
+        """
+        with self._lock:
+            paths = sorted(self._by_hash.get(file_hash, ()))
+        for rel_path in paths:
+            if self.current_hash(rel_path) == file_hash:
+                return rel_path
+            self.refresh(rel_path)
+        return None
+
+    def record(self, rel_path, file_hash):
+        """Record the hash of a file known to have that content, e.g. a copy of another file."""
+        stat = _stat(self._full_path(rel_path))
+        if stat is None:
+            return
+        with self._lock:
+            self._set(rel_path, [stat[0], stat[1], file_hash])
+
+    def remove(self, rel_path):
+        """Forget a file, or everything under a directory."""
+        with self._lock:
+            for path in self._under(rel_path):
+                self._pop(path)
+
+    def move(self, src_path, dest_path):
+        """Carry the entries of a moved file, or of everything under a moved directory."""
+        with self._lock:
+            for path in self._under(src_path):
+                self._set(dest_path + path[len(src_path):], self._pop(path))
@@ -0,0 +1,220 @@
+"""
+Cross-process counters, gauges and latency histograms of the hot paths.
+
+The observer and web server processes both update the same metrics, which
+the web server serves on conf.METRICS_PATH, in the Prometheus text format
+or, with `?format=json`, as JSON.
+
+Every metric is declared below, at import time, and all their values live
+in one shared array of doubles. The main process allocates it before
+starting the others, and hands it to them to attach to, as the module
+global of a spawned (rather than forked) process would be an array of its
+own. Updating a metric is an add to a slot of that array under a lock,
+with no strings involved; all the formatting happens when the metrics are
+served.
+"""
+import bisect
+import json
+import multiprocessing
+
+import conf
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+THROUGHPUT_BUCKETS = (1e4, 1e5, 1e6, 1e7, 1e8, 1e9)  # bytes per second
+
+_METRICS = []
+_size = 0
+
+
+class _Metric(object):
+    kind = None
+    slots = 1
+
+    def __init__(self, name, help):
+        global _size
+        self.name = name
+        self.help = help
+        self.offset = _size
+        _size += self.slots
+        _METRICS.append(self)
+
+    def _samples(self, values):
+        """(suffix, labels, value) of what's exported."""
+        return [('', '', values[self.offset])]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1):
+        values, lock = _shared or allocate()
+        with lock:
+            values[self.offset] += amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1):
+        values, lock = _shared or allocate()
+        with lock:
+            values[self.offset] += amount
+
+    def dec(self, amount=1):
+        values, lock = _shared or allocate()
+        with lock:
+            values[self.offset] -= amount
+
+    def set(self, value):
+        values, _ = _shared or allocate()
+        values[self.offset] = value
+
+
+class Histogram(_Metric):
+    """Counts of observations per bucket (not cumulative; that's done on export), their sum and count."""
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.slots = len(self.buckets) + 3  # Buckets, +Inf, sum, count
+        super(Histogram, self).__init__(name, help)
+
+    def observe(self, value):
+        slot = self.offset + bisect.bisect_left(self.buckets, value)
+        total = self.offset + len(self.buckets) + 1
+        values, lock = _shared or allocate()
+        with lock:
+            values[slot] += 1
+            values[total] += value
+            values[total + 1] += 1
+
+    def _samples(self, values):
+        samples = []
+        cumulative = 0
+        for position, bound in enumerate(self.buckets + (float('inf'),)):
+            cumulative += values[self.offset + position]
+            samples.append(('_bucket', '{{le="{}"}}'.format('+Inf' if position == len(self.buckets) else bound),
+                            cumulative))
+        total = self.offset + len(self.buckets) + 1
+        samples.append(('_sum', '', values[total]))
+        samples.append(('_count', '', values[total + 1]))
+        return samples
+
+
+# Observer
+EVENTS = Counter('simplesync_events_total', 'Filesystem events of synced types seen by the observer.')
+EVENTS_SUPPRESSED = Counter('simplesync_events_suppressed_total',
+                            'Events skipped as caused by applying a change received from a peer.')
+EVENTS_DEDUPED = Counter('simplesync_events_deduped_total',
+                         'Events skipped as repeats of one seen within the dedupe window, '
+                         'or as implied by a directory move.')
+EVENTS_IGNORED = Counter('simplesync_events_ignored_total', 'Events skipped as only of ignored paths.')
+WATCH_LIMIT_HITS = Counter('simplesync_watch_limit_hits_total',
+                           'Times the native watch limit was reached, or the tree needed more watches.')
+POLLING_FALLBACKS = Counter('simplesync_polling_fallbacks_total',
+                            'Subtrees polled instead of watched natively.')
+QUEUE_OVERFLOWS = Counter('simplesync_event_queue_overflows_total', 'Overflows of a native event queue.')
+RESCANS = Counter('simplesync_rescans_total', 'Rescans of a subtree for the changes its native watch missed.')
+RESCANNED_CHANGES = Counter('simplesync_rescanned_changes_total', 'Changes found by rescans.')
+NOTIFY_LATENCY = Histogram('simplesync_notify_latency_seconds',
+                           'Seconds from a filesystem event to a peer accepting its notification.')
+NOTIFICATIONS = Counter('simplesync_notifications_total', 'REQSYNC notifications accepted by peers.')
+NOTIFY_RETRIES = Counter('simplesync_notify_retries_total', 'Failed REQSYNC attempts.')
+NOTIFY_BACKLOG = Gauge('simplesync_notify_backlog', 'Changes waiting to be notified, summed over peers.')
+
+# Web server
+REQSYNC_SECONDS = Histogram('simplesync_reqsync_seconds', 'Seconds taken handling a received REQSYNC.')
+REQSYNC_REFUSED = Counter('simplesync_reqsync_refused_total', 'REQSYNCs refused as the fetch queue was full.')
+FETCH_QUEUE_DEPTH = Gauge('simplesync_fetch_queue_depth', 'Received changes waiting to be applied.')
+TRANSFERS_IN_FLIGHT = Gauge('simplesync_transfers_in_flight', 'Downloads in progress.')
+DOWNLOAD_SECONDS = Histogram('simplesync_download_seconds', 'Seconds taken by successful downloads.')
+DOWNLOAD_THROUGHPUT = Histogram('simplesync_download_bytes_per_second',
+                                'Bytes per second received by successful downloads.', THROUGHPUT_BUCKETS)
+DOWNLOAD_BYTES = Counter('simplesync_download_bytes_total', 'Bytes received by successful downloads.')
+LOCAL_COPIES = Counter('simplesync_local_copies_total',
+                      'Received files copied from a local file with the same content instead of fetched.')
+PAIRED_MOVES = Counter('simplesync_paired_moves_total',
+                       'Received deletes and creates of the same content applied as a move.')
+BUNDLES = Counter('simplesync_bundles_total', 'Successful REQBUNDLE downloads of several small files at once.')
+PUSHES = Counter('simplesync_pushes_total', 'Notifications sent with the content of changed files, as REQPUSH.')
+PUSHED_FILES = Counter('simplesync_pushed_files_total',
+                       'Received files installed from the content pushed along with their notification.')
+PUSHED_BYTES = Counter('simplesync_pushed_bytes_total', 'Bytes of the received files installed that way.')
+THROTTLED_SECONDS = Counter('simplesync_throttled_seconds_total',
+                            'Seconds fetches waited for the bandwidth and disk write limits.')
+DOWNLOAD_FAILURES = Counter('simplesync_download_failures_total', 'Failed downloads.')
+
+_shared = None  # (values, lock), once allocated or attached to
+
+
+def allocate():
+    """
+    Allocate the values of the metrics, if this process hasn't yet; returns
+    them, with their lock, to pass to the processes it starts.
+    """
+    global _shared
+    if _shared is None:
+        _shared = multiprocessing.RawArray('d', _size), multiprocessing.Lock()
+    return _shared
+
+
+def attach(shared):
+    """Update the values allocated by the main process, as returned by allocate(), from this one."""
+    global _shared
+    _shared = shared
+
+
+def record_download(seconds, received):
+    """Record a successful download of `received` bytes."""
+    DOWNLOAD_SECONDS.observe(seconds)
+    DOWNLOAD_BYTES.inc(received)
+    if seconds > 0:
+        DOWNLOAD_THROUGHPUT.observe(received / float(seconds))
+
+
+def _snapshot():
+    values, lock = _shared or allocate()
+    with lock:
+        return values[:]
+
+
+def _number(value):
+    return int(value) if value == int(value) else value
+
+
+def prometheus_text():
+    values = _snapshot()
+    lines = []
+    for metric in _METRICS:
+        lines.append('# HELP {} {}'.format(metric.name, metric.help))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+        for suffix, labels, value in metric._samples(values):
+            lines.append('{}{}{} {}'.format(metric.name, suffix, labels, _number(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def response_for(url_path):
+    """(content type, body) to respond to a GET of url_path with, if it's the metrics path."""
+    path, _, query = url_path.partition('?')
+    if not conf.METRICS_PATH or path != conf.METRICS_PATH:
+        return None
+    if 'format=json' in query.split('&'):
+        return 'application/json', as_json().encode('utf-8')
+    return 'text/plain; version=0.0.4', prometheus_text().encode('utf-8')
+
+
+def as_json():
+    values = _snapshot()
+    data = {}
+    for metric in _METRICS:
+        if isinstance(metric, Histogram):
+            samples = metric._samples(values)
+            data[metric.name] = {
+                'buckets': [[bound, _number(count)] for bound, (_, _, count) in
+                            zip(list(metric.buckets) + ['+Inf'], samples)],
+                'sum': values[metric.offset + len(metric.buckets) + 1],
+                'count': _number(samples[-1][2]),
+            }
+        else:
+            data[metric.name] = _number(values[metric.offset])
+    return json.dumps(data, sort_keys=True)
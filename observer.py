@@ -1,13 +1,29 @@
 import datetime
+import logging
+import os
 import sys
 import threading
 import time
 
-from watchdog.observers import Observer
+from expiringdict import ExpiringDict
 from watchdog.events import FileSystemEventHandler
 from watchdog import events
 
-from utils import logger
+import conf
+import metrics
+import startup
+import suppression
+import watchers
+from batcher import FETCH_TYPE_EVENTS, EventBatcher
+from manifest import Manifest
+from utils import ExpiringTimestamps, is_temp_path, logger
+
+SYNCED_EVENT_TYPES = (
+    events.EVENT_TYPE_CREATED,
+    events.EVENT_TYPE_MODIFIED,
+    events.EVENT_TYPE_DELETED,
+    events.EVENT_TYPE_MOVED,
+)
 
 
 class FSChangesHandler(FileSystemEventHandler):
@@ -17,65 +33,249 @@ class FSChangesHandler(FileSystemEventHandler):
     """
 
     def __init__(self, *args, **kwargs):
-        self.ip_queue = kwargs.pop('ip_queue', None)
         self.notify = kwargs.pop('notify', False)
         self.syncer = kwargs.pop('syncer', None)
         self.accountant = kwargs.pop('accountant', False)
-        self.skip = {}  # events with same timestamp and file path
-        # will be skipped if already in this
+        # events with same type and file path(s) will be skipped
+        # if already seen in the last DEDUPE_WINDOW seconds
+        self.skip = ExpiringTimestamps(max_len=conf.DEDUPE_MAX_ENTRIES, max_age=conf.DEDUPE_WINDOW)
+        # Dirs recently moved, src -> dest; the moves of their contents are implied
+        self.dir_moves = ExpiringDict(max_len=1000, max_age_seconds=conf.DEDUPE_WINDOW)
+        self.batcher = None
+        self._manifest = None
+        self._manifest_lock = threading.Lock()
+        self._dispatch_lock = threading.Lock()
+        # src_path -> when the first event of its pending change was received
+        self.received_at = {}
+        # src_path -> content hash fingerprint it was just synced with, for
+        # changes whose suppression is decided once hashed, see _is_just_synced
+        self.synced_hashes = {}
+        if self.notify:
+            # Events are coalesced and sent to remote in batches
+            self.batcher = EventBatcher(
+                self._send_batch,
+                quiet_window=kwargs.pop('batch_quiet_window', conf.BATCH_QUIET_WINDOW),
+                max_delay=kwargs.pop('batch_max_delay', conf.BATCH_MAX_DELAY),
+                max_size=kwargs.pop('batch_max_size', conf.BATCH_MAX_SIZE),
+            )
         super(FSChangesHandler, self).__init__(*args, **kwargs)
 
-    def _is_just_synced(self, event, current_time):
+    @property
+    def manifest(self):
         """
-        just_synced: {"dir/file_or_dir": 14404440}
-                     Dict of event event.src_path and expiry-timestamp
-                     If current time is less than expiry time stamp (set in future)
-                     then skip firing the event.
+        Content hashes of changed files, kept up to date in the background
+        and sent along with their notifications. Loaded on first use, which
+        start_watching makes right after the watch is set up, as loading
+        the saved one takes a while on large trees.
+        """
+        if self._manifest is None and self.notify:
+            with self._manifest_lock:
+                if self._manifest is None:
+                    self._manifest = Manifest(self.syncer.local_sync_dir, 'observer')
+        return self._manifest
+
+    def _is_just_synced(self, event, current_time):
         """
-        logger.info("In _is_just_synced; IPQ-empty: {}, event: {}, current_time:{}".format(
-            self.ip_queue.empty(), event.key, current_time))
-        just_synced = self.ip_queue.get(timeout=1) if not self.ip_queue.empty() else None
-        logger.info("just_synced: {}".format(just_synced))
+        Whether the event was caused by the syncer applying a change received
+        from remote, see suppression.py. Paths marked along with a content hash
+        are only skipped while the file still has that content, so a local
+        edit made right after a sync still gets through.
 
+        Files aren't hashed here, on the dispatch thread: if the manifest has
+        no current hash of the file, which it usually hasn't right after a
+        sync, the event goes through, and its change is dropped in _send_batch
+        if the file turns out to have the synced content once it's hashed.
+        """
+        if self.syncer is None:
+            return False
         event_src_path = event.src_path.replace(self.syncer.local_sync_dir, '')
-        # If timestamp of the latest entry of the file in observer's
-        # just_synced is more than current time skip it
-        if just_synced and (event_src_path in just_synced) and (current_time < just_synced[event_src_path]):
+        self.synced_hashes.pop(event_src_path, None)
+        marked_hash = self.syncer.suppression.lookup(event_src_path)
+        if marked_hash is None and event.event_type in (events.EVENT_TYPE_DELETED, events.EVENT_TYPE_MOVED):
+            # Deletes and moves of contents of a dir just deleted or moved by the syncer
+            marked_hash = self._marked_ancestor(event_src_path)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("just_synced: %s; event: %s, current_time:%s",
+                         marked_hash is not None, event.key, current_time)
+        if marked_hash is None:
+            return False
+        if (marked_hash == suppression.NO_HASH or event.is_directory or
+                event.event_type not in FETCH_TYPE_EVENTS):
             return True
+        if self.manifest is None:
+            return False
+        current_hash = self.manifest.current_hash(event_src_path)
+        if current_hash is None:
+            self.synced_hashes[event_src_path] = marked_hash
+            return False
+        return suppression.hash_fingerprint(current_hash) == marked_hash
+
+    def _marked_ancestor(self, rel_path):
+        """Suppression mark of the closest marked dir containing rel_path, if any."""
+        while True:
+            rel_path = rel_path.rsplit('/', 1)[0]
+            if not rel_path:
+                return None
+            marked_hash = self.syncer.suppression.lookup(rel_path)
+            if marked_hash is not None:
+                return marked_hash
+
+    def _moved_with_dir(self, event):
+        """
+        Whether the event is the move of something inside a dir whose move
+        was just seen; the watcher reports those after the dir's own move,
+        but the dir's move covers them. Remembers the dir moves it sees.
+        """
+        if event.event_type != events.EVENT_TYPE_MOVED:
+            return False
+        src_path = event.src_path
+        while True:
+            src_path = os.path.dirname(src_path)
+            if not src_path or src_path == os.path.dirname(src_path):
+                break
+            dest_dir = self.dir_moves.get(src_path)
+            if dest_dir is not None and event.dest_path == dest_dir + event.src_path[len(src_path):]:
+                return True
+        if event.is_directory:
+            self.dir_moves[event.src_path] = event.dest_path
         return False
 
+    def _unignored(self, event):
+        """
+        The event, short of the paths ignored (see ignore.py): None if they
+        all are, the creation of its dest if a move is out of an ignored
+        path, and the deletion of its src if a move is into one.
+        """
+        if self.syncer is None:
+            return event
+        rules = self.syncer.ignore
+        if not rules:
+            return event
+        sync_dir = self.syncer.local_sync_dir
+        src_ignored = rules.match(event.src_path.replace(sync_dir, ''), event.is_directory)
+        if event.event_type != events.EVENT_TYPE_MOVED:
+            return None if src_ignored else event
+        dest_ignored = rules.match(event.dest_path.replace(sync_dir, ''), event.is_directory)
+        if src_ignored and dest_ignored:
+            return None
+        elif src_ignored:
+            # Its contents are reported as moved out of the ignored path as well
+            return (events.DirCreatedEvent if event.is_directory else events.FileCreatedEvent)(event.dest_path)
+        elif dest_ignored:
+            if event.is_directory:
+                # Its contents' moves are covered by the deletion
+                self.dir_moves[event.src_path] = event.dest_path
+            return (events.DirDeletedEvent if event.is_directory else events.FileDeletedEvent)(event.src_path)
+        return event
+
+    def _update_manifest(self, data):
+        if data['change_type'] == events.EVENT_TYPE_DELETED:
+            self.manifest.remove(data['src_path'])
+        elif data['change_type'] == events.EVENT_TYPE_MOVED:
+            self.manifest.move(data['src_path'], data['dest_path'])
+        elif not data['is_dir']:
+            self.manifest.refresh(data['src_path'])
+
+    def _send_batch(self, changes):
+        """
+        Add the size and content hash of fetchable files, and notify remote
+        of those not just synced from it after all (see _is_just_synced).
+        """
+        now = time.time()
+        received_at = [self.received_at.pop(change['src_path'], now) for change in changes]
+        if len(self.received_at) > conf.DEDUPE_MAX_ENTRIES:
+            # Left behind by changes the batcher dropped
+            self.received_at.clear()
+        if len(self.synced_hashes) > conf.DEDUPE_MAX_ENTRIES:
+            self.synced_hashes.clear()
+        notified, notified_received_at = [], []
+        for change, change_received_at in zip(changes, received_at):
+            if change['change_type'] in FETCH_TYPE_EVENTS and not change['is_dir']:
+                synced_hash = self.synced_hashes.pop(change['src_path'], None)
+                entry = self.manifest.get(change['src_path'])
+                if entry:
+                    if synced_hash is not None and suppression.hash_fingerprint(entry[2]) == synced_hash:
+                        metrics.EVENTS_SUPPRESSED.inc()
+                        continue
+                    change['size'], change['file_hash'] = entry[0], entry[2]
+            notified.append(change)
+            notified_received_at.append(change_received_at)
+        if notified:
+            self.syncer.notify_remotes(notified, notified_received_at)
+
     def push_event(self, data):
-        # Call syncer to push this event's notification to remote
-        new_push_thread = threading.Thread(target=self.syncer.notify_remotes, args=(data, ))
-        new_push_thread.start()
-        new_push_thread.join()
-
-        # Record this event in local DB for syn-ack
-        # new_accountant_thread = threading.Thread(target=self.accountant.add_push_event, args=(data, ))
-        # new_accountant_thread.start()
-
-    def _dupe_event(self, event, cur_time):
-        # Skip if not more than 5s ago the latest event on same file/dir was fired
-        if (event.src_path in self.skip and self.skip[event.src_path][-1] >= cur_time - 5):
-            return True
-        return False
+        # Queue this event; the batcher calls syncer to push the
+        # notification of all pending events to remote in one go.
+        self.batcher.push(data)
+        # The syncer journals the batch with the accountant before notifying
+        # peers, so that it survives a crash until they've acknowledged it.
+
+    def _dupe_event(self, event, cur_time, version):
+        # Skip if not more than DEDUPE_WINDOW seconds ago the same event
+        # on the same file/dir was fired, and for a file created or
+        # modified, it still has the same mtime and size
+        return self.skip.seen_within(event.key, cur_time, conf.DEDUPE_WINDOW, version)
+
+    @staticmethod
+    def _version(event):
+        """
+        (mtime, size) of the file a created or modified event is of, telling
+        a repeat of the event from another change; None for other events.
+        """
+        if event.is_directory or event.event_type not in FETCH_TYPE_EVENTS:
+            return None
+        try:
+            stat = os.stat(event.src_path)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+    def dispatch(self, event):
+        # Events come from the threads of several observers, and from rescans
+        with self._dispatch_lock:
+            super(FSChangesHandler, self).dispatch(event)
 
     def on_any_event(self, event):
+        startup.mark_once('first event')
         cur_time = int(time.time())
 
-        if self._dupe_event(event, cur_time):
+        if event.event_type not in SYNCED_EVENT_TYPES:
+            # e.g. the `closed` events of newer watchdog versions
+            return
+        metrics.EVENTS.inc()
+
+        if is_temp_path(event.src_path):
+            if event.event_type != events.EVENT_TYPE_MOVED or is_temp_path(event.dest_path):
+                # Partial transfer in progress
+                return
+            # A completed transfer renamed into place is a change of its final path
+            event = events.FileModifiedEvent(event.dest_path)
+
+        # Watchdog can't leave subtrees out of a recursive watch, so ignored
+        # paths are dropped here, before any other work is done on them
+        event = self._unignored(event)
+        if event is None:
+            metrics.EVENTS_IGNORED.inc()
+            return
+
+        if self._moved_with_dir(event):
+            metrics.EVENTS_DEDUPED.inc()
+            return
+
+        version = self._version(event)
+        if self._dupe_event(event, cur_time, version):
+            metrics.EVENTS_DEDUPED.inc()
             return
         elif event.is_directory and event.event_type == events.EVENT_TYPE_MODIFIED:
             return
         else:
             if self._is_just_synced(event, cur_time):
+                metrics.EVENTS_SUPPRESSED.inc()
                 return
-            else:
-                src_path = event.dest_path if event.event_type == events.EVENT_TYPE_MOVED else event.src_path
-                if src_path in self.skip:
-                    self.skip[src_path].append(cur_time)
-                else:
-                    self.skip[src_path] = [cur_time]
+            elif not (self.synced_hashes and
+                      event.src_path.replace(self.syncer.local_sync_dir, '') in self.synced_hashes):
+                # Those possibly just synced aren't deduped, as those suppressed aren't
+                self.skip.touch(event.key, cur_time, version)
         if self.notify:
             src_path = event.src_path.replace(self.syncer.local_sync_dir, '')
             dest_path = getattr(event, 'dest_path', '').replace(self.syncer.local_sync_dir, '')
@@ -85,55 +285,60 @@ class FSChangesHandler(FileSystemEventHandler):
                 'dest_path': dest_path,
                 'is_dir': event.is_directory,
                 'time': cur_time,
-                # 'file_hash': '',
+                # 'size' and 'file_hash' are added when the batch is sent
             }
             # print "Event: {}".format(event.key)
+            self._update_manifest(event_detail)
+            self.received_at.setdefault(src_path, time.time())
             self.push_event(event_detail)
-            logger.info("OBSERVER: Pushed event: {}".format(event_detail))
+            logger.debug("OBSERVER: Queued event: %s", event_detail)
         else:
-            print "Event: {}".format(event.key)
+            print("Event: {}".format(event.key))
 
-    def del_old_skip_keys(self):
-        pass
-        # delete old keys so that self.skip doesn't bloat up
-        # for key in self.skip:
-        #     if cur_time - key > 60:
-        #         self.skip.pop(key)
 
-
-def watch_filesystem(ip_queue=None, watch_dir='', notify=False, recursive=False, syncer=None,
-                     accountant=None, daemon=False):
+def start_watching(watch_dir='', notify=False, recursive=False, syncer=None,
+                   accountant=None, daemon=False):
     """
-    Start off a watchdog oberver thread to watch filesystem event
-    changes. Also take actions accordingly.
+    Start off watchdog observer threads to watch filesystem event
+    changes, and take actions accordingly. Returns the started Watchers,
+    which pick the observers needed (see watchers.py).
 
     watch_dir: Directory to watch
     notify: Whether or not any action should be taken if an event occurs.
     """
     event_handler = FSChangesHandler(
-        ip_queue=ip_queue,
         notify=notify,
         syncer=syncer,
         accountant=accountant
     )
-    observer = Observer()
-    observer.schedule(event_handler, path=watch_dir, recursive=recursive)
-
+    observers = watchers.Watchers(event_handler, watch_dir, recursive=recursive, daemon=daemon,
+                                  ignore=(lambda: syncer.ignore) if syncer else None)
     # If run from simplesync, this will be inside the observer_process process
-    observer.daemon = daemon
-    observer.start()
+    observers.start()
+    startup.mark('watching')
     print("\n>> Started observer\n>> Watching dir: {}".format(watch_dir))
+    if notify:
+        # Events are queued by watchdog meanwhile. Peers are notified right
+        # away, replaying whatever they hadn't acknowledged before the start.
+        event_handler.manifest
+        syncer.fanout
+        startup.mark('notifying')
+    return observers
+
+
+def watch_filesystem(*args, **kwargs):
+    """Watch with start_watching, until interrupted."""
+    observers = start_watching(*args, **kwargs)
     try:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
-        observer.stop()
+        observers.stop()
     # observer.join()
 
-
 if __name__ == "__main__":
     watch_dir = '.'
     if len(sys.argv) > 1:
         watch_dir = sys.argv[1]
-    logger.info("Watching: {}".format(watch_dir))
+    logger.info("Watching: %s", watch_dir)
     watch_filesystem(watch_dir)
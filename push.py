@@ -0,0 +1,136 @@
+"""
+Notifications carrying the content of the changed files, for REQPUSH.
+
+Pulling a changed file takes a request of its own once the notification
+is in (or a REQBUNDLE for a batch of small ones), and needs the receiving
+side to reach the notifying side's web server. With conf.PUSH_MODE, the
+notifier sends the content of small changed files inline instead, after
+the notification, on the same keep-alive connection; the receiver writes
+them straight to temp files which its fetch workers then install in place
+of fetching them.
+
+It's negotiated per peer: a peer tells how many bytes of files it takes
+pushed in a notification in the PUSH_HEADER of its responses, and is only
+pushed to once it did; one answering a REQPUSH with 501 is notified with
+REQSYNC from then on. Whatever isn't pushed, like large files or files
+changed again since they were notified, is pulled as usual.
+
+Wire format of a REQPUSH body:
+    >I header length + header + frames
+where the header is the JSON a REQSYNC would have as its body, and the
+frames are those of a bundle (see bundle.py), one per pushed file.
+"""
+import hashlib
+import itertools
+import json
+import os
+import struct
+
+from watchdog import events
+
+import bundle
+import conf
+import throttle
+from utils import temp_path_for
+
+HEADER_LENGTH = struct.Struct('>I')
+PUSH_HEADER = 'X-Simplesync-Push'
+
+_staged = itertools.count()
+
+
+def accepted_size(headers):
+    """Bytes of files a peer takes pushed, per the headers of its response; 0 if it doesn't."""
+    try:
+        return int(headers.get(PUSH_HEADER) or 0)
+    except ValueError:
+        return 0
+
+
+def files_to_push(changes, local_path_for, max_size):
+    """
+    (path, content) of the files to push along with `changes`: the created
+    or modified ones of at most conf.PUSH_MAX_FILE_SIZE bytes, as long as
+    they still have the content hash they were last notified with, up to
+    max_size bytes in all.
+
+    local_path_for: Callable giving the local file of a notified path.
+    """
+    files = []
+    seen = set()
+    total = 0
+    for change in reversed(changes):
+        path = change['src_path']
+        if (change['change_type'] not in (events.EVENT_TYPE_CREATED, events.EVENT_TYPE_MODIFIED) or
+                change['is_dir'] or path in seen):
+            continue
+        seen.add(path)
+        size = change.get('size')
+        if not change.get('file_hash') or size is None or size > conf.PUSH_MAX_FILE_SIZE or total + size > max_size:
+            continue
+        content = bundle.read_file(local_path_for(path), conf.PUSH_MAX_FILE_SIZE)
+        if content is None or hashlib.sha1(content).hexdigest() != change['file_hash']:
+            continue  # Gone, or changed again; its next notification covers it
+        files.append((path, content))
+        total += len(content)
+    files.reverse()
+    return files
+
+
+def encode(header, files):
+    """Body of a REQPUSH: the JSON encoded notification `header`, then the frames of `files`."""
+    parts = [HEADER_LENGTH.pack(len(header)), header]
+    parts.extend(bundle.encode_frame(path, content) for path, content in files)
+    parts.append(bundle.end_frame())
+    return b''.join(parts)
+
+
+def limited(read, length):
+    """read(size) through `read`, returning b'' once `length` bytes were read."""
+    state = {'left': length}
+
+    def read_limited(size):
+        data = read(min(size, state['left'])) if state['left'] > 0 else b''
+        state['left'] -= len(data)
+        return data
+
+    return read_limited
+
+
+def decode(read):
+    """
+    (notification, frames) of a REQPUSH body read through `read`. The
+    frames are generated as (path, content), as bundle.read_frames does.
+    """
+    length, = HEADER_LENGTH.unpack(bundle.read_exact(read, HEADER_LENGTH.size))
+    return json.loads(bundle.read_exact(read, length).decode('utf-8')), bundle.read_frames(read)
+
+
+def stage(root, content, limiter=throttle.UNLIMITED):
+    """
+    Write pushed content to a new temp file at the top of the sync dir
+    `root`, which is always there, unlike the dir of the file it's for.
+    Returns the temp file's path.
+    """
+    tmp_path = temp_path_for(os.path.join(root, 'push-{}-{}'.format(os.getpid(), next(_staged))))
+    limiter.write(len(content))
+    with open(tmp_path, 'wb') as tmp_file:
+        tmp_file.write(content)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    return tmp_path
+
+
+def install(tmp_path, file_path):
+    """Atomically move a staged temp file into place."""
+    dir_path = os.path.dirname(file_path)
+    if dir_path and not os.path.isdir(dir_path):
+        os.makedirs(dir_path)
+    getattr(os, 'replace', os.rename)(tmp_path, file_path)
+
+
+def discard(tmp_path):
+    try:
+        os.remove(tmp_path)
+    except OSError:
+        pass
@@ -0,0 +1,242 @@
+"""
+Startup reconciliation of a sync dir with its peer.
+
+Both machines list their whole tree in the same sorted order (a depth
+first walk with the entries of each directory sorted by name), the
+receiving side streams the listing of its peer, and merge-diffs it with
+its own listing as both are being generated. Only files and dirs missing
+or stale locally are queued for the fetch workers, so neither tree is
+ever held in memory as a whole.
+
+Directories are listed with os.scandir by a pool of threads, which read
+ahead the sub directories the walk is about to descend into.
+"""
+import json
+import os
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    # Python 2
+    from scandir import scandir
+
+from watchdog import events
+
+import conf
+from fetcher import QueueFull
+from utils import is_temp_path, logger
+
+# Remote files are only considered stale if their mtime is newer than the
+# local one by more than this many seconds
+MTIME_TOLERANCE = 1
+QUEUE_BATCH_SIZE = 100
+
+
+def _text(path):
+    if isinstance(path, bytes):
+        return path.decode(sys.getfilesystemencoding() or 'utf-8')
+    return path
+
+
+def _scan(dir_path):
+    """Sorted [(name, is_dir, size, mtime)] of the files and dirs in dir_path."""
+    entries = []
+    try:
+        for entry in scandir(dir_path):
+            if is_temp_path(entry.name):
+                continue
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if not (is_dir or entry.is_file(follow_symlinks=False)):
+                    continue
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue  # Gone in the meantime
+            entries.append((entry.name, is_dir, 0 if is_dir else st.st_size, st.st_mtime))
+    except OSError as e:
+        logger.warning("RECONCILE: Couldn't list %s: %s", dir_path, e)
+    entries.sort()
+    return entries
+
+
+def sort_key(rel_path):
+    """Order in which walk_sorted yields paths."""
+    return rel_path.split('/')
+
+
+def walk_sorted(root, workers=None, read_ahead=None, ignore=None):
+    """
+    Generate (rel_path, is_dir, size, mtime) for everything under root,
+    depth first with the entries of each dir sorted by name. rel_path is
+    relative to root, with a leading '/'.
+
+    ignore: Rules of the paths to leave out (see ignore.py); ignored dirs
+    aren't even listed.
+    """
+    root = _text(os.path.abspath(root))
+    workers = workers or conf.SCAN_WORKERS
+    read_ahead = read_ahead or workers * 4
+    pool = ThreadPool(workers)
+    scans = {}  # rel dir path -> pending scan
+
+    def scan(rel_dir):
+        if rel_dir not in scans:
+            scans[rel_dir] = pool.apply_async(_scan, (root + rel_dir,))
+
+    def walk(rel_dir):
+        entries = scans.pop(rel_dir).get()
+        if ignore:
+            entries = [entry for entry in entries if not ignore.match(rel_dir + '/' + entry[0], entry[1])]
+        sub_dirs = [rel_dir + '/' + name for name, is_dir, _, _ in entries if is_dir]
+        for sub_dir in sub_dirs[:read_ahead]:
+            scan(sub_dir)
+        next_sub_dir = 0
+        for name, is_dir, size, mtime in entries:
+            rel_path = rel_dir + '/' + name
+            yield rel_path, is_dir, size, mtime
+            if is_dir:
+                next_sub_dir += 1
+                if next_sub_dir + read_ahead - 1 < len(sub_dirs):
+                    scan(sub_dirs[next_sub_dir + read_ahead - 1])
+                for item in walk(rel_path):
+                    yield item
+
+    try:
+        scan('')
+        for item in walk(''):
+            yield item
+    finally:
+        pool.terminate()
+
+
+def _wins_tie(remote_item, local_hash):
+    """
+    Whether a remote file edited about when the local one was is the version
+    to keep: the one with the greater content hash, so that both sides pick
+    the same. Neither is if a hash isn't known.
+    """
+    remote_hash = remote_item[4] if len(remote_item) > 4 else None
+    own_hash = local_hash(remote_item[0]) if local_hash else None
+    return bool(remote_hash and own_hash and remote_hash > own_hash)
+
+
+def diff_listings(local, remote, local_hash=None):
+    """
+    Merge-diff two sorted listings, generating the remote entries which
+    are missing or stale in the local one. A local file is stale if the
+    remote one is newer; if they differ in size but their mtimes are within
+    MTIME_TOLERANCE, their content hashes decide (see _wins_tie).
+
+    local_hash: Callable giving the content hash of a local file.
+    """
+    local_item = next(local, None)
+    for remote_item in remote:
+        remote_key = sort_key(remote_item[0])
+        while local_item is not None and sort_key(local_item[0]) < remote_key:
+            local_item = next(local, None)
+        if local_item is None or local_item[0] != remote_item[0]:
+            yield remote_item
+            continue
+        rel_path, is_dir, size, mtime = remote_item[:4]
+        if is_dir != local_item[1]:
+            logger.warning("RECONCILE: %s is a dir on one side only, skipped", rel_path)
+        elif is_dir:
+            continue
+        elif mtime > local_item[3] + MTIME_TOLERANCE:
+            yield remote_item
+        elif (size != local_item[2] and abs(mtime - local_item[3]) <= MTIME_TOLERANCE and
+              _wins_tie(remote_item, local_hash)):
+            yield remote_item
+
+
+class Reconciler(object):
+
+    def __init__(self, syncer, queue=None, endpoint=None):
+        """
+        queue: Where to queue the changes; the syncer's fetch queue by default.
+        endpoint: Peer to reconcile with; the syncer's remote by default.
+        """
+        self.syncer = syncer
+        self.queue = queue
+        self.endpoint = endpoint or syncer.remote_endpoint
+        self.stats = {'listed': 0, 'queued': 0}
+
+    def _remote_listing(self):
+        import transport
+        session = transport.get_session(self.endpoint)
+        r = session.request('REQLIST', self.endpoint, headers=self.syncer.auth_headers,
+                            stream=True, timeout=transport.TIMEOUT)
+        r.raise_for_status()
+        try:
+            for line in r.iter_lines():
+                if line:
+                    self.stats['listed'] += 1
+                    yield json.loads(line.decode('utf-8'))
+        finally:
+            r.close()
+
+    def _queue(self, changes):
+        while True:
+            try:
+                (self.queue or self.syncer.fetch_queue).put_many(changes)
+                self.stats['queued'] += len(changes)
+                return
+            except QueueFull:
+                time.sleep(conf.BUSY_RETRY_AFTER)
+
+    def _change_for(self, item):
+        rel_path, is_dir, size, mtime = item[:4]
+        change = {
+            'change_type': events.EVENT_TYPE_CREATED,
+            'src_path': rel_path,
+            'dest_path': '',
+            'is_dir': is_dir,
+            'time': int(mtime),
+            'origin': self.endpoint,
+            'backlog': True,  # Fetched after the changes made meanwhile, see throttle.py
+        }
+        if not is_dir:
+            change['size'] = size
+            if len(item) > 4 and item[4]:
+                change['file_hash'] = item[4]
+        return change
+
+    def run(self):
+        """Queue everything missing or stale here, compared to the remote."""
+        start = time.time()
+        rules = self.syncer.ignore
+        local = walk_sorted(self.syncer._abs_sync_dir, ignore=rules)
+        remote = self._remote_listing()
+        if rules:
+            remote = (item for item in remote if not rules.match(item[0], item[1]))
+        batch = []
+        for item in diff_listings(local, remote, local_hash=self.syncer.manifest.file_hash):
+            batch.append(self._change_for(item))
+            if len(batch) >= QUEUE_BATCH_SIZE:
+                self._queue(batch)
+                batch = []
+        if batch:
+            self._queue(batch)
+        logger.info("RECONCILE: listed %s entries of %s, queued %s changes in %.2fs",
+                    self.stats['listed'], self.endpoint, self.stats['queued'], time.time() - start)
+
+    def run_until_done(self, max_wait=300):
+        """Run once the remote is reachable, retrying with backoff for up to max_wait seconds."""
+        import requests
+        import transport
+        attempt = 0
+        deadline = time.time() + max_wait
+        while True:
+            attempt += 1
+            try:
+                return self.run()
+            except requests.RequestException as e:
+                delay = transport.backoff_delay(attempt)
+                if time.time() + delay > deadline:
+                    logger.error("RECONCILE: gave up, remote unreachable: %s", e)
+                    return
+                logger.info("RECONCILE: remote not reachable yet (%s), retrying in %ss", e, delay)
+                time.sleep(delay)
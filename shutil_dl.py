@@ -3,40 +3,515 @@ This is faster than chunked response saving.
     Credit: https://stackoverflow.com/a/39217788/1114457
 100MB takes ~58s on 7Mbps connection.
 
-BUT keep this in mind:
+The response body is consumed through `iter_content` rather than `r.raw`
+so that requests marks it as consumed and hands the keep-alive connection
+back to the session's pool once the file has been written. See:
     http://docs.python-requests.org/en/master/user/quickstart/#raw-response-content
+
+A single stream can't fill a link with a large bandwidth-delay product, so
+large files can instead be fetched as several byte ranges at once, over
+as many pooled connections (see download_segmented), and many small files
+in a single request (see download_bundle).
+
+Every download is paced by the throttle.Limiter it's given, if any, as it
+receives the body and as it writes it to disk (see throttle.py).
 """
 
-import sys
+import hashlib
+import os
 import shutil
+import sys
 import time
+from multiprocessing.pool import ThreadPool
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
 
 import requests
-from utils import ResponseSaved
+
+try:
+    from urllib3.response import HAS_ZSTD as URLLIB3_DECODES_ZSTD
+except ImportError:
+    # urllib3 < 2
+    URLLIB3_DECODES_ZSTD = False
+
+import bundle
+import content_encoding
+import delta
+import manifest
+import throttle
+from utils import ResponseSaved, logger, temp_path_for
+
+COPY_CHUNK_SIZE = 64 * 1024
+VALIDATOR_SUFFIX = '.validator'  # Of the temp file keeping the If-Range to resume a download with
+FICLONE = 0x40049409  # Linux ioctl making a file share the blocks of another (a reflink)
+
+
+def _install(tmp_path, file_path):
+    """Atomically move a completed temp file into place."""
+    getattr(os, 'replace', os.rename)(tmp_path, file_path)
+
+
+def clone_file(src_path, file_path, link=False):
+    """
+    Install a copy of the local file src_path at file_path, through a temp
+    file renamed into place: a reflink sharing its blocks where the
+    filesystem supports it, else a hard link if `link`, else a plain copy.
+    Returns how it was copied: 'reflink', 'hardlink' or 'copy'.
+    """
+    dir_path = os.path.dirname(file_path)
+    if dir_path and not os.path.isdir(dir_path):
+        os.makedirs(dir_path)
+    tmp_path = temp_path_for(file_path)
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    with open(src_path, 'rb') as src:
+        with open(tmp_path, 'wb') as tmp_file:
+            try:
+                fcntl.ioctl(tmp_file.fileno(), FICLONE, src.fileno())
+                how = 'reflink'
+            except (AttributeError, EnvironmentError):
+                how = None
+        if how is None and link:
+            os.remove(tmp_path)
+            try:
+                os.link(src_path, tmp_path)
+                how = 'hardlink'
+            except OSError:
+                pass
+        if how is None:
+            with open(tmp_path, 'wb') as tmp_file:
+                shutil.copyfileobj(src, tmp_file, COPY_CHUNK_SIZE)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            how = 'copy'
+    _install(tmp_path, file_path)
+    return how
+
+
+def _pwrite(fd, data, offset):
+    """Write all of data at offset of the file, leaving the fd's own offset alone where possible."""
+    while data:
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, data, offset)
+        else:
+            # Python 2; every segment has an fd of its own, so seeking it is fine
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, data)
+        data = data[written:]
+        offset += written
+
+
+def _preallocate(fd, size):
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass  # Not supported by the filesystem
+    os.ftruncate(fd, size)
 
 
-def download(file_path, url="https://speed.hetzner.de/100MB.bin", silent=False, headers={}):
+def _range_start(r):
+    """First byte offset of a 206 response, from its Content-Range header."""
+    content_range = r.headers.get('Content-Range', '')
+    try:
+        return int(content_range.split()[1].split('-')[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def _full_size(r):
+    """Size of the whole file a response is (part of), if known."""
+    if r.status_code == 206:
+        try:
+            return int(r.headers.get('Content-Range', '').rsplit('/', 1)[1])
+        except (IndexError, ValueError):
+            return None
+    if 'X-Simplesync-Size' in r.headers:
+        return int(r.headers['X-Simplesync-Size'])
+    if 'Content-Length' in r.headers and 'Content-Encoding' not in r.headers:
+        return int(r.headers['Content-Length'])
+    return None
+
+
+def _validator(r):
+    """
+    What to send as If-Range to resume the version of the file a response
+    is of: its ETag if it's a strong one, else its Last-Modified.
+    """
+    etag = r.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return r.headers.get('Last-Modified')
+
+
+def _load_validator(validator_path):
+    try:
+        with open(validator_path) as f:
+            return f.read().strip() or None
+    except EnvironmentError:
+        return None
+
+
+def _save_validator(validator_path, validator):
+    if validator:
+        with open(validator_path, 'w') as f:
+            f.write(validator)
+    elif os.path.exists(validator_path):
+        os.remove(validator_path)
+
+
+def _discard(*paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _fetch_into(tmp_path, validator_path, url, headers, session, timeout, validator, limiter):
+    """
+    Fetch `url` into `tmp_path`, resuming after whatever the temp file holds
+    already if `validator` says which version of the file that is; without
+    one, it's fetched from byte 0. The validator of the version being
+    written is saved to `validator_path` before any of its body is, so that
+    a later call can resume it too. Returns (response, offset resumed from,
+    validator) once the whole body has been written. Raises
+    requests.RequestException / EnvironmentError on failures, including a
+    body cut short.
+    """
+    offset = os.path.getsize(tmp_path) if validator and os.path.exists(tmp_path) else 0
+    req_headers = dict(headers)
+    req_headers.setdefault('Accept-Encoding', content_encoding.accept_encoding())
+    if offset:
+        req_headers['Range'] = 'bytes={}-'.format(offset)
+        # Server sends the whole file instead if it changed in the meantime
+        req_headers['If-Range'] = validator
+    r = (session or requests).get(url, headers=req_headers, stream=True, timeout=timeout)
+    try:
+        if r.status_code == 416:
+            # Nothing after offset; the temp file can't be trusted, start over
+            _discard(tmp_path, validator_path)
+            raise requests.RequestException("Range not satisfiable, restarting from byte 0")
+        r.raise_for_status()
+        if r.status_code == 206 and _range_start(r) == offset:
+            if _validator(r) not in (None, validator):
+                # If-Range not honoured; the range is of another version
+                _discard(tmp_path, validator_path)
+                raise requests.RequestException("Range of another version, restarting from byte 0")
+            mode = 'ab'
+        else:
+            mode = 'wb'
+            offset = 0
+            validator = _validator(r)
+            _save_validator(validator_path, validator)
+        # iter_content decodes gzip and deflate, and zstd too with urllib3 2
+        # if it has a zstd backend; otherwise zstd is decoded here
+        chunks = limiter.iter_received(r.iter_content(COPY_CHUNK_SIZE))
+        if r.headers.get('Content-Encoding') == 'zstd' and not URLLIB3_DECODES_ZSTD:
+            chunks = content_encoding.decompress_stream('zstd', chunks)
+        with open(tmp_path, mode) as tmp_file:
+            for chunk in chunks:
+                limiter.write(len(chunk))
+                tmp_file.write(chunk)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+    finally:
+        r.close()
+    full_size = _full_size(r)
+    if full_size is not None and os.path.getsize(tmp_path) != full_size:
+        raise requests.RequestException("Incomplete download: {} of {} bytes".format(
+            os.path.getsize(tmp_path), full_size))
+    return r, offset, validator
+
+
+def download(file_path, url="https://speed.hetzner.de/100MB.bin", silent=False, headers={},
+             session=None, timeout=None, expected_hash=None, attempts=3, limiter=throttle.UNLIMITED):
+    """
+    Download to a hidden temp file next to `file_path`, which is fsync'ed
+    and atomically renamed into place only once it's complete. Failed
+    attempts are resumed with a Range request from where they stopped;
+    a temp file left behind by an earlier call is resumed as well. Only
+    ever onto the same version of the file though: the ETag or
+    Last-Modified of the response the temp file was started from is kept
+    next to it and sent as If-Range, and a download without either is
+    started over instead.
+
+    session: Pooled requests.Session to fetch with (see transport.get_session).
+             A one-off connection is used if not given.
+    expected_hash: sha1 the file should have. A resumed download not matching
+                   it is thrown away and fetched again from byte 0.
+    """
     if not (url or silent):
         raise Exception("File URL not given")
     elif silent and not url:
-        result = ResponseSaved(error_message="URL is empty")
+        return ResponseSaved(error_message="URL is empty")
 
     local_filename = file_path if file_path else url.split('/')[-1]
+    tmp_path = temp_path_for(local_filename)
+    validator_path = temp_path_for(local_filename + VALIDATOR_SUFFIX)
     start = time.time()
-    r = requests.get(url, headers=headers, stream=True)
+    validator = _load_validator(validator_path)
+    error = None
+    for attempt in range(1, attempts + 1):
+        try:
+            r, offset, validator = _fetch_into(tmp_path, validator_path, url, headers, session, timeout,
+                                               validator, limiter)
+        except requests.HTTPError as e:
+            return ResponseSaved(error=e, not_ok_reason=e.response.reason)
+        except (requests.RequestException, EnvironmentError) as e:
+            error = e
+            # Of whatever the temp file now holds the start of
+            validator = _load_validator(validator_path)
+            if attempt < attempts:
+                time.sleep(attempt)
+            continue
 
-    if not r.ok:
-        result = ResponseSaved(not_ok_reason=r.reason)
-    import os; print("Current dir: {}".format(os.getcwd()))
-    with open(local_filename, 'wb') as local_file:
-        shutil.copyfileobj(r.raw, local_file)
+        if offset and expected_hash and manifest.hash_file(tmp_path) != expected_hash:
+            # Resumed onto bytes of another version of the file
+            _discard(tmp_path, validator_path)
+            validator = None
+            error = ValueError("Resumed download doesn't match hash {}".format(expected_hash))
+            continue
+        size = os.path.getsize(tmp_path)
+        _install(tmp_path, local_filename)
+        _discard(validator_path)
+        break
+    else:
+        return ResponseSaved(error=error, error_message=str(error))
 
     time_taken = time.time() - start
-    print("URL:{}; Time taken: {}".format(url, time_taken))
+    logger.debug("URL:%s; Time taken: %s", url, time_taken)
 
-    result = ResponseSaved(saved_to=local_filename, time_taken=time_taken)
+    result = ResponseSaved(success=True, saved_to=local_filename, time_taken=time_taken, bytes_transferred=size)
     return result
 
+
+def download_delta(file_path, endpoint, remote_path, block_size, headers={}, session=None, timeout=None,
+                   limiter=throttle.UNLIMITED):
+    """
+    Update the local file at `file_path` to the remote's version of
+    `remote_path` by fetching only the blocks that differ (see delta.py).
+
+    The new version is rebuilt in a temp file next to `file_path` which is
+    renamed into place once it has been verified.
+    """
+    start = time.time()
+    with open(file_path, 'rb') as basis:
+        sigs = delta.signatures(basis, block_size)
+    payload = {'path': remote_path, 'block_size': block_size, 'signatures': sigs}
+    try:
+        r = (session or requests).request('REQDELTA', endpoint, json=payload, headers=headers,
+                                          stream=True, timeout=timeout)
+    except requests.RequestException as e:
+        return ResponseSaved(error=e, error_message=str(e))
+    if not r.ok:
+        r.close()
+        return ResponseSaved(not_ok_reason=r.reason)
+
+    def read(size):
+        data = r.raw.read(size)
+        limiter.receive(len(data))
+        return data
+
+    tmp_path = temp_path_for(file_path)
+    try:
+        with open(file_path, 'rb') as basis:
+            with open(tmp_path, 'wb') as out:
+                literal_bytes, matched_bytes = delta.apply_delta(read, basis, limiter.writer(out), block_size)
+                out.flush()
+                os.fsync(out.fileno())
+        _install(tmp_path, file_path)
+    except (EnvironmentError, EOFError, ValueError, requests.RequestException) as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return ResponseSaved(error=e, error_message="Delta sync failed: {}".format(e))
+    finally:
+        r.close()
+
+    time_taken = time.time() - start
+    return ResponseSaved(
+        success=True,
+        saved_to=file_path,
+        time_taken=time_taken,
+        bytes_transferred=literal_bytes,
+        bytes_saved=matched_bytes,
+    )
+
+def _reader(chunks):
+    """read(size) over an iterator of chunks, returning at most size bytes."""
+    state = {'chunk': b'', 'offset': 0}
+
+    def read(size):
+        if state['offset'] >= len(state['chunk']):
+            state['chunk'] = next(chunks, b'')
+            state['offset'] = 0
+        offset = state['offset']
+        state['offset'] = offset + size
+        return state['chunk'][offset:offset + size]
+
+    return read
+
+
+def download_bundle(endpoint, files, headers={}, session=None, timeout=None, limiter=throttle.UNLIMITED):
+    """
+    Fetch several small files at once with a REQBUNDLE (see bundle.py).
+    Each file is written to a temp file next to its local path, which is
+    fsync'ed and atomically renamed into place as soon as it's complete.
+
+    files: (remote path, local path, expected sha1 or None) of each file.
+
+    The result's saved_to is the list of the remote paths installed; it's
+    set even if the request failed part way. Files not sent, or not
+    matching their expected hash, are left out of it.
+    """
+    start = time.time()
+    local_paths = dict((remote_path, (local_path, expected_hash))
+                       for remote_path, local_path, expected_hash in files)
+    saved = []
+    received = 0
+    try:
+        r = (session or requests).request('REQBUNDLE', endpoint, json={'paths': [f[0] for f in files]},
+                                          headers=headers, stream=True, timeout=timeout)
+    except requests.RequestException as e:
+        return ResponseSaved(error=e, error_message=str(e), saved_to=saved)
+    try:
+        r.raise_for_status()
+        chunks = limiter.iter_received(r.iter_content(COPY_CHUNK_SIZE))
+        for remote_path, data in bundle.read_frames(_reader(chunks)):
+            if data is None or remote_path not in local_paths:
+                continue
+            received += len(data)
+            local_path, expected_hash = local_paths[remote_path]
+            if expected_hash and hashlib.sha1(data).hexdigest() != expected_hash:
+                logger.debug("Bundled %s doesn't match hash %s", remote_path, expected_hash)
+                continue
+            dir_path = os.path.dirname(local_path)
+            if dir_path and not os.path.isdir(dir_path):
+                os.makedirs(dir_path)
+            tmp_path = temp_path_for(local_path)
+            limiter.write(len(data))
+            with open(tmp_path, 'wb') as tmp_file:
+                tmp_file.write(data)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            _install(tmp_path, local_path)
+            saved.append(remote_path)
+        for _ in chunks:
+            pass  # The end of the chunked body, so the connection goes back to the pool
+    except requests.HTTPError as e:
+        return ResponseSaved(error=e, not_ok_reason=e.response.reason, saved_to=saved)
+    except (EnvironmentError, EOFError, ValueError, requests.RequestException) as e:
+        return ResponseSaved(error=e, error_message="Bundle download failed: {}".format(e),
+                             saved_to=saved, bytes_transferred=received)
+    finally:
+        r.close()
+
+    return ResponseSaved(success=True, saved_to=saved, time_taken=time.time() - start,
+                         bytes_transferred=received)
+
+
+class SegmentError(requests.RequestException):
+    pass
+
+
+def _fetch_segment(tmp_path, url, first, last, headers, session, timeout, attempts, limiter):
+    """
+    Fetch bytes first..last (inclusive) of url into the same bytes of
+    tmp_path, resuming from where a failed attempt stopped. Returns the
+    Last-Modified and full size the responses had.
+    Raises requests.RequestException / EnvironmentError on failures.
+    """
+    offset = first
+    fd = os.open(tmp_path, os.O_WRONLY)
+    try:
+        for attempt in range(1, attempts + 1):
+            req_headers = dict(headers, **{'Range': 'bytes={}-{}'.format(offset, last),
+                                           'Accept-Encoding': 'identity'})
+            try:
+                r = (session or requests).get(url, headers=req_headers, stream=True, timeout=timeout)
+                try:
+                    r.raise_for_status()
+                    if r.status_code != 206 or _range_start(r) != offset:
+                        raise SegmentError("GET {} ignored the range {}-{}".format(url, offset, last))
+                    for chunk in limiter.iter_received(r.iter_content(COPY_CHUNK_SIZE)):
+                        limiter.write(len(chunk))
+                        _pwrite(fd, chunk, offset)
+                        offset += len(chunk)
+                finally:
+                    r.close()
+            except (SegmentError, requests.HTTPError):
+                raise
+            except (requests.RequestException, EnvironmentError):
+                if attempt == attempts:
+                    raise
+                time.sleep(attempt)
+                continue
+            if offset > last:
+                return r.headers.get('Last-Modified'), _full_size(r)
+        raise SegmentError("GET {}: bytes {}-{} cut short".format(url, offset, last))
+    finally:
+        os.close(fd)
+
+
+def download_segmented(file_path, url, size, segments, headers={}, session=None, timeout=None,
+                       expected_hash=None, attempts=3, limiter=throttle.UNLIMITED):
+    """
+    Download a file of `size` bytes as `segments` byte ranges fetched
+    concurrently, each written in place into a temp file preallocated next
+    to `file_path`, which is renamed into place once it's complete and
+    verified. Every range has to come from the same version of the file
+    (same Last-Modified and size), and the whole file has to match
+    expected_hash, if given.
+
+    Returns a failed ResponseSaved if the server doesn't serve ranges;
+    the file is best fetched as a single stream then.
+    """
+    start = time.time()
+    tmp_path = temp_path_for(file_path)
+    segment_size = -(-size // segments)
+    ranges = [(first, min(first + segment_size, size) - 1) for first in range(0, size, segment_size)]
+    try:
+        dir_path = os.path.dirname(file_path)
+        if dir_path and not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            _preallocate(fd, size)
+        finally:
+            os.close(fd)
+
+        pool = ThreadPool(len(ranges))
+        try:
+            versions = pool.map(
+                lambda byte_range: _fetch_segment(tmp_path, url, byte_range[0], byte_range[1],
+                                                  headers, session, timeout, attempts, limiter),
+                ranges)
+        finally:
+            pool.terminate()
+        if len(set(versions)) != 1 or versions[0][1] != size:
+            raise SegmentError("{} changed during the download".format(url))
+
+        fd = os.open(tmp_path, os.O_WRONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        if expected_hash and manifest.hash_file(tmp_path) != expected_hash:
+            raise SegmentError("{} doesn't match hash {}".format(url, expected_hash))
+        _install(tmp_path, file_path)
+    except (requests.RequestException, EnvironmentError) as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return ResponseSaved(error=e, error_message=str(e))
+
+    time_taken = time.time() - start
+    logger.debug("URL:%s; Time taken: %s, in %s segments", url, time_taken, len(ranges))
+    return ResponseSaved(success=True, saved_to=file_path, time_taken=time_taken, bytes_transferred=size)
+
+
 if __name__ == '__main__':
     file_path = sys.argv[1]
     if file_path:
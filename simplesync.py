@@ -9,31 +9,56 @@ Two main components:
                  from notifying machine.
 
 """
+import startup  # First, to time the imports (see --profile_startup)
+
 import datetime
+import hashlib
+import json
 import os
 import shutil
 import sys
+import threading
 import time
-from multiprocessing import Process, Queue
+from multiprocessing import Process
 
 import click
-import requests
 from expiringdict import ExpiringDict
 from watchdog import events
 
-# import accountant
+import accountant
 import conf
-import observer
-import shutil_dl
-import web_server
+import content_encoding
+import fetcher
+import ignore
+import manifest
+import metrics
+import push
+import suppression
+import throttle
 from utils import logger
 
+# What pulls in requests (fanout, shutil_dl, transport), the observer and the
+# web servers is imported where it's first needed instead, so that each
+# process only imports what it uses, once it's up.
+
+startup.mark('imports')
+
 MAX_RECENTLY_SYNCED_IGNORE_TIME = 5
 
+_fanout_lock = threading.Lock()
+_manifest_lock = threading.Lock()
+_fetch_queue_lock = threading.Lock()
+
 __author__ = "Ashish Kumar (ashish26kr91@gmail.com)"
 __version__ = "0.0.1"
 
 
+def _overlaps(path, other_path):
+    """Whether two paths are the same, or one is in the other."""
+    return (path == other_path or path.startswith(other_path + '/') or
+            other_path.startswith(path + '/'))
+
+
 class Syncer(object):
     VALID_CHANGE_TYPES = [
         events.EVENT_TYPE_CREATED,
@@ -54,10 +79,76 @@ class Syncer(object):
         self.remote_port = kwargs.get('remote_port', conf.DEFAULT_SYNC_MACHINE_PORT)
         self.auth_headers = kwargs.get('auth_headers', {})
         self.remote_endpoint = "http://{ip}:{port}".format(ip=self.remote_ip, port=self.remote_port)
+        # Every machine to sync with, as 'host:port'; just the remote one by default
+        self.peers = ["http://{}".format(peer) for peer in kwargs.get('peers') or []] or [self.remote_endpoint]
+        # Port this machine serves on, sent along so that peers know where to fetch from
+        self.server_port = kwargs.get('server_port')
         self.recently_saved = ExpiringDict(max_len=1000, max_age_seconds=10)
-        self.ip_queue = kwargs.get('ip_queue')
+        self.suppression = kwargs.get('suppression')
+        # Journal of outbound changes which peers acknowledge; optional
+        self.accountant = kwargs.get('accountant')
+        self.remote_accept_encodings = {}  # endpoint -> Accept-Encoding of its REQSYNC responses
+        self.remote_push_sizes = {}  # endpoint -> bytes of files it takes pushed (see push.py)
+        self.acks = fetcher.AckTracker()  # Journal seqs of received changes applied, per notifier
+        # Resolved now, as the web server changes into the sync dir later on
+        self._abs_sync_dir = os.path.abspath(self.local_sync_dir)
+        self._manifest = None
+        self._manifest_pid = None
+        self._fetch_queue = None
+        self._fetch_queue_pid = None
+        self._fanout = None
+        self._fanout_pid = None
+        self._ignore = kwargs.get('ignore')
+        self.no_bundle_endpoints = set()  # Peers which don't support REQBUNDLE
         assert isinstance(self.auth_headers, dict)
 
+    def __getstate__(self):
+        """
+        What's handed to a spawned process: what lives in the process
+        using it (ack counts, and the lazily created manifest, fetch queue
+        and fan-out) is left out, to be created anew there.
+        """
+        state = self.__dict__.copy()
+        del state['acks']
+        for name in ('_manifest', '_fetch_queue', '_fanout'):
+            state[name] = state[name + '_pid'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.acks = fetcher.AckTracker()
+
+    @property
+    def manifest(self):
+        """
+        Content hashes of the files synced to this machine. Created lazily
+        as its worker threads have to live in the process applying changes.
+        """
+        if self._manifest_pid != os.getpid():
+            with _manifest_lock:
+                if self._manifest_pid != os.getpid():
+                    self._manifest = manifest.Manifest(self._abs_sync_dir, 'receiver')
+                    self._manifest_pid = os.getpid()
+        return self._manifest
+
+    @property
+    def ignore(self):
+        """Rules of the paths not to sync (see ignore.py), reloaded when .syncignore changes."""
+        if self._ignore is None:
+            self._ignore = ignore.IgnoreRules.load(self._abs_sync_dir)
+        self._ignore = self._ignore.refreshed()
+        return self._ignore
+
+    def _is_ignored(self, change):
+        """Whether a received change is only of ignored paths, and so isn't to be applied here."""
+        rules = self.ignore
+        if not rules:
+            return False
+        if change.get('change_type') == events.EVENT_TYPE_MOVED:
+            return (rules.match(change['src_path'], change['is_dir']) and
+                    rules.match(change['dest_path'], change['is_dir']))
+        return rules.match(change['src_path'], change['is_dir'])
+
     def _is_path_in_sync_dir(self, save_path):
         return save_path.startswith(self.local_sync_dir)
 
@@ -65,7 +156,60 @@ class Syncer(object):
         # return os.path.join(self.local_sync_dir, relative_file_path)
         return os.path.join(os.getcwd(), relative_file_path)
 
-    def notify_remotes(self, sync_data):
+    @property
+    def fanout(self):
+        """
+        Per peer backlogs of changes to notify; its threads live in the
+        notifying process. Changes journaled but not acknowledged by a peer
+        before this process started are replayed to it first.
+        """
+        if self._fanout_pid != os.getpid():
+            with _fanout_lock:
+                if self._fanout_pid != os.getpid():
+                    self._start_fanout()
+        return self._fanout
+
+    def _start_fanout(self):
+        import fanout
+        self._fanout = fanout.FanOut(self.peers, self.notify_remote)
+        if self.accountant:
+            for peer in self._fanout.peers:
+                # Marked as backlog, fetched after the changes made since
+                replayed = [dict(change, backlog=True) for change in self.accountant.unacked(peer.endpoint)]
+                if replayed:
+                    logger.info("SYNCER: replaying %s unacknowledged changes to %s",
+                                len(replayed), peer.endpoint)
+                    peer.push(replayed)
+        self._fanout_pid = os.getpid()
+
+    def warm_up(self):
+        """
+        Import what fetching received changes needs, requests above all, and
+        set up the sessions to fetch from the peers with, so that the first
+        change doesn't wait on it. Meant to be run on a thread once the
+        server is up.
+        """
+        # Only imported, which is what takes a while; it's used when fetching
+        import shutil_dl  # noqa: F401
+        import transport
+        for endpoint in self.peers:
+            transport.get_session(endpoint)
+        startup.mark('fetch path imported')
+
+    def notify_remotes(self, changes, received_at=None):
+        """
+        Queue changes to be notified to every peer, see notify_remote.
+        Each peer is notified concurrently, at its own pace (see fanout.py).
+        The changes are journaled first, if there's a journal.
+
+        received_at: Times the events of the changes were received at, if known.
+        """
+        changes = changes if isinstance(changes, list) else [changes]
+        if self.accountant:
+            self.accountant.add_push_event(changes)
+        self.fanout.push(changes, received_at)
+
+    def notify_remote(self, endpoint, sync_data):
         """
         To notify the other machine that they need to pull the FS changes on this machine.
 
@@ -75,35 +219,122 @@ class Syncer(object):
         available, but this struck me as good usage of requests module.. Sockets transfer
         implementation might be added if I have enough time.
 
-        Notification will be tried 3 times
-
-        sync_data: {
+        Notification will be tried conf.NOTIFY_RETRIES times, backing off
+        between failed attempts, and waiting up to conf.NOTIFY_BUSY_MAX_WAIT
+        seconds in all on a remote answering it's busy. The pooled session for the remote endpoint
+        is reused, so the connection is kept alive across notifications.
+        Large notifications are compressed once the remote has told which
+        encodings it accepts (see content_encoding.py). With conf.PUSH_MODE, small
+        changed files are sent along, as a REQPUSH, to a remote which told
+        it takes them (see push.py).
+
+        endpoint: 'http://host:port' of the peer to notify.
+        sync_data: Either a single change, or a list of changes which is
+            sent as one batched notification ({'changes': [...]}).
+            Each change is: {
                 'change_type': event.event_type,
                 'source_path': event.src_path,
                 'dest_path': getattr(event, 'dest_path'),
                 'is_dir': event.is_directory,
                 'time': cur_time,
-                # 'file_hash': '',
+                'size': 1024,  # for created/modified files
+                'file_hash': '',  # for created/modified files
             }
+            The port this machine serves on is sent along as 'origin_port',
+            and the last journal 'seq' of the changes as 'seq'. The remote
+            acknowledges the seqs of the changes it applied in its responses,
+            so once these are applied, in the response to this notification
+            or a later one.
         """
+        import requests
+        import transport
+        if isinstance(sync_data, list):
+            sync_data = {'changes': sync_data}
+            if sync_data['changes'] and 'seq' in sync_data['changes'][-1]:
+                sync_data['seq'] = sync_data['changes'][-1]['seq']
+        if self.server_port:
+            sync_data = dict(sync_data, origin_port=self.server_port)
+        method, body, headers = self._notification(endpoint, sync_data)
         notif_posted = False
         retry_ctr = 0
-        logger.info("SYNCER notifying remote")
-        while not notif_posted and retry_ctr < 3:
-            req = requests.Request(
-                method='REQSYNC',
-                url=self.remote_endpoint,
-                json=sync_data,
-                headers=self.auth_headers
-            )
-            resp = requests.session().send(req.prepare())
-            notif_posted = resp.ok
+        busy_waited = 0
+        session = transport.get_session(endpoint)
+        logger.debug("SYNCER notifying %s", endpoint)
+        while not notif_posted and retry_ctr < conf.NOTIFY_RETRIES:
             retry_ctr += 1
-            time.sleep(retry_ctr)
-            if notif_posted:
-                logger.info("Notified; REQSYNC response: \n{}".format(resp.text))
+            try:
+                resp = session.request(
+                    method,
+                    endpoint,
+                    data=body,
+                    headers=headers,
+                    timeout=transport.TIMEOUT,
+                )
+            except requests.RequestException as e:
+                metrics.NOTIFY_RETRIES.inc()
+                logger.warning("REQSYNC attempt %s failed: %s", retry_ctr, e)
+            else:
+                if resp.status_code == 503 and 'Retry-After' in resp.headers:
+                    retry_after = float(resp.headers['Retry-After'])
+                    if busy_waited + retry_after > conf.NOTIFY_BUSY_MAX_WAIT:
+                        metrics.NOTIFY_RETRIES.inc()
+                        logger.warning("REQSYNC failed: %s still busy after %s seconds", endpoint, busy_waited)
+                        break
+                    # Remote is busy; wait as told without using up an attempt
+                    retry_ctr -= 1
+                    busy_waited += retry_after
+                    time.sleep(retry_after)
+                    continue
+                if resp.status_code == 501 and method == 'REQPUSH':
+                    # Predates REQPUSH; the files are pulled from now on
+                    self.remote_push_sizes[endpoint] = 0
+                    retry_ctr -= 1
+                    method, body, headers = self._notification(endpoint, sync_data)
+                    continue
+                notif_posted = resp.ok
+                # What the remote can decode, and take pushed; used for the next notifications
+                self.remote_accept_encodings[endpoint] = resp.headers.get('Accept-Encoding')
+                self.remote_push_sizes[endpoint] = push.accepted_size(resp.headers)
+                if notif_posted:
+                    metrics.NOTIFICATIONS.inc()
+                    logger.debug("Notified; REQSYNC response: \n%s", resp.text)
+                    self._record_ack(endpoint, resp)
+                else:
+                    metrics.NOTIFY_RETRIES.inc()
+                    logger.warning("REQSYNC attempt %s failed: %s %s", retry_ctr, resp.status_code, resp.reason)
+            if not notif_posted and retry_ctr < conf.NOTIFY_RETRIES:
+                time.sleep(transport.backoff_delay(retry_ctr))
         return notif_posted
 
+    def _notification(self, endpoint, sync_data):
+        """(method, body, headers) of the request notifying `endpoint` of sync_data."""
+        body = json.dumps(sync_data).encode('utf-8')
+        headers = dict(self.auth_headers, **{'Content-Type': 'application/json'})
+        max_push_size = min(conf.PUSH_MAX_SIZE, self.remote_push_sizes.get(endpoint, 0)) if conf.PUSH_MODE else 0
+        if max_push_size:
+            files = push.files_to_push(sync_data.get('changes', [sync_data]),
+                                       lambda path: os.path.join(self._abs_sync_dir, path[1:]), max_push_size)
+            if files:
+                metrics.PUSHES.inc()
+                headers['Content-Type'] = 'application/octet-stream'
+                return 'REQPUSH', push.encode(body, files), headers
+        encoding = content_encoding.negotiate(self.remote_accept_encodings.get(endpoint))
+        if encoding and len(body) >= conf.COMPRESSION_MIN_SIZE:
+            body = content_encoding.compress(encoding, body)
+            headers['Content-Encoding'] = encoding
+        return 'REQSYNC', body, headers
+
+    def _record_ack(self, endpoint, resp):
+        """Mark the changes a REQSYNC response acknowledges as done with in the journal."""
+        if not self.accountant:
+            return
+        try:
+            ack_seq = resp.json().get('ack_seq')
+        except ValueError:
+            return
+        if ack_seq:
+            self.accountant.ack(endpoint, ack_seq)
+
     def _is_created(self, change_type):
         return change_type == events.EVENT_TYPE_CREATED
 
@@ -116,8 +347,9 @@ class Syncer(object):
     def _is_moved(self, change_type):
         return change_type == events.EVENT_TYPE_MOVED
 
-    def _needs_fetch(self, change_type):
-        return change_type in self.NEEDS_FETCH_TYPE_EVENTS
+    def _needs_fetch(self, change_type, is_dir=False):
+        # Directories have no content to fetch, they're just created locally
+        return change_type in self.NEEDS_FETCH_TYPE_EVENTS and not is_dir
 
     def is_valid_change_data(self, notif_data):
         errors = []
@@ -139,35 +371,250 @@ class Syncer(object):
             return False
         return True
 
-    def _write_to_IPQ(self, data):
-        q_data = {data['src_path']: time.time() + MAX_RECENTLY_SYNCED_IGNORE_TIME}
-        self.ip_queue.put(
-            q_data
-        )
+    def _mark_just_synced(self, data):
+        """
+        Have the observer skip the events caused by applying this change,
+        so that it isn't echoed back to the remote (see suppression.py).
+        """
+        if data['change_type'] == events.EVENT_TYPE_MOVED:
+            self.suppression.mark(data['src_path'])
+            self.suppression.mark(data['dest_path'])
+        else:
+            self.suppression.mark(data['src_path'], data.get('file_hash'))
 
-    def remote_action(self, data):
+    def _use_delta(self, local_path):
+        """Whether the local copy is large enough to only fetch the changed blocks."""
+        if not conf.DELTA_SYNC:
+            return False
+        try:
+            return os.path.isfile(local_path) and os.path.getsize(local_path) >= conf.DELTA_MIN_SIZE
+        except OSError:
+            return False
+
+    def _use_segments(self, data):
+        """Whether the file is large enough to be downloaded as several byte ranges at once."""
+        return conf.DOWNLOAD_SEGMENTS > 1 and data.get('size', 0) >= conf.SEGMENTED_MIN_SIZE
+
+    def bundle_key(self, data):
+        """
+        Peer to fetch a received change from along with other small files
+        (see apply_bundle), or None if it's to be applied on its own.
+        """
+        if (data['change_type'] in self.NEEDS_FETCH_TYPE_EVENTS and not data['is_dir'] and
+                0 <= data.get('size', -1) <= conf.BUNDLE_MAX_FILE_SIZE and not data.get('pushed_to')):
+            endpoint = self.endpoint_for(data)
+            if endpoint not in self.no_bundle_endpoints:
+                return endpoint
+        return None
+
+    def endpoint_for(self, data):
+        """Endpoint of the peer to fetch a received change from: the one which sent it."""
+        return data.get('origin') or self.remote_endpoint
+
+    def _copy_local(self, data):
+        """
+        Install a received file by copying a local file with the same
+        content, if the manifest knows of one (see conf.LOCAL_COPY).
+        Returns whether it did.
+        """
+        import shutil_dl
+        if conf.LOCAL_COPY == 'off' or not data.get('file_hash'):
+            return False
+        source = self.manifest.find(data['file_hash'])
+        if source is None or source == data['src_path']:
+            return False
+        try:
+            how = shutil_dl.clone_file(self._get_local_save_path(source[1:]),
+                                       self._get_local_save_path(data['src_path'][1:]),
+                                       link=conf.LOCAL_COPY == 'hardlink')
+        except EnvironmentError as e:
+            logger.warning("Couldn't copy %s from local %s: %s; fetching it", data['src_path'], source, e)
+            return False
+        if self.manifest.current_hash(source) != data['file_hash']:
+            # Changed while being copied
+            return False
+        metrics.LOCAL_COPIES.inc()
+        self.recently_saved[data['src_path']] = data
+        self.manifest.record(data['src_path'], data['file_hash'])
+        logger.info("Synced file from local %s (%s): %s", source, how, data)
+        return True
+
+    def _install_pushed(self, data):
         """
-        Fetch and write a remote file to local filesystem.
+        Install the content pushed along with a received change, if it was
+        (see stage_pushed). Returns whether it did.
         """
-        url = os.path.join(self.remote_endpoint, data['src_path'][1:])
+        tmp_path = data.pop('pushed_to', None)
+        if not tmp_path:
+            return False
+        try:
+            size = os.path.getsize(tmp_path)
+            push.install(tmp_path, self._get_local_save_path(data['src_path'][1:]))
+        except EnvironmentError as e:
+            logger.warning("Couldn't install pushed %s: %s; fetching it", data['src_path'], e)
+            push.discard(tmp_path)
+            return False
+        metrics.PUSHED_FILES.inc()
+        metrics.PUSHED_BYTES.inc(size)
+        self.recently_saved[data['src_path']] = data
+        self.manifest.record(data['src_path'], data['file_hash'])
+        logger.info("Synced pushed file: %s", data)
+        return True
 
-        result = shutil_dl.download(
-            self._get_local_save_path(data['src_path'][1:]),
-            url,
-            headers=self.auth_headers
+    def _delta_download(self, local_path, data):
+        import delta
+        import shutil_dl
+        import transport
+        endpoint = self.endpoint_for(data)
+        block_size = delta.block_size_for(os.path.getsize(local_path), conf.DELTA_BLOCK_SIZE)
+        result = shutil_dl.download_delta(
+            local_path,
+            endpoint,
+            data['src_path'],
+            block_size,
+            headers=self.auth_headers,
+            session=transport.get_session(endpoint),
+            timeout=transport.TIMEOUT,
+            limiter=throttle.limiter_for(endpoint, throttle.priority(data)),
         )
+        if result.success:
+            logger.info("Delta synced %s: %s bytes transferred, %s bytes saved, in %.2fs",
+                        data['src_path'], result.bytes_transferred, result.bytes_saved, result.time_taken)
+        else:
+            logger.warning("Delta sync failed: %s; Error: %s; fetching whole file",
+                           data, result.error_message or result.not_ok_reason)
+        return result
+
+    def remote_action(self, data):
+        """
+        Fetch and write a remote file to local filesystem. Returns whether
+        the file is up to date now.
+
+        Nothing is fetched if the local file already has the content hash
+        sent along. If a large enough local copy exists, only the blocks
+        that differ are fetched, falling back to fetching the whole file.
+        """
+        import shutil_dl
+        import transport
+        endpoint = self.endpoint_for(data)
+        url = os.path.join(endpoint, data['src_path'][1:])
+        local_path = self._get_local_save_path(data['src_path'][1:])
+
+        if self._install_pushed(data):
+            return True
+        if data.get('file_hash') and self.manifest.file_hash(data['src_path']) == data['file_hash']:
+            logger.debug("Already up to date, not fetching: %s", data)
+            return True
+        if self._copy_local(data):
+            return True
+
+        result = None
+        limiter = throttle.limiter_for(endpoint, throttle.priority(data))
+        metrics.TRANSFERS_IN_FLIGHT.inc()
+        try:
+            if self._use_delta(local_path):
+                result = self._delta_download(local_path, data)
+            if not (result and result.success) and self._use_segments(data):
+                result = shutil_dl.download_segmented(
+                    local_path,
+                    url,
+                    data['size'],
+                    conf.DOWNLOAD_SEGMENTS,
+                    headers=self.auth_headers,
+                    session=transport.get_session(endpoint),
+                    timeout=transport.TIMEOUT,
+                    expected_hash=data.get('file_hash'),
+                    limiter=limiter,
+                )
+                if not result.success:
+                    logger.warning("Segmented download failed: %s; Error: %s; fetching as a single stream",
+                                   data, result.error_message or result.not_ok_reason)
+            if not (result and result.success):
+                result = shutil_dl.download(
+                    local_path,
+                    url,
+                    headers=self.auth_headers,
+                    session=transport.get_session(endpoint),
+                    timeout=transport.TIMEOUT,
+                    expected_hash=data.get('file_hash'),
+                    limiter=limiter,
+                )
+        finally:
+            metrics.TRANSFERS_IN_FLIGHT.dec()
 
         if result.success:
+            metrics.record_download(result.time_taken, result.bytes_transferred)
             self.recently_saved[data['src_path']] = data
-            # TODO call accountant to mark pull notif as succeeded.
-            logger.info("Synced file: {}".format(data))
-            pass
+            self.manifest.refresh(data['src_path'])
+            logger.info("Synced file: %s", data)
         else:
-            logger.warning("Sync failed: {}; Error: {}".format(data, result.error_message or result.not_ok_reason))
+            metrics.DOWNLOAD_FAILURES.inc()
+            logger.warning("Sync failed: %s; Error: %s", data, result.error_message or result.not_ok_reason)
+        return result.success
+
+    def apply_bundle(self, changes):
+        """
+        Apply several received changes of small files from the same peer,
+        fetching them all in one REQBUNDLE (see bundle.py). Whatever isn't
+        delivered that way is fetched on its own. Returns the changes which
+        couldn't be applied.
+        """
+        import requests
+        import shutil_dl
+        import transport
+        for change in changes:
+            self._mark_just_synced(change)
+        endpoint = self.endpoint_for(changes[0])
+        fetches = [change for change in changes if not (
+            change.get('file_hash') and self.manifest.file_hash(change['src_path']) == change['file_hash'] or
+            self._copy_local(change))]
+        files = [(change['src_path'], self._get_local_save_path(change['src_path'][1:]), change.get('file_hash'))
+                 for change in fetches]
+
+        metrics.TRANSFERS_IN_FLIGHT.inc()
+        try:
+            result = shutil_dl.download_bundle(
+                endpoint,
+                files,
+                headers=self.auth_headers,
+                session=transport.get_session(endpoint),
+                timeout=transport.TIMEOUT,
+                limiter=throttle.limiter_for(endpoint, min(throttle.priority(change) for change in fetches)),
+            ) if files else None
+        finally:
+            metrics.TRANSFERS_IN_FLIGHT.dec()
+
+        saved = set(result.saved_to) if result else set()
+        if result and result.success:
+            metrics.BUNDLES.inc()
+            metrics.record_download(result.time_taken, result.bytes_transferred)
+            logger.info("Synced %s of %s files in a bundle from %s: %s bytes in %.2fs",
+                        len(saved), len(files), endpoint, result.bytes_transferred, result.time_taken)
+        elif result:
+            metrics.DOWNLOAD_FAILURES.inc()
+            if isinstance(result.error, requests.HTTPError) and result.error.response.status_code == 501:
+                # Predates REQBUNDLE; small files are fetched from it one by one from now on
+                self.no_bundle_endpoints.add(endpoint)
+            logger.warning("Bundle download from %s failed: %s; fetching the %s files left one by one",
+                           endpoint, result.error_message or result.not_ok_reason, len(files) - len(saved))
+        failed = []
+        for change in fetches:
+            if change['src_path'] in saved:
+                self.recently_saved[change['src_path']] = change
+                self.manifest.refresh(change['src_path'])
+                logger.debug("Synced file: %s", change)
+            elif not self.remote_action(change):
+                failed.append(change)
+
+        # Again, as fetching may have taken longer than the suppression lasts
+        for change in changes:
+            self._mark_just_synced(change)
+        return failed
 
     def _delete(self, src_path, is_dir):
         if is_dir:
-            remove_func = os.rmdir
+            # Whatever is in it goes too; the notifier sends one change for the whole subtree
+            remove_func = shutil.rmtree
         else:
             remove_func = os.remove
         try:
@@ -178,57 +625,248 @@ class Syncer(object):
                 pass
             else:
                 # TODO Some other error. Permissions or something perhaps. Handle this
-                logger.error("\nlocal_action: Error in deleting {};\nexception: {}".format(src_path, ose.args))
+                logger.error("\nlocal_action: Error in deleting %s;\nexception: %s", src_path, ose.args)
                 pass
 
+    def _mkdir(self, src_path):
+        try:
+            os.makedirs(src_path)
+        except OSError as ose:
+            if ose.args[0] == 17:
+                # Already exists
+                pass
+            else:
+                logger.error("\nlocal_action: Error in creating dir %s;\nexception: %s", src_path, ose.args)
+
     def _move(self, src_path, dest_path, is_dir):
+        # A rename, so that a dir is moved with everything in it at once, and
+        # is never moved into an existing dir at dest_path like shutil.move does
         try:
-            shutil.move(src_path, dest_path)
+            dest_dir = os.path.dirname(dest_path)
+            if dest_dir and not os.path.isdir(dest_dir):
+                os.makedirs(dest_dir)
+            os.rename(src_path, dest_path)
         except OSError as ose:
             if ose.args[0] == 2:
                 # Doesn't exist
                 pass
             else:
                 # TODO Some other error. Permissions or something perhaps. Handle this
-                logger.error("\nlocal_action: Error in moving {};\nexception: {}".format(
-                    (src_path, dest_path), ose.args))
+                logger.error("\nlocal_action: Error in moving %s;\nexception: %s", (src_path, dest_path), ose.args)
                 pass
 
     def local_action(self, data):
         """
         No need to contact remote machine. Only do modifications in
-        local filesystem - when even type is `deleted` or `moved`
+        local filesystem - when even type is `deleted` or `moved`, or
+        a directory is `created`
         """
         src = data['src_path'][1:]
         dst = data['dest_path'][1:]
-        if data['change_type'] == events.EVENT_TYPE_DELETED:
+        if data['change_type'] == events.EVENT_TYPE_CREATED and data['is_dir']:
+            self._mkdir(src)
+        elif data['change_type'] == events.EVENT_TYPE_DELETED:
             self._delete(src, data['is_dir'])
+            self.manifest.remove(data['src_path'])
         elif data['change_type'] == events.EVENT_TYPE_MOVED:
             self._move(src, dst, data['is_dir'])
+            self.manifest.move(data['src_path'], data['dest_path'])
         else:
-            logger.warning("\nlocal_action NOT CAUGHT type:'{}'".format(data['change_type']))
+            logger.warning("\nlocal_action NOT CAUGHT type:'%s'", data['change_type'])
 
-    def handle_sync_push(self, notif_data):
+    def handle_sync_push(self, notif_data, origin=None, pushed=(), seq=None):
         """
+        Validate and queue received changes for the fetch workers; they're
+        applied in the background, in order per path (see fetcher.py).
+
+        Returns the validation errors. Raises fetcher.QueueFull when the
+        fetch queue has no room for the changes; nothing is queued then.
+
+        origin: Endpoint of the peer which sent the changes, to fetch them from.
+        pushed: (path, content) of the files pushed along with the changes, see stage_pushed.
+        seq: Last journal seq of the changes; it's acknowledged once they're all
+             applied, see acks.
+
+        notif_data is either a single change, or a list of changes which
+        are applied in the given order.
+
         notif_data = {
             'change_type': 'created',
             'src_path': '/tmp/abc',  # source path on remote
             'dest_path': '/tmp/xyz',  # in case change_type is `moved`
             'is_dir': True/False,
-            # 'file_hash': 'ddfdf', # present if is_dir is False and change_type is created/modified
+            'size': 1024,  # present if is_dir is False and change_type is created/modified
+            'file_hash': 'ddfdf', # present if is_dir is False and change_type is created/modified
             'time': 144414141, # unix time stamp upto
         }
         """
-        if not self.is_valid_change_data(notif_data):
-            return self.errors
-
-        self._write_to_IPQ(notif_data)
+        valid_changes, errors = self.validate_changes(notif_data, origin)
+        self.stage_pushed(valid_changes, pushed)
+        self.acks.expect(valid_changes)
+        try:
+            self.fetch_queue.put_many(valid_changes)
+        except fetcher.QueueFull:
+            self.unqueued(valid_changes)
+            raise
+        if seq:
+            self.acks.received(origin, seq)
+        return errors
+
+    def unqueued(self, changes):
+        """Let go of received changes the fetch queue had no room for."""
+        for change in changes:
+            self.acks.release(change)
+        self.discard_pushed(changes)
+
+    def stage_pushed(self, changes, pushed):
+        """
+        Write the files pushed along with received changes (see push.py) to
+        temp files, tagging the changes they're the content of with them, for
+        the fetch workers to install instead of fetching them. Content which
+        isn't that of the last change of its path is left out; such changes
+        are fetched as usual. Reads all of `pushed`.
+        """
+        fetches = {}  # path -> its last change fetching it
+        for change in changes:
+            if self._needs_fetch(change['change_type'], change['is_dir']):
+                fetches[change['src_path']] = change
+        for path, content in pushed:
+            change = fetches.pop(path, None)
+            if content is None or change is None or hashlib.sha1(content).hexdigest() != change.get('file_hash'):
+                continue
+            endpoint = self.endpoint_for(change)
+            try:
+                change['pushed_to'] = push.stage(self._abs_sync_dir, content,
+                                                 throttle.limiter_for(endpoint, throttle.priority(change)))
+            except EnvironmentError as e:
+                logger.warning("Couldn't stage pushed %s: %s; fetching it", path, e)
+
+    def discard_pushed(self, changes):
+        """Remove the temp files of the pushed files of changes which won't be applied."""
+        for change in changes:
+            if change.get('pushed_to'):
+                push.discard(change.pop('pushed_to'))
+
+    def validate_changes(self, notif_data, origin=None):
+        """
+        Split received changes (see handle_sync_push) into the valid ones,
+        in order, and the validation errors of the others. The valid ones
+        are tagged with their origin, if given; those of paths ignored here
+        are left out silently, and deletes and creations of the same content
+        are paired into moves (see _pair_moves).
+        """
+        changes = notif_data if isinstance(notif_data, list) else [notif_data]
+        errors = []
+        valid_changes = []
+        for change in changes:
+            if self.is_valid_change_data(change):
+                if self._is_ignored(change):
+                    logger.debug("SYNCER: ignoring change of %s", change['src_path'])
+                    continue
+                if origin:
+                    change['origin'] = origin
+                change.pop('pushed_to', None)  # Only ever set by stage_pushed
+                valid_changes.append(change)
+            elif isinstance(notif_data, list):
+                errors.append({'change': change, 'errors': self.errors})
+            else:
+                errors.extend(self.errors)
+        return self._pair_moves(valid_changes), errors
 
-        if self._needs_fetch(notif_data['change_type']):
-            self.remote_action(notif_data)  # Need to fetch file system objects from other machine
+    def _pair_moves(self, changes):
+        """
+        Valid changes, with the delete of a file followed by the creation of
+        a file with the same content turned into a move of the file, so that
+        nothing is fetched. The move takes the place of the creation, with the
+        journal seq of the delete so that neither is acknowledged before it's
+        applied; the pair is left alone if any change in between involves
+        either path.
+        """
+        deletes = {}  # hash -> position of a delete of a file with that content here
+        paired = {}  # position of a creation -> position of the delete paired with it
+        for position, change in enumerate(changes):
+            if change['is_dir']:
+                continue
+            if change['change_type'] == events.EVENT_TYPE_DELETED:
+                file_hash = self.manifest.current_hash(change['src_path'])
+                if file_hash:
+                    deletes[file_hash] = position
+            elif change['change_type'] in self.NEEDS_FETCH_TYPE_EVENTS and change.get('file_hash') in deletes:
+                delete_position = deletes.pop(change['file_hash'])
+                paths = (changes[delete_position]['src_path'], change['src_path'])
+                if not any(_overlaps(path, changed_path) for between in changes[delete_position + 1:position]
+                           for changed_path in fetcher._change_paths(between) for path in paths):
+                    paired[position] = delete_position
+        if not paired:
+            return changes
+        deleted = set(paired.values())
+        paired_changes = []
+        for position, change in enumerate(changes):
+            if position in deleted:
+                continue
+            if position in paired:
+                metrics.PAIRED_MOVES.inc()
+                change = dict(change, change_type=events.EVENT_TYPE_MOVED,
+                              src_path=changes[paired[position]]['src_path'], dest_path=change['src_path'])
+                if 'seq' in changes[paired[position]]:
+                    change['seq'] = changes[paired[position]]['seq']
+            paired_changes.append(change)
+        return paired_changes
+
+    @property
+    def fetch_queue(self):
+        """Received changes waiting to be applied; workers live in the receiving process."""
+        if self._fetch_queue_pid != os.getpid():
+            with _fetch_queue_lock:
+                if self._fetch_queue_pid != os.getpid():
+                    self._fetch_queue = fetcher.FetchQueue(
+                        self.apply_change,
+                        workers=conf.FETCH_WORKERS,
+                        max_size=conf.FETCH_QUEUE_SIZE,
+                        apply_bundle=self.apply_bundle,
+                        bundle_key=self.bundle_key,
+                        priority=throttle.priority,
+                        applied=self.acks.applied,
+                        failed=self.acks.failed,
+                    )
+                    self._fetch_queue_pid = os.getpid()
+        return self._fetch_queue
+
+    def apply_change(self, change):
+        """Apply a single valid change to the local filesystem. Returns whether it did."""
+        self._mark_just_synced(change)
+
+        if self._needs_fetch(change['change_type'], change['is_dir']):
+            applied = self.remote_action(change)  # Need to fetch file system objects from other machine
         else:
-            self.local_action(notif_data)  # Need to only modify local filesystem
-        return []
+            self.local_action(change)  # Need to only modify local filesystem
+            applied = True
+
+        # Again, as fetching may have taken longer than the suppression lasts
+        self._mark_just_synced(change)
+        return applied
+
+
+def _watch(metrics_shared, **kwargs):
+    """Target of the observer process, importing the observer there."""
+    metrics.attach(metrics_shared)
+    import observer
+    startup.mark('observer imported')
+    observer.watch_filesystem(**kwargs)
+
+
+def _serve(server_mode, metrics_shared=None, **kwargs):
+    """Target of the web server process, importing the web server there."""
+    if metrics_shared:
+        metrics.attach(metrics_shared)
+    if server_mode == 'asyncio':
+        import aio_server
+        serve = aio_server.run_server
+    else:
+        import web_server
+        serve = web_server.run_server
+    startup.mark('server imported')
+    serve(**kwargs)
 
 
 @click.command()
@@ -238,19 +876,42 @@ class Syncer(object):
 @click.option('--server_port', '-p', type=click.INT, help='Server port.')
 @click.option('--remote_ip', '-ri', help='Remote machine IP.')
 @click.option('--remote_port', '-rp', type=click.INT, help='Remote machine port.')
-def run(syncdir, recursive, server_port, remote_ip, remote_port):
-    if not (syncdir or recursive or server_port or remote_ip or remote_port):
+@click.option('--peer', 'peers', multiple=True, help='Machine to sync with, as host:port; repeat for '
+                                                     'several machines. Overrides the remote ip and port.')
+@click.option('--reconcile', is_flag=True, help='Fetch whatever is missing or stale compared to the '
+                                                 'remote machine on startup.')
+@click.option('--server_mode', type=click.Choice(['threaded', 'asyncio']),
+              help='Serve with a thread per connection, or on an asyncio event loop (Python 3.7+).')
+@click.option('--single_process', is_flag=True, help='Watch and serve from a single process, instead of '
+                                                      'a process each.')
+@click.option('--profile_startup', '--profile-startup', is_flag=True,
+              help='Print how long each phase of the startup takes.')
+def run(syncdir, recursive, server_port, remote_ip, remote_port, peers, reconcile, server_mode,
+        single_process, profile_startup):
+    if not (syncdir or recursive or server_port or remote_ip or remote_port or peers):
         print(click.get_current_context().get_help())
         sys.exit()
+    if profile_startup:
+        startup.enable()
 
-    ip_queue = Queue()  # inter process queue for skipping just synced objects
+    # Index shared by both processes for skipping just synced objects
     # getting reported by observers on both sides in an infinite loop.
+    just_synced = suppression.SuppressionIndex(ttl=MAX_RECENTLY_SYNCED_IGNORE_TIME)
 
+    single_process = single_process or conf.SINGLE_PROCESS
+    if single_process and syncdir:
+        # The web server changes into the sync dir, while the observer keeps
+        # resolving new dirs to watch against the current one
+        syncdir = os.path.abspath(syncdir)
     server_port = server_port or conf.WEBSERVER_PORT
     serve_on = ('0.0.0.0', server_port)
     recursive = recursive or conf.WATCH_RECURSIVE
+    if not peers and not (remote_ip or remote_port):
+        peers = conf.PEERS
     syncer = Syncer(
-        ip_queue=ip_queue,
+        peers=list(peers),
+        server_port=server_port,
+        suppression=just_synced,
         local_sync_dir=syncdir,
         remote_ip=remote_ip or conf.DEFAULT_SYNC_MACHINE_IP,
         remote_port=remote_port or conf.DEFAULT_SYNC_MACHINE_PORT,
@@ -258,39 +919,56 @@ def run(syncdir, recursive, server_port, remote_ip, remote_port):
                           # and its check in transporter module
     )
     print("Using configuration: \n")
-    print("Remote: {}".format(syncer.remote_endpoint))
+    print("Peers: {}".format(", ".join(syncer.peers)))
     print("Sync dir: {}".format(syncer.local_sync_dir))
     print("Watch recursive: {}".format(recursive))
     print("Server PORT: {}".format(server_port))
-
-    # accountant = accountant.TheAccountant()
-    observer_process = Process(
-        target=observer.watch_filesystem,
-        args=(),
-        kwargs=dict(
-            ip_queue=ip_queue,
-            watch_dir=syncdir,
-            notify=True,
-            recursive=recursive,
-            syncer=syncer,
-            daemon=True,
-            # accountant=accountant,
-        )
+    if conf.JOURNAL:
+        # Opened by the observer process, which journals the changes it notifies
+        syncer.accountant = accountant.TheAccountant(syncer.local_sync_dir, syncer.peers)
+    reconcile = reconcile or conf.RECONCILE_ON_START
+    print("Reconcile on start: {}".format(reconcile))
+    server_mode = server_mode or conf.SERVER_MODE
+    print("Server mode: {}".format(server_mode))
+    print("Single process: {}".format(single_process))
+    if server_mode == 'asyncio' and sys.version_info < (3, 7):
+        sys.exit("The asyncio server mode needs Python 3.7+")
+    startup.mark('shared state built')
+
+    watch_kwargs = dict(
+        watch_dir=syncdir,
+        notify=True,
+        recursive=recursive,
+        syncer=syncer,
+        daemon=True,
+        accountant=syncer.accountant,
+    )
+    serve_kwargs = dict(
+        server_mode=server_mode,
+        serve_on=serve_on,
+        serve_dir=syncdir,
+        send_ack=True,
+        syncer=syncer,
+        reconcile_on_start=reconcile,
+        accountant=syncer.accountant,
     )
+    if single_process:
+        # The observer runs on threads of its own, and the server on this one
+        import observer
+        startup.mark('observer imported')
+        observer.start_watching(**watch_kwargs)
+        _serve(**serve_kwargs)
+        return
+
+    # Passed along explicitly (as is the syncer, with the suppression index)
+    # for the processes to share them even if spawned rather than forked
+    metrics_shared = metrics.allocate()
+    observer_process = Process(target=_watch, name='observer',
+                               kwargs=dict(watch_kwargs, metrics_shared=metrics_shared))
     observer_process.start()
 
-    webserver_process = Process(
-        target=web_server.run_server,
-        args=(),
-        kwargs=dict(
-            ip_queue=ip_queue,
-            serve_on=serve_on,
-            serve_dir=syncdir,
-            send_ack=True,
-            syncer=syncer,
-            # accountant=accountant,
-        )
-    )
+    webserver_process = Process(target=_serve, name='webserver',
+                                kwargs=dict(serve_kwargs, metrics_shared=metrics_shared))
     webserver_process.start()
 
     observer_process.join()
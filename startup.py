@@ -0,0 +1,78 @@
+"""
+Timings of the startup phases of a node, reported with --profile-startup.
+
+Each process marks the phases it goes through as it starts (see mark),
+from the imports to watching the sync dir or serving, and then its first
+event or request. Marks are always recorded, which is just appending a
+timestamp; once profiling is enabled, those recorded so far and every
+later one are printed, with the time since the node was launched and
+since the previous mark.
+
+The launch time is when the interpreter started, where /proc tells it,
+or else when this module was imported, which simplesync does before
+anything else. It's handed down to the observer and web server processes
+through the environment, so that their marks count from the launch too.
+"""
+import multiprocessing
+import os
+import sys
+import time
+
+ENV_VAR = 'SIMPLESYNC_PROFILE_STARTUP'
+
+
+def _process_started_at():
+    """When this process started, per /proc, or now if that can't be told."""
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = float(f.read().rpartition(')')[2].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - uptime + start_ticks / os.sysconf('SC_CLK_TCK')
+    except (EnvironmentError, ValueError, IndexError, AttributeError):
+        return time.time()
+
+
+enabled = bool(os.environ.get(ENV_VAR))
+launched_at = float(os.environ[ENV_VAR]) if enabled else _process_started_at()
+_marks = []  # (phase, time) of this process
+_marks_pid = os.getpid()
+_seen = set()
+
+
+def _print(phase, at, previous_at):
+    print("STARTUP {:<12} {:<28} {:8.1f} ms  (+{:.1f} ms)".format(
+        multiprocessing.current_process().name, phase, (at - launched_at) * 1000, (at - previous_at) * 1000))
+    sys.stdout.flush()
+
+
+def mark(phase):
+    """Record that this process just got through a phase of its startup."""
+    global _marks, _marks_pid
+    at = time.time()
+    previous_at = _marks[-1][1] if _marks else launched_at
+    if _marks_pid != os.getpid():
+        # A forked child, whose marks start after its parent's last one
+        _marks = []
+        _marks_pid = os.getpid()
+    _marks.append((phase, at))
+    if enabled:
+        _print(phase, at, previous_at)
+
+
+def mark_once(phase):
+    """Mark a phase only the first time it's reached in this process, e.g. the first event."""
+    if phase not in _seen:
+        _seen.add(phase)
+        mark(phase)
+
+
+def enable():
+    """Print the marks so far and from now on, in this process and those it starts."""
+    global enabled
+    enabled = True
+    os.environ[ENV_VAR] = repr(launched_at)
+    previous_at = launched_at
+    for phase, at in _marks:
+        _print(phase, at, previous_at)
+        previous_at = at
@@ -0,0 +1,95 @@
+"""
+Cross-process index of just synced paths, for echo suppression.
+
+When the receiving side applies a change it marks the path here, along
+with the content hash it's writing; the observer then skips the events
+that change causes instead of notifying the remote of it all over again.
+
+The index is a fixed size open addressing hash table in a shared ctypes
+array, created by the main process and handed to the observer and web
+server processes along with the syncer, whether they're forked or
+spawned. Each slot holds a fingerprint of the relative path,
+an expiry timestamp and a fingerprint of the content hash; expired slots
+are simply reused, so nothing ever needs to be cleaned up.
+"""
+import hashlib
+import multiprocessing
+import struct
+import time
+
+SLOT = struct.Struct('=QdQ')  # path fingerprint, expires at, content hash fingerprint
+MAX_PROBES = 32
+NO_HASH = 0
+
+
+def _path_fingerprint(rel_path):
+    if not isinstance(rel_path, bytes):
+        rel_path = rel_path.encode('utf-8')
+    fingerprint, = struct.unpack('=Q', hashlib.md5(rel_path).digest()[:8])
+    return fingerprint or 1  # 0 marks an empty slot
+
+
+def hash_fingerprint(file_hash):
+    if not file_hash:
+        return NO_HASH
+    return int(file_hash[:16], 16) or 1
+
+
+class SuppressionIndex(object):
+
+    def __init__(self, capacity=65536, ttl=5):
+        """
+        capacity: Number of slots, rounded up to a power of two.
+        ttl: Seconds a marked path stays suppressed.
+        """
+        self.capacity = 1
+        while self.capacity < capacity:
+            self.capacity *= 2
+        self.ttl = ttl
+        self._table = multiprocessing.RawArray('c', self.capacity * SLOT.size)
+        self._lock = multiprocessing.Lock()
+
+    def _slots(self, fingerprint):
+        """Slot offsets to probe for a path fingerprint."""
+        first = fingerprint & (self.capacity - 1)
+        for probe in range(min(MAX_PROBES, self.capacity)):
+            yield ((first + probe) & (self.capacity - 1)) * SLOT.size
+
+    def mark(self, rel_path, file_hash=None):
+        """Suppress events on rel_path for the next ttl seconds; if file_hash is
+        given, only as long as the file still has that content."""
+        fingerprint = _path_fingerprint(rel_path)
+        now = time.time()
+        entry = (fingerprint, now + self.ttl, hash_fingerprint(file_hash))
+        with self._lock:
+            reusable = None
+            oldest_expiry = None
+            for offset in self._slots(fingerprint):
+                slot_fingerprint, expires_at, _ = SLOT.unpack_from(self._table, offset)
+                if slot_fingerprint == fingerprint:
+                    reusable = offset
+                    break
+                if slot_fingerprint == 0:
+                    if reusable is None or oldest_expiry >= now:
+                        reusable = offset
+                    break
+                if reusable is None or expires_at < oldest_expiry:
+                    # Expired slots are free; otherwise evict the one expiring first
+                    reusable, oldest_expiry = offset, expires_at
+            SLOT.pack_into(self._table, reusable, *entry)
+
+    def lookup(self, rel_path):
+        """
+        None if rel_path isn't suppressed. Otherwise the fingerprint of the
+        content hash it was marked with, which is NO_HASH if none was given.
+        """
+        fingerprint = _path_fingerprint(rel_path)
+        now = time.time()
+        with self._lock:
+            for offset in self._slots(fingerprint):
+                slot_fingerprint, expires_at, content = SLOT.unpack_from(self._table, offset)
+                if slot_fingerprint == fingerprint:
+                    return content if expires_at > now else None
+                if slot_fingerprint == 0:
+                    return None
+        return None
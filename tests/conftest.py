@@ -0,0 +1,62 @@
+"""
+The modules live at the top of the repo, and conf.py reads conf.ini from
+the working dir when it's first imported, so they're imported here with
+the settings of conf.ini.sample.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def _import_conf():
+    workdir = tempfile.mkdtemp(prefix='simplesync-tests-')
+    shutil.copy(os.path.join(ROOT, 'conf.ini.sample'), os.path.join(workdir, 'conf.ini'))
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        import conf  # noqa: F401
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+_import_conf()
+
+
+@pytest.fixture
+def state_dir(tmp_path, monkeypatch):
+    """conf.STATE_DIR, in a temp dir of the test's own."""
+    import conf
+    path = str(tmp_path / 'state')
+    monkeypatch.setattr(conf, 'STATE_DIR', path)
+    return path
+
+
+@pytest.fixture
+def conf_dir(tmp_path, monkeypatch):
+    """A working dir with the conf.ini of the tests, for processes spawned from the test to import conf in."""
+    shutil.copy(os.path.join(ROOT, 'conf.ini.sample'), str(tmp_path / 'conf.ini'))
+    monkeypatch.chdir(str(tmp_path))
+    return tmp_path
+
+
+class _NoSleep(object):
+    time = staticmethod(time.time)
+
+    @staticmethod
+    def sleep(seconds):
+        pass
+
+
+@pytest.fixture
+def no_retry_delay(monkeypatch):
+    """Failed downloads retried right away."""
+    import shutil_dl
+    monkeypatch.setattr(shutil_dl, 'time', _NoSleep)
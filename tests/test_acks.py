@@ -0,0 +1,225 @@
+"""Acknowledging received changes only once applied, and the journal they're replayed from (user-013)."""
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+import accountant
+import fetcher
+import simplesync
+import suppression
+
+ORIGIN = 'http://127.0.0.1:8101'
+
+
+def _change(seq, path, change_type='modified', origin=ORIGIN):
+    return {'change_type': change_type, 'src_path': path, 'dest_path': '', 'is_dir': False,
+            'time': 0, 'seq': seq, 'origin': origin}
+
+
+def _closed_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def _wait_for(predicate, timeout=10):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+class TestAckTracker(object):
+
+    def test_acks_up_to_the_first_change_not_applied(self):
+        acks = fetcher.AckTracker()
+        changes = [_change(seq, '/f{}'.format(seq)) for seq in (1, 2, 3)]
+        acks.expect(changes)
+        acks.received(ORIGIN, 3)
+        assert acks.ack_seq(ORIGIN) is None
+        acks.applied(changes[0])
+        acks.applied(changes[2])
+        assert acks.ack_seq(ORIGIN) == 1
+        acks.applied(changes[1])
+        assert acks.ack_seq(ORIGIN) == 3
+
+    def test_failed_change_is_held_back(self):
+        acks = fetcher.AckTracker()
+        changes = [_change(seq, '/f{}'.format(seq)) for seq in (1, 2, 3)]
+        acks.expect(changes)
+        acks.received(ORIGIN, 3)
+        acks.applied(changes[0])
+        acks.failed(changes[1])
+        acks.applied(changes[2])
+        assert acks.ack_seq(ORIGIN) == 1
+
+    def test_failed_change_is_released_by_a_later_change_of_its_path(self):
+        acks = fetcher.AckTracker()
+        failing, other, later = _change(1, '/f'), _change(2, '/g'), _change(3, '/f')
+        acks.expect([failing, other])
+        acks.received(ORIGIN, 2)
+        acks.failed(failing)
+        acks.applied(other)
+        assert acks.ack_seq(ORIGIN) is None
+        acks.expect([later])
+        acks.received(ORIGIN, 3)
+        acks.applied(later)
+        assert acks.ack_seq(ORIGIN) == 3
+
+    def test_released_change_isnt_held_back(self):
+        acks = fetcher.AckTracker()
+        change = _change(1, '/f')
+        acks.expect([change])
+        acks.release(change)
+        assert acks.ack_seq(ORIGIN) is None
+
+    def test_changes_without_seq_or_origin_are_ignored(self):
+        acks = fetcher.AckTracker()
+        acks.expect([_change(None, '/f'), _change(1, '/g', origin=None)])
+        acks.received(ORIGIN, 5)
+        assert acks.ack_seq(ORIGIN) == 5
+
+
+class TestFetchQueue(object):
+
+    def _run(self, changes, failing_paths, bundle_key=None):
+        acks = fetcher.AckTracker()
+        done = []
+        lock = threading.Lock()
+
+        def apply(change):
+            with lock:
+                done.append(change)
+            return change['src_path'] not in failing_paths
+
+        def apply_bundle(batch):
+            with lock:
+                done.extend(batch)
+            return [change for change in batch if change['src_path'] in failing_paths]
+
+        queue = fetcher.FetchQueue(apply, workers=2, apply_bundle=apply_bundle, bundle_key=bundle_key,
+                                   applied=acks.applied, failed=acks.failed)
+        acks.expect(changes)
+        queue.put_many(changes)
+        acks.received(ORIGIN, changes[-1]['seq'])
+        _wait_for(lambda: len(done) == len(changes))
+        # The callbacks run right after apply returns
+        time.sleep(0.05)
+        return acks
+
+    def test_failed_apply_isnt_acknowledged(self):
+        changes = [_change(seq, '/f{}'.format(seq)) for seq in (1, 2, 3)]
+        assert self._run(changes, {'/f2'}).ack_seq(ORIGIN) == 1
+
+    def test_all_applied_are_acknowledged(self):
+        changes = [_change(seq, '/f{}'.format(seq)) for seq in (1, 2, 3)]
+        assert self._run(changes, set()).ack_seq(ORIGIN) == 3
+
+    def test_failed_file_of_a_bundle_isnt_acknowledged(self):
+        changes = [_change(seq, '/f{}'.format(seq)) for seq in (1, 2, 3)]
+        acks = self._run(changes, {'/f3'}, bundle_key=lambda change: ORIGIN)
+        assert acks.ack_seq(ORIGIN) == 2
+
+    def test_raising_apply_isnt_acknowledged(self):
+        acks = fetcher.AckTracker()
+        done = threading.Event()
+
+        def apply(change):
+            done.set()
+            raise IOError("disk full")
+
+        queue = fetcher.FetchQueue(apply, workers=1, applied=acks.applied, failed=acks.failed)
+        change = _change(1, '/f')
+        acks.expect([change])
+        queue.put_many([change])
+        acks.received(ORIGIN, 1)
+        assert done.wait(5)
+        time.sleep(0.05)
+        assert acks.ack_seq(ORIGIN) is None
+
+
+def test_failed_download_isnt_acknowledged(tmp_path, monkeypatch, state_dir, no_retry_delay):
+    """A received change whose file can't be fetched from its notifier is never acknowledged to it."""
+    sync_dir = tmp_path / 'sync'
+    sync_dir.mkdir()
+    monkeypatch.chdir(str(sync_dir))
+    origin = 'http://127.0.0.1:{}'.format(_closed_port())
+    syncer = simplesync.Syncer(local_sync_dir=str(sync_dir), remote_ip='127.0.0.1', remote_port=_closed_port(),
+                               suppression=suppression.SuppressionIndex(capacity=64))
+    failed = []
+    failed_of = syncer.acks.failed
+    monkeypatch.setattr(syncer.acks, 'failed', lambda change: (failed_of(change), failed.append(change)))
+    changes = [
+        {'change_type': 'created', 'src_path': '/d', 'dest_path': '', 'is_dir': True, 'time': 0, 'seq': 1},
+        {'change_type': 'created', 'src_path': '/d/f', 'dest_path': '', 'is_dir': False, 'time': 0,
+         'size': 10 * 1024 * 1024, 'file_hash': 'a' * 40, 'seq': 2},
+    ]
+
+    errors = syncer.handle_sync_push(changes, origin=origin, seq=2)
+
+    assert errors == []
+    _wait_for(lambda: failed)
+    assert [change['seq'] for change in failed] == [2]
+    assert os.path.isdir(str(sync_dir / 'd'))
+    assert not os.path.exists(str(sync_dir / 'd' / 'f'))
+    assert syncer.acks.ack_seq(origin) == 1
+
+
+def test_unacknowledged_changes_are_replayed(tmp_path):
+    """What a peer acknowledged is compacted out of the journal; the rest is replayed to it."""
+    peer = 'http://127.0.0.1:8102'
+    journal = accountant.TheAccountant(str(tmp_path / 'sync'), [peer], state_dir=str(tmp_path / 'state'),
+                                       segment_size=1)
+    changes = [_change(None, '/f{}'.format(n), origin=None) for n in range(1, 5)]
+    for change in changes:
+        journal.add_push_event([change])
+    acks = fetcher.AckTracker()
+    received = [dict(change, origin=ORIGIN) for change in changes]
+    acks.expect(received)
+    acks.received(ORIGIN, 4)
+    acks.applied(received[0])
+    acks.failed(received[1])
+    acks.applied(received[2])
+    acks.applied(received[3])
+
+    journal.ack(peer, acks.ack_seq(ORIGIN))
+    _wait_for(lambda: not os.path.exists(journal._segment_path(1)))
+
+    assert [change['src_path'] for change in journal.unacked(peer)] == ['/f2', '/f3', '/f4']
+
+
+@pytest.mark.parametrize('cut', [1, accountant.RECORD_HEADER.size + 3])
+def test_torn_record_is_cut_off_on_recovery(tmp_path, cut):
+    peer = 'http://127.0.0.1:8102'
+    kwargs = dict(sync_dir=str(tmp_path / 'sync'), peers=[peer], state_dir=str(tmp_path / 'state'))
+    journal = accountant.TheAccountant(**kwargs)
+    journal.add_push_event([_change(None, '/f1', origin=None), _change(None, '/f2', origin=None)])
+    # Saved by the writer thread, else the recovered journal takes the peer as new
+    _wait_for(lambda: os.path.exists(journal.acks_path))
+    path = journal._segment_path(1)
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - cut)
+
+    recovered = accountant.TheAccountant(**kwargs)
+    assert recovered.stats()['seq'] == 1
+    recovered.ack(peer, 0)
+    assert [change['src_path'] for change in recovered.unacked(peer)] == ['/f1']
+
+
+def test_corrupt_record_is_cut_off_on_recovery(tmp_path):
+    peer = 'http://127.0.0.1:8102'
+    kwargs = dict(sync_dir=str(tmp_path / 'sync'), peers=[peer], state_dir=str(tmp_path / 'state'))
+    journal = accountant.TheAccountant(**kwargs)
+    journal.add_push_event([_change(None, '/f1', origin=None), _change(None, '/f2', origin=None)])
+    path = journal._segment_path(1)
+    with open(path, 'r+b') as f:
+        f.seek(-2, os.SEEK_END)
+        f.write(b'!!')
+
+    recovered = accountant.TheAccountant(**kwargs)
+    assert recovered.stats()['seq'] == 1
@@ -0,0 +1,166 @@
+"""Resuming interrupted downloads only onto the same version of the file (user-007)."""
+import os
+import threading
+
+import pytest
+
+import shutil_dl
+from utils import temp_path_for
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+OLD = b'a' * 1000000
+NEW = b'b' * 1000000
+CUT_AFTER = 500000
+OLD_DATE = 'Mon, 05 Oct 2026 10:00:00 GMT'
+NEW_DATE = 'Mon, 05 Oct 2026 10:00:01 GMT'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    GET of the server's current version of the file, with byte ranges,
+    cutting the body short after `cut_after` bytes while that's set.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers.items()))
+        content, validators = server.content, server.validators
+        start = 0
+        byte_range = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if byte_range and (not server.honour_if_range or if_range in validators.values()):
+            start = int(byte_range.split('=')[1].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(content) - 1, len(content)))
+        else:
+            self.send_response(200)
+        for name, value in validators.items():
+            self.send_header(name, value)
+        body = content[start:]
+        self.send_header('Content-Length', str(len(body)))
+        if server.cut_after is not None:
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(body[:server.cut_after])
+            server.cut_after = None
+            self.close_connection = True
+            return
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def server():
+    httpd = _Server(('127.0.0.1', 0), _Handler)
+    httpd.requests = []
+    httpd.content = OLD
+    httpd.validators = {'Last-Modified': OLD_DATE}
+    httpd.honour_if_range = True
+    httpd.cut_after = None
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    httpd.url = 'http://127.0.0.1:{}/f'.format(httpd.server_address[1])
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _download(tmp_path, server, **kwargs):
+    return shutil_dl.download(str(tmp_path / 'f'), server.url, headers={'Accept-Encoding': 'identity'}, **kwargs)
+
+
+def _resumed_from(request):
+    """Offset a request asked for the rest of the file from, or 0."""
+    if 'Range' not in request:
+        return 0
+    return int(request['Range'].split('=')[1].rstrip('-'))
+
+
+def _read(path):
+    with open(str(path), 'rb') as f:
+        return f.read()
+
+
+def test_cut_short_is_resumed_with_its_validator(tmp_path, server, no_retry_delay):
+    server.cut_after = CUT_AFTER
+
+    result = _download(tmp_path, server)
+
+    assert result.success
+    assert _read(tmp_path / 'f') == OLD
+    assert 0 < _resumed_from(server.requests[1]) <= CUT_AFTER
+    assert server.requests[1]['If-Range'] == OLD_DATE
+    assert os.listdir(str(tmp_path)) == ['f']
+
+
+def test_left_behind_temp_file_is_resumed_by_a_later_call(tmp_path, server, no_retry_delay):
+    server.cut_after = CUT_AFTER
+    assert not _download(tmp_path, server, attempts=1).success
+    assert os.path.exists(temp_path_for(str(tmp_path / 'f') + shutil_dl.VALIDATOR_SUFFIX))
+
+    assert _download(tmp_path, server).success
+    assert _read(tmp_path / 'f') == OLD
+    assert 0 < _resumed_from(server.requests[-1]) <= CUT_AFTER
+    assert server.requests[-1]['If-Range'] == OLD_DATE
+
+
+def test_changed_file_is_fetched_whole(tmp_path, server, no_retry_delay):
+    server.cut_after = CUT_AFTER
+    assert not _download(tmp_path, server, attempts=1).success
+    server.content, server.validators = NEW, {'Last-Modified': NEW_DATE}
+
+    assert _download(tmp_path, server).success
+    assert _read(tmp_path / 'f') == NEW
+
+
+def test_range_of_another_version_isnt_spliced_on(tmp_path, server, no_retry_delay):
+    server.cut_after = CUT_AFTER
+    assert not _download(tmp_path, server, attempts=1).success
+    server.content, server.validators = NEW, {'Last-Modified': NEW_DATE}
+    server.honour_if_range = False
+
+    assert _download(tmp_path, server).success
+    assert _read(tmp_path / 'f') == NEW
+    assert _resumed_from(server.requests[-1]) == 0
+
+
+def test_without_validator_it_restarts_from_byte_0(tmp_path, server, no_retry_delay):
+    server.validators = {}
+    server.cut_after = CUT_AFTER
+
+    assert _download(tmp_path, server).success
+    assert _read(tmp_path / 'f') == OLD
+    assert _resumed_from(server.requests[1]) == 0
+
+
+def test_strong_etag_is_preferred(tmp_path, server, no_retry_delay):
+    server.validators = {'ETag': '"v1"', 'Last-Modified': OLD_DATE}
+    server.cut_after = CUT_AFTER
+
+    assert _download(tmp_path, server).success
+    assert server.requests[1]['If-Range'] == '"v1"'
+
+
+def test_weak_etag_isnt_used(tmp_path, server, no_retry_delay):
+    server.validators = {'ETag': 'W/"v1"', 'Last-Modified': OLD_DATE}
+    server.cut_after = CUT_AFTER
+
+    assert _download(tmp_path, server).success
+    assert server.requests[1]['If-Range'] == OLD_DATE
+
@@ -0,0 +1,93 @@
+"""The index of just synced paths, and the metrics, shared with forked and spawned processes (user-008)."""
+import json
+import multiprocessing
+import sys
+import time
+
+import pytest
+
+import accountant
+import metrics
+import simplesync
+import suppression
+
+HASH = '3f786850e387550fdab836ed7e6dc881de23001b'
+OTHER_HASH = '89e6c98d92887913cadf06b2adb97f26cde4849b'
+
+START_METHODS = [method for method in ('fork', 'spawn')
+                 if sys.version_info >= (3, 4) and method in multiprocessing.get_all_start_methods()]
+
+
+class TestSuppressionIndex(object):
+
+    def test_marked_path_is_suppressed_with_its_hash(self):
+        index = suppression.SuppressionIndex(capacity=64)
+        index.mark('d/f', HASH)
+        assert index.lookup('d/f') == suppression.hash_fingerprint(HASH)
+        assert index.lookup('d/f') != suppression.hash_fingerprint(OTHER_HASH)
+        assert index.lookup('d/g') is None
+
+    def test_marked_without_hash(self):
+        index = suppression.SuppressionIndex(capacity=64)
+        index.mark(u'd/\xe9')
+        assert index.lookup(u'd/\xe9') == suppression.NO_HASH
+
+    def test_remarking_replaces_the_hash(self):
+        index = suppression.SuppressionIndex(capacity=64)
+        index.mark('f', HASH)
+        index.mark('f', OTHER_HASH)
+        assert index.lookup('f') == suppression.hash_fingerprint(OTHER_HASH)
+
+    def test_expires_after_ttl(self, monkeypatch):
+        index = suppression.SuppressionIndex(capacity=64, ttl=5)
+        index.mark('f', HASH)
+        now = time.time()
+        monkeypatch.setattr(suppression.time, 'time', lambda: now + 6)
+        assert index.lookup('f') is None
+
+    def test_full_table_evicts_the_oldest(self):
+        index = suppression.SuppressionIndex(capacity=4)
+        for n in range(5):
+            index.mark('f{}'.format(n))
+        assert index.lookup('f4') == suppression.NO_HASH
+        assert sum(index.lookup('f{}'.format(n)) is not None for n in range(5)) == 4
+
+
+def _mark_and_count(syncer, metrics_shared, done):
+    metrics.attach(metrics_shared)
+    syncer.suppression.mark('from/child', HASH)
+    metrics.EVENTS_SUPPRESSED.inc(3)
+    done.put((len(syncer.acks._pending), syncer.accountant._pid))
+
+
+@pytest.fixture
+def start_method(request, monkeypatch):
+    """The start method of the processes, as set by a node's main module, with metrics not allocated yet."""
+    method = multiprocessing.get_start_method()
+    multiprocessing.set_start_method(request.param, force=True)
+    monkeypatch.setattr(metrics, '_shared', None)
+    yield request.param
+    multiprocessing.set_start_method(method, force=True)
+
+
+@pytest.mark.skipif(not START_METHODS, reason="needs multiprocessing start methods")
+@pytest.mark.parametrize('start_method', START_METHODS, indirect=True)
+def test_shared_with_started_process(conf_dir, state_dir, start_method):
+    """What a process started with the syncer marks and counts is seen by the one which started it."""
+    syncer = simplesync.Syncer(local_sync_dir=str(conf_dir), suppression=suppression.SuppressionIndex(capacity=64))
+    syncer.accountant = accountant.TheAccountant(syncer.local_sync_dir, syncer.peers)
+    syncer.acks.expect([{'seq': 1, 'origin': 'http://127.0.0.1:8102', 'src_path': '/f'}])
+    metrics.EVENTS_SUPPRESSED.inc()
+    done = multiprocessing.Queue()
+
+    process = multiprocessing.Process(target=_mark_and_count, args=(syncer, metrics.allocate(), done))
+    process.start()
+    pending, journal_pid = done.get(timeout=30)
+    process.join(30)
+
+    assert process.exitcode == 0
+    assert syncer.suppression.lookup('from/child') == suppression.hash_fingerprint(HASH)
+    assert json.loads(metrics.as_json())['simplesync_events_suppressed_total'] == 4
+    if start_method == 'spawn':
+        # What lives in the process using it is created afresh there, rather than copied
+        assert (pending, journal_pid) == (0, None)
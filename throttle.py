@@ -0,0 +1,166 @@
+"""
+Bandwidth and disk write limits of the fetches, and their priorities.
+
+Every received change gets a priority class (see priority): deletes, moves,
+dirs and small files come first, then other files, then files of at least
+conf.BULK_FILE_SIZE bytes, then the backlog, i.e. changes replayed from the
+journal or queued by a reconcile. The FetchQueue takes the changes ready to
+be applied in that order, and never has all its workers on bulk fetches.
+
+Fetches are paced through token buckets (see TokenBucket): one shared by
+all the fetches of the process (conf.MAX_DOWNLOAD_RATE), one per peer
+fetched from (conf.MAX_DOWNLOAD_RATE_PER_PEER), and one for the writes of
+fetched files to disk (conf.MAX_DISK_WRITE_RATE). Pacing a download just
+delays reading its next chunk, so the peer's sends are held up by TCP's
+flow control. A bucket gives precedence to higher priority fetches: as
+long as they use up its rate, lower priority ones wait.
+"""
+import os
+import threading
+import time
+
+from watchdog import events
+
+import conf
+import metrics
+
+PRIORITY_INTERACTIVE = 0  # Deletes, moves, dirs and files of up to conf.SMALL_FILE_SIZE bytes
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2  # Files of at least conf.BULK_FILE_SIZE bytes
+PRIORITY_BACKLOG = 3  # Changes replayed or reconciled, see Syncer and Reconciler
+PRIORITIES = 4
+
+BURST_SECONDS = 0.25  # A bucket lets this many seconds' worth of bytes through at once
+
+
+def priority(change):
+    """Priority class of a received change, the lower the sooner it's applied."""
+    if change.get('backlog'):
+        return PRIORITY_BACKLOG
+    if change['change_type'] not in (events.EVENT_TYPE_CREATED, events.EVENT_TYPE_MODIFIED) or change['is_dir']:
+        return PRIORITY_INTERACTIVE
+    size = change.get('size')
+    if size is None:
+        return PRIORITY_NORMAL  # Sent by a peer predating sizes in notifications
+    if size <= conf.SMALL_FILE_SIZE:
+        return PRIORITY_INTERACTIVE
+    return PRIORITY_BULK if size >= conf.BULK_FILE_SIZE else PRIORITY_NORMAL
+
+
+class TokenBucket(object):
+    """
+    Limits the bytes going through to `rate` per second, with bursts of up
+    to BURST_SECONDS worth of them.
+
+    Each priority class has the time by which the bytes reserved so far at
+    that class, or any higher one, will have gone through at the rate. A
+    reservation is scheduled after that, so higher priority ones are never
+    held up by lower priority ones, but push them back.
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self._lock = threading.Lock()
+        self._done_at = [0.0] * PRIORITIES
+
+    def reserve(self, amount, priority=PRIORITY_INTERACTIVE):
+        """Reserve `amount` bytes; returns the seconds to wait before they can go through."""
+        with self._lock:
+            now = time.time()
+            start = max([now] + self._done_at[:priority + 1])
+            self._done_at[priority] = start + amount / self.rate
+            return self._done_at[priority] - now - BURST_SECONDS
+
+
+class Limiter(object):
+    """Paces the fetches of a priority class through the buckets they go through."""
+
+    def __init__(self, priority=PRIORITY_INTERACTIVE, network=(), disk=()):
+        self.priority = priority
+        self.network = network
+        self.disk = disk
+
+    def _delay(self, buckets, amount):
+        return max([0] + [bucket.reserve(amount, self.priority) for bucket in buckets])
+
+    def network_delay(self, amount):
+        """Seconds to wait before receiving `amount` more bytes; for waiting on an event loop."""
+        return self._delay(self.network, amount)
+
+    def disk_delay(self, amount):
+        """Seconds to wait before writing `amount` more bytes; for waiting on an event loop."""
+        return self._delay(self.disk, amount)
+
+    def _wait(self, delay):
+        if delay > 0:
+            metrics.THROTTLED_SECONDS.inc(delay)
+            time.sleep(delay)
+
+    def receive(self, amount):
+        """Wait until `amount` more bytes can be received."""
+        if self.network:
+            self._wait(self.network_delay(amount))
+
+    def write(self, amount):
+        """Wait until `amount` more bytes can be written."""
+        if self.disk:
+            self._wait(self.disk_delay(amount))
+
+    def iter_received(self, chunks):
+        """Generate the chunks of a response body, paced."""
+        for chunk in chunks:
+            self.receive(len(chunk))
+            yield chunk
+
+    def writer(self, f):
+        """File object writing to f, paced."""
+        return _PacedWriter(f, self) if self.disk else f
+
+
+class _PacedWriter(object):
+
+    def __init__(self, f, limiter):
+        self._f = f
+        self._limiter = limiter
+
+    def write(self, data):
+        self._limiter.write(len(data))
+        return self._f.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+
+UNLIMITED = Limiter()
+
+_buckets = {}  # endpoint, or None for the shared bucket -> TokenBucket
+_disk_bucket = None
+_buckets_pid = None
+_lock = threading.Lock()
+
+
+def _bucket(key, rate):
+    if not rate:
+        return None
+    bucket = _buckets.get(key)
+    if bucket is None:
+        bucket = _buckets[key] = TokenBucket(rate)
+    return bucket
+
+
+def limiter_for(endpoint, priority):
+    """
+    Limiter of the fetches of a priority class from `endpoint`. Like the
+    transport sessions, buckets are never shared across processes.
+    """
+    global _buckets_pid, _disk_bucket
+    with _lock:
+        if _buckets_pid != os.getpid():
+            _buckets.clear()
+            _disk_bucket = TokenBucket(conf.MAX_DISK_WRITE_RATE) if conf.MAX_DISK_WRITE_RATE else None
+            _buckets_pid = os.getpid()
+        network = [bucket for bucket in (_bucket(None, conf.MAX_DOWNLOAD_RATE),
+                                         _bucket(endpoint, conf.MAX_DOWNLOAD_RATE_PER_PEER)) if bucket]
+    if not (network or _disk_bucket):
+        return UNLIMITED
+    return Limiter(priority, network, [_disk_bucket] if _disk_bucket else [])
@@ -0,0 +1,55 @@
+"""
+Long lived, pooled HTTP sessions.
+
+One requests.Session per remote endpoint is shared by the notifications
+and the file fetches to that endpoint, so connections are kept alive and
+reused instead of being set up again for every request.
+"""
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import conf
+
+# (connect, read) timeouts for every request made through these sessions
+TIMEOUT = (conf.CONNECT_TIMEOUT, conf.READ_TIMEOUT)
+
+_sessions = {}
+_sessions_pid = None
+_lock = threading.Lock()
+
+
+def _new_session(endpoint):
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=conf.POOL_SIZE,
+        pool_block=True,  # Wait for a free connection rather than opening extra ones
+    )
+    session.mount(endpoint, adapter)
+    return session
+
+
+def get_session(endpoint):
+    """
+    Return the shared session for `endpoint`, creating it on first use.
+
+    Sessions are never shared across processes: a forked child gets its
+    own pool instead of reusing the sockets of its parent.
+    """
+    global _sessions_pid
+    with _lock:
+        if _sessions_pid != os.getpid():
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+        session = _sessions.get(endpoint)
+        if session is None:
+            session = _sessions[endpoint] = _new_session(endpoint)
+        return session
+
+
+def backoff_delay(attempt):
+    """Seconds to wait before retrying after `attempt` failed attempts."""
+    return conf.RETRY_BACKOFF * (2 ** (attempt - 1))
@@ -1,12 +1,156 @@
+import atexit
+import copy
 import datetime
 import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+import conf
+
+LOG_WRITE_INTERVAL = 0.1
+# Types of log args which can't change before their record is formatted
+try:
+    IMMUTABLE_LOG_ARGS = (type(None), bool, int, long, float, basestring)  # Python 2
+except NameError:
+    IMMUTABLE_LOG_ARGS = (type(None), bool, int, float, str, bytes)
+# Types of log args which are shallow copied to keep them as they were
+COPIED_LOG_ARGS = (dict, list, set)
+
+
+class QueueingFileHandler(logging.Handler):
+    """
+    Log handler which only queues records; a writer thread wakes up every
+    LOG_WRITE_INTERVAL seconds to format and append them to the log file in
+    one go, so logging never waits on the disk, and messages are only
+    formatted off the logging thread. When max_size records are waiting
+    already, more are dropped, and how many were is logged once there's
+    room again.
+
+    A record with args which may change meanwhile, like a dict of a change
+    being applied, gets a shallow copy of them on the logging thread, so
+    that it shows them as they were when logged; args of other mutable
+    types have the message merged with them there instead (as
+    logging.handlers.QueueHandler does).
+
+    Each process gets its own queue and writer thread, as threads don't
+    survive a fork.
+    """
+
+    def __init__(self, path, max_size=10000):
+        logging.Handler.__init__(self)
+        self.path = path
+        self.max_size = max_size
+        self.dropped = 0
+        self._pid = None
+
+    def _start(self):
+        self._records = deque()
+        self._pid = os.getpid()
+        writer = threading.Thread(target=self._write_forever, name='log-writer')
+        writer.daemon = True
+        writer.start()
+        atexit.register(self._write_queued)
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            with self.lock:
+                if self._pid != os.getpid():
+                    self._start()
+        # Appending to a deque is atomic, so no lock is needed
+        if len(self._records) < self.max_size:
+            if record.args and not all(isinstance(arg, IMMUTABLE_LOG_ARGS) for arg in self._args(record)):
+                try:
+                    record = self._snapshot(record)
+                except Exception:
+                    self.handleError(record)
+                    return
+            self._records.append(record)
+        else:
+            self.dropped += 1
+
+    @staticmethod
+    def _args(record):
+        return record.args if isinstance(record.args, tuple) else (record.args,)
+
+    @staticmethod
+    def _snapshot(record):
+        """Copy of a record with its args as they are now."""
+        record = copy.copy(record)
+        if isinstance(record.args, COPIED_LOG_ARGS):
+            record.args = copy.copy(record.args)
+        elif all(isinstance(arg, IMMUTABLE_LOG_ARGS + COPIED_LOG_ARGS) for arg in record.args):
+            record.args = tuple(copy.copy(arg) if isinstance(arg, COPIED_LOG_ARGS) else arg
+                                for arg in record.args)
+        else:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def _write_forever(self):
+        while True:
+            time.sleep(LOG_WRITE_INTERVAL)
+            self._write_queued()
+
+    def _write_queued(self):
+        records = []
+        try:
+            while True:
+                records.append(self._records.popleft())
+        except IndexError:
+            pass
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            records.append(logging.makeLogRecord({
+                'name': 'simplesync', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'msg': "LOG: dropped %d records, as too many were waiting to be written",
+                'args': (dropped,)}))
+        if not records:
+            return
+        lines = []
+        for queued in records:
+            try:
+                line = self.format(queued) + '\n'
+            except Exception:
+                self.handleError(queued)
+                continue
+            if not isinstance(line, str):
+                line = line.encode('utf-8')  # Python 2 unicode
+            lines.append(line)
+        try:
+            with open(self.path, 'a') as f:
+                f.write(''.join(lines))
+        except EnvironmentError:
+            self.handleError(records[0])
+
+
+# Don't collect what the log format doesn't show, see Optimization in the logging docs
+logging._srcfile = None
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
 
 logger = logging.getLogger('simplesync')
-hdlr = logging.FileHandler('/tmp/simplesync.log')
+hdlr = QueueingFileHandler(conf.LOG_PATH, conf.LOG_QUEUE_SIZE)
 formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
 hdlr.setFormatter(formatter)
 logger.addHandler(hdlr)
-logger.setLevel(logging.INFO)
+logger.setLevel(getattr(logging, conf.LOG_LEVEL.upper()))
+
+# Partially transferred files are written to hidden files with this suffix,
+# next to their final path, and renamed into place once complete.
+TEMP_SUFFIX = '.simplesync-part'
+
+
+def temp_path_for(file_path):
+    head, tail = os.path.split(file_path)
+    return os.path.join(head, '.' + tail + TEMP_SUFFIX)
+
+
+def is_temp_path(file_path):
+    tail = os.path.basename(file_path)
+    return tail.startswith('.') and tail.endswith(TEMP_SUFFIX)
 
 
 class QuickLog(object):
@@ -33,7 +177,55 @@ class ResponseSaved(object):
         self.error = kwargs.get('error', False)  # To pass exceptions
         self.error_message = kwargs.get('error_message', '')  # To pass custom error message
         self.not_ok_reason = kwargs.get('not_ok_reason', '')  # response.reason
+        self.bytes_transferred = kwargs.get('bytes_transferred', 0)  # bytes received over the wire
+        self.bytes_saved = kwargs.get('bytes_saved', 0)  # bytes not transferred thanks to delta sync
 
     def __unicode__(self):
         return "{}-{}-{}-{}-{}".format(self.success, self.saved_to, self.time_taken,
                                        self.error, self.error_message, self.not_ok_reason)
+
+
+class ExpiringTimestamps(object):
+    """
+    Last seen timestamp per key, along with what it was seen with (e.g. a
+    version of the file it's of), bounded in both age and number of keys.
+
+    Keys are kept in least recently seen order, so expired keys are always
+    at the front and are dropped as new ones come in; past max_len keys,
+    the least recently seen key is evicted even if it hasn't expired yet.
+    """
+
+    def __init__(self, max_len=10000, max_age=60):
+        self.max_len = max_len
+        self.max_age = max_age
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self.expired = 0  # Keys dropped for being older than max_age
+        self.evicted = 0  # Keys dropped for going over max_len
+
+    def __len__(self):
+        return len(self._seen)
+
+    def seen_within(self, key, now, seconds, value=None):
+        """Whether key was last seen, with the same value, no more than `seconds` before now."""
+        with self._lock:
+            last_seen, last_value = self._seen.get(key, (None, None))
+        return last_seen is not None and last_seen >= now - seconds and last_value == value
+
+    def touch(self, key, now, value=None):
+        """Record key as seen at now, with value."""
+        with self._lock:
+            self._seen.pop(key, None)
+            self._seen[key] = now, value
+            while self._seen:
+                oldest_key = next(iter(self._seen))
+                if self._seen[oldest_key][0] >= now - self.max_age:
+                    break
+                del self._seen[oldest_key]
+                self.expired += 1
+            while len(self._seen) > self.max_len:
+                self._seen.popitem(last=False)
+                self.evicted += 1
+
+    def stats(self):
+        return {'size': len(self._seen), 'expired': self.expired, 'evicted': self.evicted}
@@ -0,0 +1,406 @@
+"""
+The watchdog observers watching a sync dir, and their supervision.
+
+Native observers (inotify on Linux) need a watch per directory, and a user
+can only have so many of them (fs.inotify.max_user_watches). Past that,
+watchdog fails to watch a tree, or silently leaves out the dirs created
+later. The kernel also drops the events of a watch whose queue overflows,
+which watchdog skips without a word. Either way changes go unnoticed.
+
+So, with conf.OBSERVER_BACKEND:
+    auto     - The dirs are counted first. A tree needing at most
+               conf.MAX_WATCHES watches is watched natively; a larger one is
+               watched in a hybrid mode: its most recently active top level
+               subtrees that fit are watched natively, and the rest of the
+               tree is polled, i.e. swept every conf.POLL_INTERVAL seconds,
+               comparing the stat of every file with the previous sweep's.
+    native   - The tree is watched natively, without counting its dirs.
+    polling  - The whole tree is polled, e.g. on network filesystems.
+
+Whenever the watch limit is hit anyway, by a native watch or a dir created
+under one later, that subtree falls back to polling. After an overflow, or
+such a fallback, the subtree is rescanned: it's compared to a snapshot
+taken when things last were quiet, and the differences are handled as
+events, so no change is lost. Metrics count how often each of these happens.
+
+Paths not to sync (see ignore.py) are left out of the dir counts, the
+subtrees watched natively, the polling sweeps and the snapshots. A native
+watch of a whole tree still covers the ignored dirs in it, as watchdog
+can't leave subtrees out of a recursive watch.
+"""
+import errno
+import inspect
+import os
+import sys
+import threading
+import time
+
+from watchdog import events
+from watchdog.observers import Observer
+from watchdog.observers.polling import PollingObserverVFS
+from watchdog.utils.dirsnapshot import DirectorySnapshot, DirectorySnapshotDiff
+
+try:
+    from os import scandir
+except ImportError:
+    # Python 2
+    from scandir import scandir
+
+import conf
+import metrics
+from utils import logger
+
+if sys.platform.startswith('linux'):
+    from watchdog.observers import inotify_c
+else:
+    inotify_c = None
+
+WATCH_LIMIT_PATH = '/proc/sys/fs/inotify/max_user_watches'
+SUPERVISE_INTERVAL = 1
+# The snapshots rescans compare to are taken again once there were events,
+# and then none for SNAPSHOT_QUIET seconds, at most every SNAPSHOT_INTERVAL
+SNAPSHOT_QUIET = 5
+SNAPSHOT_INTERVAL = 30
+
+OVERFLOW = 'overflow'
+WATCH_LIMIT = 'watch limit'
+
+_reading = threading.local()  # .path of the inotify watch read by this thread
+_reports = []  # (OVERFLOW or WATCH_LIMIT, path of the watch) since the last check
+_reports_lock = threading.Lock()
+
+
+def _is_watch_limit(e):
+    # Older watchdog versions raise these without an errno
+    return e.errno in (errno.ENOSPC, errno.EMFILE) or 'limit reached' in str(e)
+
+
+def _report(kind, path):
+    if path is None:
+        return  # Not read from a watch, e.g. while scheduling one; its caller gets the error
+    if not isinstance(path, str):
+        path = os.fsdecode(path)
+    with _reports_lock:
+        _reports.append((kind, path))
+
+
+def _hook_inotify():
+    """
+    Have watchdog's inotify reader report the queue overflows and watch limit
+    errors it otherwise drops, along with the path of the watch concerned.
+    """
+    Inotify = inotify_c.Inotify
+    if getattr(Inotify, 'simplesync_hooked', False):
+        return
+    read_events = Inotify.read_events
+    parse_event_buffer = Inotify._parse_event_buffer
+    raise_error = Inotify._raise_error
+
+    def hooked_read_events(self, *args, **kwargs):
+        _reading.path = self.path
+        return read_events(self, *args, **kwargs)
+
+    def hooked_parse_event_buffer(event_buffer):
+        for wd, mask, cookie, name in parse_event_buffer(event_buffer):
+            if mask & inotify_c.InotifyConstants.IN_Q_OVERFLOW:
+                _report(OVERFLOW, getattr(_reading, 'path', None))
+            yield wd, mask, cookie, name
+
+    def hooked_raise_error():
+        try:
+            raise_error()
+        except OSError as e:
+            if _is_watch_limit(e):
+                _report(WATCH_LIMIT, getattr(_reading, 'path', None))
+            raise
+
+    Inotify.read_events = hooked_read_events
+    Inotify._parse_event_buffer = staticmethod(hooked_parse_event_buffer)
+    Inotify._raise_error = staticmethod(hooked_raise_error)
+    Inotify.simplesync_hooked = True
+
+
+def watch_budget():
+    """Native watches a sync dir may use: conf.MAX_WATCHES, else half the user's limit, if known."""
+    if conf.MAX_WATCHES:
+        return conf.MAX_WATCHES
+    try:
+        with open(WATCH_LIMIT_PATH) as f:
+            return int(f.read()) // 2
+    except (EnvironmentError, ValueError):
+        return None
+
+
+def _count_dirs(path, skip=None):
+    """
+    (number of dirs, latest mtime of those under it) of the tree under path,
+    itself included, short of the dirs `skip` is true for and what's under them.
+    """
+    count = 0
+    latest = 0
+    stack = [path]
+    while stack:
+        count += 1
+        try:
+            entries = list(scandir(stack.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False) and not (skip and skip(entry.path)):
+                stack.append(entry.path)
+                try:
+                    latest = max(latest, entry.stat(follow_symlinks=False).st_mtime)
+                except OSError:
+                    pass
+    return count, latest
+
+
+def _default_listdir():
+    """The listdir DirectorySnapshot uses: os.listdir, or os.scandir in newer watchdog versions."""
+    try:
+        spec = inspect.getfullargspec(DirectorySnapshot.__init__)
+    except AttributeError:
+        # Python 2
+        spec = inspect.getargspec(DirectorySnapshot.__init__)
+    return spec.defaults[spec.args.index('listdir') - len(spec.args)]
+
+
+def _entry_is_dir(dir_path, entry):
+    """Whether a listdir entry, a name or a DirEntry, is a dir."""
+    if not hasattr(entry, 'is_dir'):
+        return os.path.isdir(os.path.join(dir_path, entry))
+    try:
+        return entry.is_dir(follow_symlinks=False)
+    except OSError:
+        return False
+
+
+def diff_events(ref, snapshot):
+    """Generate the events turning snapshot `ref` into `snapshot`, as a polling observer would."""
+    diff = DirectorySnapshotDiff(ref, snapshot)
+    for path in diff.files_deleted:
+        yield events.FileDeletedEvent(path)
+    for path in diff.dirs_deleted:
+        yield events.DirDeletedEvent(path)
+    for path in diff.dirs_created:
+        yield events.DirCreatedEvent(path)
+    for path in diff.files_created:
+        yield events.FileCreatedEvent(path)
+    for path in diff.files_modified:
+        yield events.FileModifiedEvent(path)
+    for src_path, dest_path in diff.dirs_moved:
+        yield events.DirMovedEvent(src_path, dest_path)
+    for src_path, dest_path in diff.files_moved:
+        yield events.FileMovedEvent(src_path, dest_path)
+
+
+class Watchers(object):
+    """The observers watching a sync dir, see the module docstring."""
+
+    def __init__(self, handler, path, recursive=False, backend=None, daemon=False, ignore=None):
+        """
+        ignore: Callable giving the current IgnoreRules of the paths not to
+                sync (see ignore.py), relative to path; None to watch them all.
+        """
+        self.handler = handler
+        self.path = path
+        self.recursive = recursive
+        self.backend = backend or conf.OBSERVER_BACKEND
+        self.daemon = daemon
+        self.ignore = ignore
+        self.native = None
+        self.polling = None
+        self._native_watches = {}  # path -> watch of each subtree watched natively
+        self._snapshots = {}  # path -> DirectorySnapshot of a subtree watched natively
+        self._excluded = set()  # Subtrees left out of the polling of self.path
+        self._last_event_at = 0
+        self._snapshot_at = 0
+        self._listdir = _default_listdir()
+
+    def dispatch(self, event):
+        """Hand an event of an observer to the handler, noting when it came."""
+        self._last_event_at = time.time()
+        self.handler.dispatch(event)
+
+    def _rules(self):
+        return self.ignore() if self.ignore else None
+
+    def _is_ignored_dir(self, path):
+        rules = self._rules()
+        return bool(rules) and rules.match(path[len(self.path):], is_dir=True)
+
+    def _unignored(self, dir_path, entries):
+        """The listdir entries of dir_path short of the ignored ones."""
+        rules = self._rules()
+        if not rules:
+            return entries
+        rel_dir = dir_path[len(self.path):]
+        return [entry for entry in entries
+                if not rules.match(rel_dir + '/' + getattr(entry, 'name', entry), _entry_is_dir(dir_path, entry))]
+
+    def _plan(self):
+        """Subtrees to watch natively; the rest of the tree is polled."""
+        if self.backend == 'polling':
+            return []
+        budget = watch_budget()
+        if self.backend == 'native' or not self.recursive or budget is None:
+            return [self.path]
+        subtrees = []  # (latest dir mtime, dirs, path)
+        for entry in scandir(self.path):
+            if entry.is_dir(follow_symlinks=False) and not self._is_ignored_dir(entry.path):
+                count, latest = _count_dirs(entry.path, skip=self._is_ignored_dir)
+                subtrees.append((max(latest, entry.stat(follow_symlinks=False).st_mtime), count, entry.path))
+        needed = 1 + sum(count for _, count, _ in subtrees)
+        if needed <= budget:
+            return [self.path]
+        native = []
+        for _, count, path in sorted(subtrees, reverse=True):
+            if count <= budget:
+                native.append(path)
+                budget -= count
+        metrics.WATCH_LIMIT_HITS.inc()
+        metrics.POLLING_FALLBACKS.inc(len(subtrees) - len(native))
+        logger.warning("WATCHERS: %s needs %s watches, over the budget of %s; watching %s of its %s "
+                       "subtrees natively, polling the rest", self.path, needed, watch_budget(),
+                       len(native), len(subtrees))
+        return native
+
+    def start(self):
+        if inotify_c:
+            _hook_inotify()
+        native = self._plan()
+        self.native = Observer()
+        self.native.daemon = self.daemon
+        self.native.start()
+        for path in native:
+            self._watch_natively(path)
+        if self.path not in self._native_watches:
+            self._excluded = set(self._native_watches)
+            self._poll(self.path)
+        supervisor = threading.Thread(target=self._supervise, name='watch-supervisor')
+        supervisor.daemon = True
+        supervisor.start()
+
+    def stop(self):
+        for observer in (self.native, self.polling):
+            if observer:
+                observer.stop()
+
+    def _watch_natively(self, path):
+        try:
+            self._native_watches[path] = self.native.schedule(self, path, recursive=self.recursive)
+        except OSError as e:
+            if not _is_watch_limit(e):
+                raise
+            metrics.WATCH_LIMIT_HITS.inc()
+            metrics.POLLING_FALLBACKS.inc()
+            logger.warning("WATCHERS: %s watching %s natively, polling it instead", e, path)
+
+    def _listdir_unignored(self, path):
+        return self._unignored(path, list(self._listdir(path)))
+
+    def _listdir_polled(self, path):
+        return [entry for entry in self._listdir_unignored(path)
+                if os.path.join(path, getattr(entry, 'name', entry)) not in self._excluded]
+
+    def _poll(self, path):
+        if self.polling is None:
+            self.polling = PollingObserverVFS(os.stat, self._listdir_polled, polling_interval=conf.POLL_INTERVAL)
+            self.polling.daemon = self.daemon
+            self.polling.start()
+        self.polling.schedule(self, path, recursive=self.recursive)
+
+    def _snapshot(self, path):
+        try:
+            return DirectorySnapshot(path, self.recursive, listdir=self._listdir_unignored)
+        except OSError as e:
+            logger.warning("WATCHERS: couldn't snapshot %s: %s", path, e)
+            return None
+
+    def _supervise(self):
+        # Taken after the native watches started, so no change falls in between
+        self.refresh_snapshots()
+        while True:
+            time.sleep(SUPERVISE_INTERVAL)
+            try:
+                self.check()
+                now = time.time()
+                if (self._last_event_at > self._snapshot_at and now - self._last_event_at >= SNAPSHOT_QUIET and
+                        now - self._snapshot_at >= SNAPSHOT_INTERVAL):
+                    self.refresh_snapshots()
+            except Exception as e:
+                logger.exception("WATCHERS: supervision failed: %s", e)
+
+    def refresh_snapshots(self):
+        """
+        Snapshot the subtrees watched natively again, so that a rescan only
+        finds what changed since. A snapshot is kept if an overflow of its
+        watch was reported while it was being taken, as the new one may then
+        include changes whose events were lost.
+        """
+        self._snapshot_at = time.time()
+        for path in list(self._native_watches):
+            snapshot = self._snapshot(path)
+            with _reports_lock:
+                overflowed = (OVERFLOW, path) in _reports
+            if not overflowed and path in self._native_watches:
+                self._snapshots[path] = snapshot
+
+    def _emitter_alive(self, watch):
+        return any(emitter.is_alive() for emitter in self.native.emitters if emitter.watch == watch)
+
+    def check(self):
+        """Handle the overflows and watch limit errors reported, and the native watches which stopped."""
+        with _reports_lock:
+            reports = _reports[:]
+            del _reports[:]
+        # A burst overflows a queue over and over; one rescan covers it all
+        for kind, path in sorted(set(reports)):
+            if path not in self._native_watches:
+                continue  # Fallen back to polling already
+            if kind == OVERFLOW:
+                metrics.QUEUE_OVERFLOWS.inc()
+                logger.warning("WATCHERS: event queue of %s overflowed, rescanning it", path)
+                self.rescan(path)
+            else:
+                metrics.WATCH_LIMIT_HITS.inc()
+                self._fall_back(path, "inotify watch limit reached under")
+        for path, watch in list(self._native_watches.items()):
+            if not self._emitter_alive(watch):
+                self._fall_back(path, "native watch stopped on")
+
+    def rescan(self, path):
+        """Handle the differences between a subtree and its last snapshot as events."""
+        metrics.RESCANS.inc()
+        ref = self._snapshots.get(path)
+        snapshot = self._snapshots[path] = self._snapshot(path)
+        if ref is None or snapshot is None:
+            logger.warning("WATCHERS: no snapshot of %s to tell what changed in it", path)
+            return
+        found = 0
+        for event in diff_events(ref, snapshot):
+            self.handler.dispatch(event)
+            found += 1
+        metrics.RESCANNED_CHANGES.inc(found)
+        logger.info("WATCHERS: rescanned %s, %s changes found", path, found)
+
+    def _fall_back(self, path, reason):
+        """Poll a subtree watched natively until now, catching up on what its watch missed."""
+        metrics.POLLING_FALLBACKS.inc()
+        watch = self._native_watches.pop(path)
+        try:
+            self.native.unschedule(watch)
+        except (KeyError, OSError):
+            pass
+        if not os.path.isdir(path):
+            # Deleted; polled along with the rest of the tree if it's created again
+            logger.warning("WATCHERS: %s %s, which is gone", reason, path)
+            self._excluded.discard(path)
+            self._snapshots.pop(path, None)
+            return
+        logger.warning("WATCHERS: %s %s, polling it instead", reason, path)
+        # Polling starts from a snapshot of its own, so the rescan after it
+        # covers everything up to that one
+        self._poll(path)
+        self.rescan(path)
+        self._snapshots.pop(path, None)
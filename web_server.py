@@ -2,7 +2,9 @@ import argparse
 import datetime
 import json
 import os
+import re
 import sys
+import threading
 import time
 
 try:
@@ -10,85 +12,424 @@ try:
     from http.server import SimpleHTTPRequestHandler
     import http.server as BaseHTTPServer
     import socketserver as SocketServer
+    from urllib.parse import quote
 except ImportError:
     # Python 2
     import BaseHTTPServer
     import SocketServer
     from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from urllib import quote
 
+import bundle
+import conf
+import content_encoding
+import delta
+import metrics
+import push
+import reconcile
+import startup
+from fetcher import QueueFull
 from utils import logger
 
+CHUNK_WRITE_SIZE = 64 * 1024
 
-class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler, SimpleHTTPRequestHandler):
+
+def parse_range(range_header, size):
+    """
+    (start, end) byte offsets of a single `Range: bytes=start-[end]` (or
+    suffix `bytes=-length`) within a file of `size` bytes. None if the header
+    isn't such a range. The range can't be satisfied if start >= size or start > end.
+    """
+    match = re.match(r'bytes=(\d*)-(\d*)$', range_header.strip())
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if first:
+        return int(first), min(int(last), size - 1) if last else size - 1
+    return max(size - int(last), 0), size - 1
+
+
+def sync_response_headers():
+    """Headers of REQSYNC responses telling what the notifier may send next."""
+    headers = {'Accept-Encoding': content_encoding.accept_encoding()}
+    if conf.PUSH_MAX_SIZE:
+        headers[push.PUSH_HEADER] = str(conf.PUSH_MAX_SIZE)
+    return headers
+
+
+def origin_endpoint(client_ip, data):
+    """
+    Endpoint the changes of a REQSYNC are to be fetched from: the notifier's
+    address, on the port it said it serves on. Pops that from the data.
+    """
+    origin_port = data.pop('origin_port', None) if isinstance(data, dict) else None
+    if not origin_port:
+        return None
+    return "http://{}:{}".format(client_ip, int(origin_port))
+
+
+class RequestHandler(SimpleHTTPRequestHandler):
     """
     Basic HTTP webserver request handler with custom request REQSYNC method handling.
     https://stackoverflow.com/questions/31371166/reading-json-from-simplehttpserver-post-data
 
-    BaseHTTPRequestHandler - for implementing custom request method handler.
+    BaseHTTPRequestHandler (through SimpleHTTPRequestHandler) - for implementing custom request method handler.
     SimpleHTTPRequestHandler - for using its default GET handler which is well polished.
+
+    Speaks HTTP/1.1 so that peers can keep their pooled connections alive;
+    every response therefore has to carry a Content-Length.
     """
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; with Nagle's algorithm on,
+    # the body of a small response waits for the peer's delayed ACK (~40ms)
+    disable_nagle_algorithm = True
+
+    def parse_request(self):
+        """Also refuse bodies larger than conf.MAX_BODY_SIZE, before any of them is read."""
+        if not SimpleHTTPRequestHandler.parse_request(self):
+            return False
+        if int(self.headers.get('Content-Length') or 0) > conf.MAX_BODY_SIZE:
+            # Closes the connection, with the body left unread
+            self.send_error(413, "Request body too large")
+            return False
+        return True
+
+    def do_GET(self):
+        response = metrics.response_for(self.path)
+        if response:
+            self._send_body(200, *response)
+            return
+        SimpleHTTPRequestHandler.do_GET(self)
+
+    def send_head(self):
+        """
+        SimpleHTTPRequestHandler.send_head with support for a single
+        `Range: bytes=start-[end]` (or suffix `bytes=-length`) request, so
+        interrupted downloads can be resumed. An If-Range not matching the
+        file's Last-Modified gets the whole file, as do directories.
+
+        Whole files are compressed on the fly if negotiated (see content_encoding.py).
+        """
+        self._range_remaining = None
+        self._compress_with = None
+        range_header = self.headers.get('Range')
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            return SimpleHTTPRequestHandler.send_head(self)
+        if not range_header:
+            return self._send_full_head(path)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            self.send_error(404, "File not found")
+            return None
+
+        fs = os.fstat(f.fileno())
+        size = fs.st_size
+        last_modified = self.date_time_string(fs.st_mtime)
+        if_range = self.headers.get('If-Range')
+        byte_range = parse_range(range_header, size)
+        if byte_range is None or (if_range and if_range != last_modified):
+            f.close()
+            return self._send_full_head(path)
+
+        start, end = byte_range
+        if start >= size or start > end:
+            f.close()
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */{}'.format(size))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+
+        self.send_response(206)
+        self.send_header('Content-type', self.guess_type(path))
+        self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Last-Modified', last_modified)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        f.seek(start)
+        self._range_remaining = end - start + 1
+        return f
+
+    def _send_full_head(self, path):
+        """Headers for a whole file; compressed and chunked if negotiated."""
+        encoding = content_encoding.negotiate(self.headers.get('Accept-Encoding'))
+        if not encoding or not content_encoding.is_compressible(path):
+            return SimpleHTTPRequestHandler.send_head(self)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            self.send_error(404, "File not found")
+            return None
+        fs = os.fstat(f.fileno())
+        if fs.st_size < conf.COMPRESSION_MIN_SIZE:
+            f.close()
+            return SimpleHTTPRequestHandler.send_head(self)
+
+        self.send_response(200)
+        self.send_header('Content-type', self.guess_type(path))
+        self.send_header('Content-Encoding', encoding)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Last-Modified', self.date_time_string(fs.st_mtime))
+        self.send_header('Accept-Ranges', 'bytes')
+        # Uncompressed size, so the receiver can tell whether it got everything
+        self.send_header('X-Simplesync-Size', str(fs.st_size))
+        self.end_headers()
+        self._compress_with = encoding
+        return f
+
+    def copyfile(self, source, outputfile):
+        """
+        Copy only the requested range, if send_head served a range request,
+        or compress the file on the fly if send_head negotiated that.
+        """
+        if getattr(self, '_compress_with', None):
+            compressor = content_encoding.compressor(self._compress_with)
+            while True:
+                data = source.read(CHUNK_WRITE_SIZE)
+                if not data:
+                    break
+                self._write_chunk(compressor.compress(data))
+            self._write_chunk(compressor.flush())
+            self._end_chunked()
+            return
+        remaining = getattr(self, '_range_remaining', None)
+        if remaining is None:
+            return SimpleHTTPRequestHandler.copyfile(self, source, outputfile)
+        while remaining > 0:
+            data = source.read(min(CHUNK_WRITE_SIZE, remaining))
+            if not data:
+                break
+            outputfile.write(data)
+            remaining -= len(data)
 
-    def _process_sync_request(self, data):
+    def _process_sync_request(self, data, origin=None, pushed=(), seq=None):
         """For processing a remote sync request.
         >> Trigger sync
         >> Record transaction in DB
         >> sync-ack for confirming a successful sync or log failure
         """
-        # Call transporter to push this event's notification to remote
-        # Also, not creating a new thread, because this webserver handles each
-        # client request in a separate thread already, so no worries of blocking other requests.
-        # TODO Record this event in local DB for syn-ack
+        # Changes are only queued here; the syncer's fetch workers apply them,
+        # so the response doesn't have to wait for the files to be downloaded.
+        # Once applied they're acknowledged, by the notifier's journal seq, in
+        # the response to a later notification if not this one.
 
-        return self.server.syncer.handle_sync_push(data)
+        return self.server.syncer.handle_sync_push(data, origin, pushed, seq)
 
     def do_REQSYNC(self):
-        self.data_string = self.rfile.read(int(self.headers['Content-Length']))
-        data = json.loads(self.data_string)
+        start = time.time()
+        try:
+            self._handle_reqsync()
+        finally:
+            metrics.REQSYNC_SECONDS.observe(time.time() - start)
+
+    def do_REQPUSH(self):
+        """
+        A REQSYNC followed by the content of changed files (see push.py),
+        which are written to temp files as they're read.
+        """
+        start = time.time()
+        try:
+            self._handle_reqsync(with_files=True)
+        finally:
+            metrics.REQSYNC_SECONDS.observe(time.time() - start)
+
+    def _handle_reqsync(self, with_files=False):
+        if with_files:
+            data, pushed = push.decode(push.limited(self.rfile.read, int(self.headers['Content-Length'])))
+        else:
+            self.data_string = self.rfile.read(int(self.headers['Content-Length']))
+            if self.headers.get('Content-Encoding'):
+                try:
+                    self.data_string = content_encoding.decompress(self.headers['Content-Encoding'], self.data_string,
+                                                                   conf.MAX_BODY_SIZE)
+                except content_encoding.TooLarge as e:
+                    self._send_json(413, {'errors': [str(e)]})
+                    return
+            data = json.loads(self.data_string)
+            pushed = ()
 
         # Now here we take action on the sync notification
         # We call the syncer's action method which will decide
         # whether to fetch the sync file (create/update) or just do local mod (delete/moved)
 
-        logger.info("WEBSERVER: RECEIVED REQSYNC: {}\n".format(data))
-        errors = self._process_sync_request(data)
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json')
-        self.end_headers()
+        logger.debug("WEBSERVER: RECEIVED REQSYNC: %s", data)
+        origin = origin_endpoint(self.client_address[0], data)
+        seq = data.get('seq') if isinstance(data, dict) else None
+        if isinstance(data, dict) and 'changes' in data:
+            # Batched notification; changes are applied in order
+            data = data['changes']
+        try:
+            errors = self._process_sync_request(data, origin, pushed, seq)
+        except QueueFull:
+            metrics.REQSYNC_REFUSED.inc()
+            logger.warning("WEBSERVER: fetch queue full, REQSYNC refused")
+            self._send_json(503, {'errors': ['Fetch queue full']},
+                            headers={'Retry-After': str(conf.BUSY_RETRY_AFTER)})
+            return
         resp_data = {'errors': errors}
-        logger.info("WEBSERVER: PROCESSED REQSYNC; errors: {}\n##############################\n".format(errors))
+        logger.info("WEBSERVER: PROCESSED %s of %s changes from %s; errors: %s",
+                    self.command, len(data) if isinstance(data, list) else 1, origin, errors)
         if self.server.send_ack:
             # to notify notifier when the notification was processed.
             resp_data['ack'] = time.time()
+            # and up to which journal seq its changes were applied
+            ack_seq = self.server.syncer.acks.ack_seq(origin)
+            if ack_seq is not None:
+                resp_data['ack_seq'] = ack_seq
         else:
             # Return the data received
             resp_data['data'] = data
-        self.wfile.write(json.dumps(resp_data))
+        # Let the notifier know which encodings it can compress notifications
+        # with, and how many bytes of files it can push along
+        self._send_json(200, resp_data, headers=sync_response_headers())
+
+    def do_REQDELTA(self):
+        """
+        Send the delta between the requested file and the block
+        signatures of the requester's copy of it (see delta.py).
+        Request body: {'path': '/dir/file', 'block_size': 4096, 'signatures': [[weak, strong], ...]}
+        """
+        data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        file_path = self.translate_path(quote(data['path']))
+        try:
+            source = open(file_path, 'rb')
+        except IOError:
+            self.send_error(404, "File not found")
+            return
+
+        with source:
+            self._start_chunked(200, 'application/octet-stream')
+            buffered = []
+            buffered_size = 0
+            for op, value in delta.delta_ops(source, data['signatures'], data['block_size']):
+                encoded = delta.encode_op(op, value)
+                buffered.append(encoded)
+                buffered_size += len(encoded)
+                if buffered_size >= CHUNK_WRITE_SIZE:
+                    self._write_chunk(b''.join(buffered))
+                    buffered = []
+                    buffered_size = 0
+            self._write_chunk(b''.join(buffered))
+            self._end_chunked()
+
+    def do_REQBUNDLE(self):
+        """
+        Send several small files in one stream (see bundle.py).
+        Request body: {'paths': ['/dir/file', ...]}
+        """
+        data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self._start_chunked(200, 'application/octet-stream')
+        buffered = []
+        buffered_size = 0
+        for frame in bundle.frames(data['paths'], lambda path: self.translate_path(quote(path)),
+                                   conf.BUNDLE_MAX_FILE_SIZE):
+            buffered.append(frame)
+            buffered_size += len(frame)
+            if buffered_size >= CHUNK_WRITE_SIZE:
+                self._write_chunk(b''.join(buffered))
+                buffered = []
+                buffered_size = 0
+        self._write_chunk(b''.join(buffered))
+        self._end_chunked()
+
+    def do_REQLIST(self):
+        """
+        Stream the sorted listing of the whole sync dir (see reconcile.py),
+        one JSON [rel_path, is_dir, size, mtime, file_hash] per line. The
+        hash is only included if it's known without hashing the file.
+        Ignored paths (see ignore.py) are left out.
+        """
+        manifest = self.server.syncer.manifest
+        self._start_chunked(200, 'application/x-ndjson')
+        buffered = []
+        buffered_size = 0
+        for rel_path, is_dir, size, mtime in reconcile.walk_sorted(self.translate_path('/'),
+                                                                    ignore=self.server.syncer.ignore):
+            file_hash = None if is_dir else manifest.peek(rel_path, size, mtime)
+            line = json.dumps([rel_path, is_dir, size, mtime, file_hash]).encode('utf-8') + b'\n'
+            buffered.append(line)
+            buffered_size += len(line)
+            if buffered_size >= CHUNK_WRITE_SIZE:
+                self._write_chunk(b''.join(buffered))
+                buffered = []
+                buffered_size = 0
+        self._write_chunk(b''.join(buffered))
+        self._end_chunked()
+
+    def _start_chunked(self, code, content_type):
+        """Start a response whose body is sent with chunked transfer encoding."""
+        self.send_response(code)
+        self.send_header('Content-type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def _write_chunk(self, data):
+        if data:
+            self.wfile.write('{:x}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n')
+
+    def _end_chunked(self):
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _send_json(self, code, resp_data, headers=None):
+        self._send_body(code, 'application/json', json.dumps(resp_data).encode('utf-8'), headers)
+
+    def _send_body(self, code, content_type, body, headers=None):
+        self.send_response(code)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
 
 
 class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
     """Handle requests in a separate thread."""
 
     def __init__(self, server_address, RequestHandlerClass, *args, **kwargs):
-        self.ip_queue = kwargs.pop('ip_queue', None)
         self.send_ack = kwargs.pop('send_ack', None)
         self.syncer = kwargs.pop('syncer', None)
         self.accountant = kwargs.pop('accountant')
         BaseHTTPServer.HTTPServer.__init__(self, server_address, RequestHandlerClass)
 
+    def process_request(self, request, client_address):
+        startup.mark_once('first request')
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
 
-def run_server(ip_queue=None, serve_on=('0.0.0.0', 8000), serve_dir='.', send_ack=True,
-               syncer=None, accountant=None):
+
+def run_server(serve_on=('0.0.0.0', 8000), serve_dir='.', send_ack=True,
+               syncer=None, accountant=None, reconcile_on_start=False):
+    """
+    reconcile_on_start: Fetch everything missing or stale here compared to
+                        each peer, once it's reachable (see reconcile.py).
+    """
     os.chdir(serve_dir)  # https://stackoverflow.com/a/39801780/1114457
     server = ThreadedHTTPServer(
         serve_on,
         RequestHandler,
-        ip_queue=ip_queue,
         send_ack=send_ack,
         syncer=syncer,
         accountant=accountant
     )
-    logger.info("\n>> Started web server; Use <Ctrl-C> to stop \n>> Serving on : {}".format(serve_on))
+    startup.mark('listening')
+    if syncer:
+        # Import what fetching changes needs while waiting for the first ones
+        warm_up_thread = threading.Thread(target=syncer.warm_up, name='warm-up')
+        warm_up_thread.daemon = True
+        warm_up_thread.start()
+    logger.info("\n>> Started web server; Use <Ctrl-C> to stop \n>> Serving on : %s", serve_on)
     logger.info(">> Started web server, use <Ctrl-C> to stop")
+    if reconcile_on_start:
+        for endpoint in syncer.peers:
+            reconciler = reconcile.Reconciler(syncer, endpoint=endpoint)
+            reconcile_thread = threading.Thread(target=reconciler.run_until_done,
+                                                name='reconcile-{}'.format(endpoint))
+            reconcile_thread.daemon = True
+            reconcile_thread.start()
     try:
         server.serve_forever()
     except KeyboardInterrupt: